@@ -1,13 +1,13 @@
 import os
-import threading
 import argparse
 from flask import Flask
 from waitress import serve
 
 # Import functionalities from the new forllm_server package
-from forllm_server.config import DATABASE, UPLOAD_FOLDER
-from forllm_server.database import init_db, close_db, update_setting
-from forllm_server.llm_queue import llm_worker
+from forllm_server.config import DATABASE, UPLOAD_FOLDER, LLM_WORKER_COUNT, WAITRESS_THREADS
+from forllm_server.database import init_db, close_db, update_setting, get_db
+from forllm_server.llm_processing import backfill_post_token_counts
+from forllm_server.llm_queue import start_llm_workers
 from forllm_server.file_indexer import scan_and_cache_files
 
 # Import Blueprints
@@ -51,16 +51,30 @@ def reset_theme_to_default():
         update_setting('theme', 'theme-silvery')
         print("Theme has been reset.")
 
+def backfill_token_counts():
+    """Stores token counts for posts written before they were counted on write."""
+    with app.app_context():
+        print("Backfilling post token counts...")
+        counted = backfill_post_token_counts(get_db())
+        print(f"Token counts stored for {counted} posts.")
+
 # --- Main Execution ---
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Run the forllm server.")
     parser.add_argument('--reset-theme', action='store_true', help="Reset the application theme to the default 'silvery' and exit.")
+    parser.add_argument('--backfill-token-counts', action='store_true', help="Store token counts for existing posts that don't have them yet and exit.")
     parser.add_argument('--debug', action='store_true', help="Run the application in Flask's debug mode.")
+    parser.add_argument('--workers', type=int, default=LLM_WORKER_COUNT, help=f"Number of concurrent LLM worker threads (default: {LLM_WORKER_COUNT}).")
     args = parser.parse_args()
 
     if args.reset_theme:
         reset_theme_to_default()
         exit()
+
+    if args.backfill_token_counts:
+        init_db() # Adds the token count columns to older databases
+        backfill_token_counts()
+        exit()
         
     # Create upload folder if it doesn't exist
     try:
@@ -74,10 +88,9 @@ if __name__ == '__main__':
     print("Initializing database...")
     init_db() # Ensure DB exists and schema is created/verified
 
-    print("Starting LLM Worker thread...")
-    # Pass the Flask 'app' instance to the llm_worker thread
-    worker_thread = threading.Thread(target=llm_worker, args=(app,), daemon=True)
-    worker_thread.start()
+    print(f"Starting {args.workers} LLM Worker thread(s)...")
+    # Pass the Flask 'app' instance to each llm_worker thread in the pool
+    worker_threads = start_llm_workers(app, args.workers)
 
     # Initial file indexing on startup
     with app.app_context():
@@ -93,4 +106,4 @@ if __name__ == '__main__':
     else:
         print("Starting production server with Waitress...")
         # Host 0.0.0.0 makes it accessible on the network
-        serve(app, host='0.0.0.0', port=4773)
\ No newline at end of file
+        serve(app, host='0.0.0.0', port=4773, threads=WAITRESS_THREADS)
\ No newline at end of file
@@ -4,12 +4,127 @@ DATABASE = 'forllm_data.db'
 CURRENT_USER_ID = 1
 CURRENT_USERNAME = "LocalUser"
 # Placeholder for Ollama API endpoint
-OLLAMA_BASE_URL = "http://localhost:11434" # Base Ollama URL
-# OLLAMA_API_BASE_URL is used by ollama_utils to fetch model details
-OLLAMA_API_BASE_URL = 'http://localhost:11434'
-OLLAMA_GENERATE_URL = f"{OLLAMA_BASE_URL}/api/generate"
-OLLAMA_TAGS_URL = f"{OLLAMA_BASE_URL}/api/tags" # Endpoint to list local models
+OLLAMA_BASE_URL = "http://localhost:11434" # Base Ollama URL; all calls go through ollama_client.py
+# Every Ollama server requests may be routed to. Add one URL per inference box; each request goes to a
+# healthy backend that already has its model loaded, else to the one with the fewest requests in flight.
+OLLAMA_BACKENDS = [OLLAMA_BASE_URL]
 DEFAULT_MODEL = "llama3" # A sensible default
+# How replies are requested from Ollama:
+#   'chat'     - /api/chat with the persona as the system message and a prefix-stable user message
+#                (history first, the post being answered last), so consecutive requests on a thread
+#                reuse Ollama's prompt (KV) cache instead of re-evaluating the whole history.
+#   'generate' - the original single prompt sent to /api/generate.
+OLLAMA_PROMPT_MODE = 'chat'
+
+# --- Ollama HTTP client (ollama_client.py) ---
+OLLAMA_CONNECT_TIMEOUT = 5          # Seconds to establish a connection
+OLLAMA_READ_TIMEOUT = 300           # Max seconds between reads; model loading and prompt eval can be slow
+OLLAMA_METADATA_READ_TIMEOUT = 10   # For quick calls such as /api/tags, /api/ps and /api/show
+OLLAMA_HTTP_POOL_SIZE = 8           # Keep-alive connections kept open per Ollama host
+OLLAMA_NUM_PARALLEL = 2             # Requests each backend runs at once; match the server's OLLAMA_NUM_PARALLEL
+OLLAMA_BACKEND_RETRY_SECONDS = 30   # A backend that refused a connection is skipped this long before being tried again
+OLLAMA_MODEL_LIST_CACHE_SECONDS = 60 # With several backends, model requests only go to those whose /api/tags (re-read this often) lists the model
+# Circuit breaker: after this many consecutive failed calls (connection errors, timeouts, 5xx) workers stop
+# claiming requests. Every OLLAMA_CIRCUIT_OPEN_SECONDS one worker probes /api/ps; the pause doubles up to
+# OLLAMA_CIRCUIT_MAX_OPEN_SECONDS while Ollama stays down, and claiming resumes as soon as a probe succeeds.
+OLLAMA_CIRCUIT_FAILURE_THRESHOLD = 3
+OLLAMA_CIRCUIT_OPEN_SECONDS = 15
+OLLAMA_CIRCUIT_MAX_OPEN_SECONDS = 240
+OLLAMA_STREAM_CHUNK_SIZE = 64 * 1024 # Bytes read at a time from streaming responses
+
+# --- LLM Queue ---
+# Number of worker threads draining llm_requests concurrently.
+# One per request slot across all backends, so throughput scales with the number of inference boxes.
+LLM_WORKER_COUNT = OLLAMA_NUM_PARALLEL * len(OLLAMA_BACKENDS)
+# A claimed request is leased to its worker for this long and the lease is renewed
+# while the worker is alive; rows whose lease lapses are reclaimed by other workers.
+LLM_REQUEST_LEASE_SECONDS = 120
+# How often the reaper looks for 'processing' rows left behind by a dead worker (it also runs at startup)
+# and for 'pending_dependency' rows whose parent can no longer release them.
+LLM_REAPER_INTERVAL_SECONDS = 60
+# Idle workers are woken at once by this process's notify_llm_queue(); requests queued by another server
+# process sharing the database are only seen when they poll, which they do at least this often.
+LLM_QUEUE_POLL_SECONDS = 5
+# While a request runs, its worker checks this often whether the row was cancelled (possibly by another
+# server process) so the Ollama call is cut off promptly; the lease itself is renewed every LEASE/3.
+LLM_CANCEL_CHECK_SECONDS = 2
+# Longest a worker (or the model warmup thread) sleeps on the processing schedule alone - outside a window,
+# behind an open Ollama circuit - before re-reading it, so a clock jump or an edit made elsewhere is picked up.
+LLM_SCHEDULE_RECHECK_SECONDS = 60
+# Each process caches the compiled schedule; schedule edits bump a version row in settings, which readers
+# compare against at most this often, so an edit made through another server process takes effect too.
+SCHEDULE_VERSION_CHECK_SECONDS = 2
+# Workers prefer requests for a model Ollama already has loaded, so a mixed-model backlog
+# doesn't swap weights on every request. A request that has waited longer than this is
+# served in plain FIFO order again, which bounds how long other models can be starved.
+LLM_MODEL_AFFINITY_MAX_WAIT_SECONDS = 300
+# A request that fails for a transient reason (Ollama unreachable, timed out, 5xx) goes back to 'pending'
+# and is retried after LLM_RETRY_BASE_DELAY_SECONDS * 2^(attempts - 1), capped at LLM_RETRY_MAX_DELAY_SECONDS.
+# It is marked 'error' after LLM_MAX_ATTEMPTS attempts.
+LLM_MAX_ATTEMPTS = 5
+LLM_RETRY_BASE_DELAY_SECONDS = 10
+LLM_RETRY_MAX_DELAY_SECONDS = 600
+# Priority classes for llm_requests.priority; higher is served first.
+LLM_PRIORITY_BULK = 0          # Persona generation jobs
+LLM_PRIORITY_INTERACTIVE = 10  # Replies to posts
+LLM_PRIORITY_BUMPED = 20       # Set through POST /api/queue/<id>/bump
+# Requests are compared by class (priority // LLM_PRIORITY_CLASS_WIDTH), so model affinity
+# still applies between requests of the same class.
+LLM_PRIORITY_CLASS_WIDTH = 10
+# A waiting request below the interactive class gains one priority point per this many seconds, up to
+# LLM_PRIORITY_INTERACTIVE. Aged bulk work then shares the interactive class but still yields to
+# interactive requests (ties go to the higher base priority), and bumped requests always go first.
+LLM_PRIORITY_AGING_SECONDS = 60
+# While a reply streams in, the text generated so far is saved to llm_requests.partial_response
+# this often, so a crash doesn't lose a long generation.
+LLM_STREAM_PERSIST_SECONDS = 5
+# Finished streams stay available to late SSE subscribers for this long.
+LLM_STREAM_RETENTION_SECONDS = 60
+# Idle SSE connections get a keep-alive comment this often.
+LLM_STREAM_HEARTBEAT_SECONDS = 15
+# How long the list of loaded models from /api/ps is reused before asking Ollama again.
+OLLAMA_LOADED_MODELS_CACHE_SECONDS = 10
+# Queue ETAs (GET /api/queue) assume each model keeps the throughput it averaged over this window.
+LLM_ETA_HISTORY_HOURS = 7 * 24
+# Assumed run time of a request when no request has completed in that window yet.
+LLM_ETA_DEFAULT_SECONDS = 120
+# GET /api/queue is polled; its ETA replay is reused for this long unless the queue changes in this process.
+LLM_ETA_CACHE_SECONDS = 5
+# When a processing window opens, the models of pending requests (the LLM_WARMUP_MAX_MODELS most requested ones)
+# are loaded before the first request needs them.
+LLM_WARMUP_MAX_MODELS = 2
+# keep_alive sent with each generation: how long Ollama keeps the model loaded afterwards, longer while more requests
+# for the same model are queued. Capped at the time left in the window when LLM_RELEASE_MODELS_AT_WINDOW_END is set.
+LLM_KEEP_ALIVE_BUSY_SECONDS = 30 * 60
+LLM_KEEP_ALIVE_IDLE_SECONDS = 5 * 60
+# Unload the models the queue used when the window closes, so their memory is free for daytime work.
+LLM_RELEASE_MODELS_AT_WINDOW_END = True
+
+# --- LLM Response Cache ---
+# Replies are cached by (model, generation options, hash of the full prompt sent), so requesting a reply
+# to an unchanged thread again returns the earlier answer instead of generating it again.
+# Requests can opt out with "use_cache": false in POST /api/posts/<id>/request_llm.
+LLM_RESPONSE_CACHE_ENABLED = True
+LLM_RESPONSE_CACHE_TTL_SECONDS = 7 * 24 * 3600
+LLM_RESPONSE_CACHE_MAX_ENTRIES = 500 # Least recently used entries are evicted beyond this
+# A request whose exact prompt is already being generated by another request is put back in the queue
+# until that one finishes (then served from the cache); this caps how long it waits before checking again.
+LLM_RESPONSE_CACHE_COALESCE_WAIT_SECONDS = 60
+
+# --- Token Counting ---
+# Token counts are memoized by a hash of the text, so persona instructions, headers and attachments
+# aren't re-encoded for every prompt build and estimate. Least recently used counts are evicted
+# once the cache's memory use exceeds this.
+TOKEN_COUNT_CACHE_MAX_BYTES = 4 * 1024 * 1024
+# Threads tiktoken uses when count_tokens_batch encodes several uncached texts at once. Starting them only
+# pays off for enough text; smaller batches are encoded one by one on the calling thread.
+TOKEN_COUNT_BATCH_THREADS = 4
+TOKEN_COUNT_BATCH_MIN_CHARS = 64 * 1024
+
+# --- Server ---
+# Waitress worker threads. Each open SSE stream holds one, so keep this well above
+# the number of browser tabs expected to watch topics at once.
+WAITRESS_THREADS = 16
 
 # Map Python's weekday() to short day names
 DAY_MAP = {0: 'Mon', 1: 'Tue', 2: 'Wed', 3: 'Thu', 4: 'Fri', 5: 'Sat', 6: 'Sun'}
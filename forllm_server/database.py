@@ -1,9 +1,39 @@
 import sqlite3
 import datetime
+import hashlib
+import json
 import logging # ADDED
+import math
 import os
 from flask import g, current_app # Added current_app for logger access
-from .config import DATABASE, CURRENT_USER_ID, CURRENT_USERNAME, DEFAULT_MODEL
+from .config import (DATABASE, CURRENT_USER_ID, CURRENT_USERNAME, DEFAULT_MODEL,
+                     LLM_PRIORITY_BULK, LLM_PRIORITY_INTERACTIVE, LLM_PRIORITY_BUMPED, LLM_PRIORITY_CLASS_WIDTH, LLM_PRIORITY_AGING_SECONDS, LLM_MAX_ATTEMPTS,
+                     LLM_RETRY_BASE_DELAY_SECONDS, LLM_RETRY_MAX_DELAY_SECONDS, LLM_RESPONSE_CACHE_TTL_SECONDS,
+                     LLM_RESPONSE_CACHE_MAX_ENTRIES)
+
+# Per-request performance columns on llm_requests: Ollama's counters from the final stream chunk
+# (durations in nanoseconds, as Ollama reports them) and the server-side timings around them.
+LLM_REQUEST_OLLAMA_METRIC_COLUMNS = ('total_duration', 'load_duration', 'prompt_eval_count', 'prompt_eval_duration',
+                                     'eval_count', 'eval_duration')
+LLM_REQUEST_TIMING_COLUMNS = ('queue_wait_seconds', 'prompt_build_seconds', 'time_to_first_token_seconds')
+# Sort keys ranking waiting requests, all DESC: bumped rows first, then the priority class with aging,
+# then the base priority. Aging lifts a row below the interactive class at most up to LLM_PRIORITY_INTERACTIVE,
+# and the base priority breaks the tie there, so aged bulk work never outranks interactive or bumped work.
+_LLM_PRIORITY_ORDER_KEYS = (
+    "priority >= ?",
+    "CAST(CASE WHEN priority >= ? THEN priority"
+    " ELSE MIN(priority + (julianday('now') - julianday(requested_at)) * 86400.0 / ?, ?) END / ? AS INTEGER)",
+    "priority",
+)
+_LLM_PRIORITY_ORDER_PARAMS = (LLM_PRIORITY_BUMPED, LLM_PRIORITY_INTERACTIVE, LLM_PRIORITY_AGING_SECONDS,
+                              LLM_PRIORITY_INTERACTIVE, LLM_PRIORITY_CLASS_WIDTH)
+
+def _llm_priority_order_sql(only_when: str | None = None) -> str:
+    """ORDER BY terms for _LLM_PRIORITY_ORDER_KEYS (takes _LLM_PRIORITY_ORDER_PARAMS), optionally only for rows matching only_when."""
+    keys = _LLM_PRIORITY_ORDER_KEYS
+    if only_when:
+        keys = [f"CASE WHEN {only_when} THEN {key} END" for key in keys]
+    return ", ".join(f"{key} DESC" for key in keys)
 
 def get_db():
     """Opens a new database connection if there is none yet for the current application context."""
@@ -23,6 +53,10 @@ def init_db():
     db.row_factory = sqlite3.Row  # Use dictionary-like rows for this connection
     cursor = db.cursor()
 
+    # WAL lets the web requests keep reading while LLM workers write replies concurrently.
+    # The journal mode is persistent, so setting it here covers every later connection.
+    cursor.execute("PRAGMA journal_mode=WAL")
+
     # Check if users table exists (as a proxy for initial setup)
     cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='users'")
     users_table_exists = cursor.fetchone()
@@ -99,7 +133,7 @@ def init_db():
                 request_id INTEGER PRIMARY KEY AUTOINCREMENT,
                 post_id_to_respond_to INTEGER, -- Made nullable
                 requested_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                status TEXT NOT NULL DEFAULT 'pending', -- pending, processing, complete, error, pending_dependency
+                status TEXT NOT NULL DEFAULT 'pending', -- pending, processing, complete, error, pending_dependency, cancelled
                 llm_model TEXT,
                 llm_persona TEXT,
                 processed_at TIMESTAMP,
@@ -395,6 +429,111 @@ def init_db():
             print(f"Error adding 'parent_request_id' column to llm_requests: {e}")
             db.rollback()
 
+    # --- Check and add lease columns to 'llm_requests' for atomic claiming across workers/processes ---
+    cursor.execute("PRAGMA table_info(llm_requests)")
+    columns = [col[1] for col in cursor.fetchall()]
+    for column_name, column_type in (('lease_owner', 'TEXT'), ('lease_expires_at', 'TIMESTAMP')):
+        if column_name not in columns:
+            print(f"Updating llm_requests table: Adding '{column_name}' column...")
+            try:
+                cursor.execute(f"ALTER TABLE llm_requests ADD COLUMN {column_name} {column_type}")
+                db.commit()
+                print(f"'{column_name}' column added to llm_requests.")
+            except Exception as e:
+                print(f"Error adding '{column_name}' column to llm_requests: {e}")
+                db.rollback()
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_llm_requests_status ON llm_requests(status, requested_at)')
+    db.commit()
+
+    # --- Check and add 'partial_response' to 'llm_requests' (text saved periodically while streaming) ---
+    if 'partial_response' not in columns:
+        print("Updating llm_requests table: Adding 'partial_response' column...")
+        try:
+            cursor.execute("ALTER TABLE llm_requests ADD COLUMN partial_response TEXT")
+            db.commit()
+            print("'partial_response' column added to llm_requests.")
+        except Exception as e:
+            print(f"Error adding 'partial_response' column to llm_requests: {e}")
+            db.rollback()
+
+    # --- Check and add 'priority' to 'llm_requests' so replies aren't queued behind bulk jobs ---
+    if 'priority' not in columns:
+        print("Updating llm_requests table: Adding 'priority' column...")
+        try:
+            cursor.execute(f"ALTER TABLE llm_requests ADD COLUMN priority INTEGER NOT NULL DEFAULT {int(LLM_PRIORITY_INTERACTIVE)}")
+            cursor.execute("UPDATE llm_requests SET priority = ? WHERE request_type = 'generate_persona'", (LLM_PRIORITY_BULK,))
+            db.commit()
+            print("'priority' column added to llm_requests.")
+        except Exception as e:
+            print(f"Error adding 'priority' column to llm_requests: {e}")
+            db.rollback()
+
+    # --- Check and add response cache bookkeeping to 'llm_requests' ---
+    # use_cache: per-request opt-out; prompt_cache_key: key of the prompt sent (see make_llm_response_cache_key);
+    # cache_status: 'hit', 'miss' or 'bypass'; coalesced_into: the identical in-flight request it waited for.
+    for column_name, column_type in (('use_cache', 'INTEGER NOT NULL DEFAULT 1'), ('prompt_cache_key', 'TEXT'),
+                                     ('cache_status', 'TEXT'), ('coalesced_into', 'INTEGER')):
+        if column_name not in columns:
+            print(f"Updating llm_requests table: Adding '{column_name}' column...")
+            try:
+                cursor.execute(f"ALTER TABLE llm_requests ADD COLUMN {column_name} {column_type}")
+                db.commit()
+                print(f"'{column_name}' column added to llm_requests.")
+            except Exception as e:
+                print(f"Error adding '{column_name}' column to llm_requests: {e}")
+                db.rollback()
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_llm_requests_prompt_cache_key ON llm_requests(prompt_cache_key)')
+    db.commit()
+
+    # --- Check and add retry bookkeeping to 'llm_requests' (transient failures are retried with backoff) ---
+    # response_post_id records the reply a completed request wrote, so stranded dependents can be re-linked to it.
+    for column_name, column_type in (('attempt_count', 'INTEGER NOT NULL DEFAULT 0'), ('last_error', 'TEXT'),
+                                     ('next_attempt_at', 'TIMESTAMP'), ('response_post_id', 'INTEGER REFERENCES posts(post_id)')):
+        if column_name not in columns:
+            print(f"Updating llm_requests table: Adding '{column_name}' column...")
+            try:
+                cursor.execute(f"ALTER TABLE llm_requests ADD COLUMN {column_name} {column_type}")
+                db.commit()
+                print(f"'{column_name}' column added to llm_requests.")
+            except Exception as e:
+                print(f"Error adding '{column_name}' column to llm_requests: {e}")
+                db.rollback()
+
+    # --- Check and add performance counters to 'llm_requests' (see record_llm_request_metrics) ---
+    # The *_duration columns are Ollama's own counters from the final stream chunk, in nanoseconds;
+    # the *_seconds columns are measured by the server.
+    for column_name in LLM_REQUEST_OLLAMA_METRIC_COLUMNS + LLM_REQUEST_TIMING_COLUMNS:
+        if column_name not in columns:
+            column_type = 'REAL' if column_name.endswith('_seconds') else 'INTEGER'
+            print(f"Updating llm_requests table: Adding '{column_name}' column...")
+            try:
+                cursor.execute(f"ALTER TABLE llm_requests ADD COLUMN {column_name} {column_type}")
+                db.commit()
+                print(f"'{column_name}' column added to llm_requests.")
+            except Exception as e:
+                print(f"Error adding '{column_name}' column to llm_requests: {e}")
+                db.rollback()
+    # Windowed aggregates (get_llm_queue_metrics) scan finished requests by when they finished
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_llm_requests_processed_at ON llm_requests(processed_at)')
+    db.commit()
+
+    # --- Check and add window-end admission rules to 'schedule' (see scheduler.get_processing_window_at) ---
+    # admission_policy 'fit': near the end of the window only start requests predicted to finish before it closes
+    # (plus overrun_grace_minutes); 'any': start whatever is next as long as the window is open.
+    cursor.execute("PRAGMA table_info(schedule)")
+    schedule_columns = [col[1] for col in cursor.fetchall()]
+    for column_name, column_type in (('admission_policy', "TEXT NOT NULL DEFAULT 'fit'"),
+                                     ('overrun_grace_minutes', 'INTEGER NOT NULL DEFAULT 0')):
+        if column_name not in schedule_columns:
+            print(f"Updating schedule table: Adding '{column_name}' column...")
+            try:
+                cursor.execute(f"ALTER TABLE schedule ADD COLUMN {column_name} {column_type}")
+                db.commit()
+                print(f"'{column_name}' column added to schedule.")
+            except Exception as e:
+                print(f"Error adding '{column_name}' column to schedule: {e}")
+                db.rollback()
+
 
     print("Verifying/Creating Persona management tables and defaults...")
     cursor.execute('''
@@ -512,6 +651,28 @@ def init_db():
         print("llm_model_metadata table verified/created.")
     except sqlite3.Error as e:
         print(f"Error creating/verifying llm_model_metadata table: {e}")
+
+    # --- Create llm_response_cache table (finished replies by prompt, see LLM_RESPONSE_CACHE_* in config.py) ---
+    print("Verifying/Creating llm_response_cache table...")
+    try:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS llm_response_cache (
+                cache_key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                options TEXT,
+                prompt_hash TEXT NOT NULL,
+                response TEXT NOT NULL,
+                generation_seconds REAL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                hit_count INTEGER NOT NULL DEFAULT 0
+            );
+        """)
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_llm_response_cache_last_used ON llm_response_cache(last_used_at)')
+        db.commit()
+        print("llm_response_cache table verified/created.")
+    except sqlite3.Error as e:
+        print(f"Error creating/verifying llm_response_cache table: {e}")
         # No rollback needed here usually for CREATE IF NOT EXISTS, but good practice if part of larger transaction block
         # db.rollback()
  
@@ -604,6 +765,72 @@ def init_db():
         print(f"Error creating/verifying File Tagging Feature tables: {e}")
         db.rollback()
 
+    # --- Check and add stored token counts to 'posts' so prompt builds don't re-tokenize every post ---
+    # content_tokens: the post text; history_line_tokens: its chat-history line including the trailing newline
+    # (see update_post_token_counts in llm_processing). NULL means not counted yet: prompt builds count and store
+    # the missing ones of the thread they use, and `forllm.py --backfill-token-counts` fills in the rest.
+    cursor.execute("PRAGMA table_info(posts)")
+    columns = [col[1] for col in cursor.fetchall()]
+    for column_name in ('content_tokens', 'history_line_tokens'):
+        if column_name not in columns:
+            print(f"Updating posts table: Adding '{column_name}' column...")
+            try:
+                cursor.execute(f"ALTER TABLE posts ADD COLUMN {column_name} INTEGER")
+                db.commit()
+                print(f"'{column_name}' column added to posts.")
+            except Exception as e:
+                print(f"Error adding '{column_name}' column to posts: {e}")
+                db.rollback()
+
+    # --- Check and add 'thread_path' to 'posts': a materialized path so ancestors, subtrees and thread order
+    # are single indexed queries instead of walking parent_post_id (see set_post_thread_path) ---
+    if 'thread_path' not in columns:
+        print("Updating posts table: Adding 'thread_path' column...")
+        try:
+            cursor.execute("ALTER TABLE posts ADD COLUMN thread_path TEXT")
+            db.commit()
+            print("'thread_path' column added to posts.")
+        except Exception as e:
+            print(f"Error adding 'thread_path' column to posts: {e}")
+            db.rollback()
+    # Fill in paths for existing posts, one tree level per pass; posts whose parent is gone become roots
+    filled = 0
+    while True:
+        cursor.execute(f"""
+            UPDATE posts SET thread_path = COALESCE(
+                (SELECT parent.thread_path FROM posts parent WHERE parent.post_id = posts.parent_post_id), ''
+            ) || {_POST_PATH_SEGMENT_SQL}
+            WHERE thread_path IS NULL
+              AND (parent_post_id IS NULL
+                   OR NOT EXISTS (SELECT 1 FROM posts parent WHERE parent.post_id = posts.parent_post_id)
+                   OR (SELECT parent.thread_path FROM posts parent WHERE parent.post_id = posts.parent_post_id) IS NOT NULL)
+        """)
+        if cursor.rowcount <= 0:
+            break
+        filled += cursor.rowcount
+    if filled:
+        print(f"Filled in thread_path for {filled} posts.")
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_posts_thread_path ON posts(thread_path)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_posts_topic_thread_path ON posts(topic_id, thread_path)')
+    db.commit()
+
+    # --- Check and add 'branch_root_id' to 'posts': the top-level post of its tree (the first thread_path segment),
+    # so recent posts per sibling branch come from one windowed query (see get_recent_posts_from_sibling_branches) ---
+    if 'branch_root_id' not in columns:
+        print("Updating posts table: Adding 'branch_root_id' column...")
+        try:
+            cursor.execute("ALTER TABLE posts ADD COLUMN branch_root_id INTEGER")
+            db.commit()
+            print("'branch_root_id' column added to posts.")
+        except Exception as e:
+            print(f"Error adding 'branch_root_id' column to posts: {e}")
+            db.rollback()
+    cursor.execute("""
+        UPDATE posts SET branch_root_id = CAST(substr(thread_path, 1, instr(thread_path, '/') - 1) AS INTEGER)
+        WHERE branch_root_id IS NULL AND thread_path IS NOT NULL
+    """)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_posts_topic_branch_root ON posts(topic_id, branch_root_id, created_at)')
+    db.commit()
 
     db.close()
 def soft_delete_post(post_id):
@@ -639,7 +866,9 @@ def soft_delete_post(post_id):
                 UPDATE posts
                 SET content = '[Post Deleted]',
                     tagged_personas_in_content = NULL,
-                    tagged_files_in_content = NULL
+                    tagged_files_in_content = NULL,
+                    content_tokens = NULL,
+                    history_line_tokens = NULL
                 WHERE post_id = ?
             """, (post_id,))
 
@@ -666,7 +895,7 @@ def update_post(post_id, content, title=None, tagged_persona_ids=None, tagged_fi
             cursor = db.cursor()
             
             # Prepare the update query
-            update_fields = ["content = ?"]
+            update_fields = ["content = ?", "content_tokens = NULL", "history_line_tokens = NULL"] # Recounted by the caller
             params = [content]
 
             if tagged_persona_ids is not None:
@@ -805,6 +1034,125 @@ def cache_model_context_window(db, model_name: str, context_window: int | None):
     except sqlite3.Error as e:
         logger.error(f"Database error in cache_model_context_window for {model_name}: {e}")
 
+# --- LLM Response Cache Logic ---
+
+def make_llm_response_cache_key(model: str, options, prompt: str) -> tuple[str, str]:
+    """
+    Returns (cache_key, prompt_hash) for a prompt. options holds everything besides the prompt that
+    changes the output (prompt mode, Ollama generation options); it is serialized with sorted keys.
+    """
+    prompt_hash = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+    options_json = json.dumps(options or {}, sort_keys=True)
+    cache_key = hashlib.sha256(f"{model}\n{options_json}\n{prompt_hash}".encode('utf-8')).hexdigest()
+    return cache_key, prompt_hash
+
+def get_cached_llm_response(db_connection, cache_key: str):
+    """
+    Returns (response, generation_seconds) for a cached prompt younger than LLM_RESPONSE_CACHE_TTL_SECONDS,
+    counting the hit, or None on a miss.
+    """
+    row = db_connection.execute("""
+        SELECT response, generation_seconds FROM llm_response_cache
+        WHERE cache_key = ? AND created_at > datetime('now', ?)
+    """, (cache_key, f"-{int(LLM_RESPONSE_CACHE_TTL_SECONDS)} seconds")).fetchone()
+    if row is None:
+        return None
+    db_connection.execute("""
+        UPDATE llm_response_cache SET hit_count = hit_count + 1, last_used_at = CURRENT_TIMESTAMP WHERE cache_key = ?
+    """, (cache_key,))
+    db_connection.commit()
+    return row[0], row[1]
+
+def store_llm_response(db_connection, cache_key: str, model: str, options, prompt_hash: str, response: str,
+                       generation_seconds: float | None) -> int:
+    """
+    Caches a finished reply, then drops expired entries and the least recently used ones beyond
+    LLM_RESPONSE_CACHE_MAX_ENTRIES. Returns the number of entries evicted.
+    """
+    db_connection.execute("""
+        INSERT INTO llm_response_cache (cache_key, model, options, prompt_hash, response, generation_seconds)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(cache_key) DO UPDATE SET
+            response = excluded.response, generation_seconds = excluded.generation_seconds,
+            created_at = CURRENT_TIMESTAMP, last_used_at = CURRENT_TIMESTAMP
+    """, (cache_key, model, json.dumps(options or {}, sort_keys=True), prompt_hash, response, generation_seconds))
+    evicted = db_connection.execute("DELETE FROM llm_response_cache WHERE created_at <= datetime('now', ?)",
+                                    (f"-{int(LLM_RESPONSE_CACHE_TTL_SECONDS)} seconds",)).rowcount
+    evicted += db_connection.execute("""
+        DELETE FROM llm_response_cache WHERE cache_key IN (
+            SELECT cache_key FROM llm_response_cache ORDER BY last_used_at DESC, created_at DESC LIMIT -1 OFFSET ?
+        )
+    """, (LLM_RESPONSE_CACHE_MAX_ENTRIES,)).rowcount
+    db_connection.commit()
+    return evicted
+
+def register_llm_request_prompt(db_connection, request_id: int, cache_key: str) -> int | None:
+    """
+    Records the cache key of the prompt a request is about to generate and returns the id of another
+    request already generating the same prompt, if any. Check and write happen in one write transaction,
+    so of two identical requests claimed together exactly one ends up generating.
+    """
+    try:
+        db_connection.execute("BEGIN IMMEDIATE")
+        row = db_connection.execute("""
+            SELECT request_id FROM llm_requests
+            WHERE prompt_cache_key = ? AND status = 'processing' AND request_id != ?
+            ORDER BY request_id LIMIT 1
+        """, (cache_key, request_id)).fetchone()
+        # Past any earlier wait on another request; defer_llm_request_for_prompt sets coalesced_into again if needed.
+        db_connection.execute("UPDATE llm_requests SET prompt_cache_key = ?, coalesced_into = NULL WHERE request_id = ?", (cache_key, request_id))
+        db_connection.commit()
+    except sqlite3.Error:
+        db_connection.rollback()
+        raise
+    return row[0] if row else None
+
+def defer_llm_request_for_prompt(db_connection, request_id: int, leader_request_id: int, wait_seconds: int) -> bool:
+    """
+    Puts a request back in the queue to wait for leader_request_id, which is generating the same prompt.
+    The claim isn't counted as an attempt. release_llm_requests_waiting_for_prompt wakes it early.
+    """
+    cursor = db_connection.execute("""
+        UPDATE llm_requests
+        SET status = 'pending', coalesced_into = ?, attempt_count = MAX(0, attempt_count - 1),
+            lease_owner = NULL, lease_expires_at = NULL, next_attempt_at = datetime('now', ?)
+        WHERE request_id = ? AND status = 'processing'
+    """, (leader_request_id, f"+{int(wait_seconds)} seconds", request_id))
+    db_connection.commit()
+    return cursor.rowcount > 0
+
+def release_llm_requests_waiting_for_prompt(db_connection, cache_key: str) -> int:
+    """Makes requests deferred behind an identical prompt claimable now (its reply is cached, or it failed)."""
+    cursor = db_connection.execute("""
+        UPDATE llm_requests SET next_attempt_at = NULL, coalesced_into = NULL
+        WHERE prompt_cache_key = ? AND status = 'pending' AND coalesced_into IS NOT NULL
+    """, (cache_key,))
+    db_connection.commit()
+    return cursor.rowcount
+
+def get_llm_response_cache_stats(db_connection) -> dict:
+    """Cache size, hits and generation time saved, plus how many requests were served each way."""
+    entries, total_hits, saved_seconds = db_connection.execute("""
+        SELECT COUNT(*), COALESCE(SUM(hit_count), 0), COALESCE(SUM(hit_count * generation_seconds), 0)
+        FROM llm_response_cache
+    """).fetchone()
+    requests_by_status = {status: count for status, count in db_connection.execute("""
+        SELECT cache_status, COUNT(*) FROM llm_requests WHERE cache_status IS NOT NULL GROUP BY cache_status
+    """)}
+    # coalesced_into is cleared once a request stops waiting, so this counts the requests waiting right now
+    coalesced = db_connection.execute("SELECT COUNT(*) FROM llm_requests WHERE coalesced_into IS NOT NULL AND status = 'pending'").fetchone()[0]
+    return {
+        'entries': entries,
+        'max_entries': LLM_RESPONSE_CACHE_MAX_ENTRIES,
+        'ttl_seconds': LLM_RESPONSE_CACHE_TTL_SECONDS,
+        'total_hits': total_hits,
+        'saved_generation_seconds': round(saved_seconds, 1),
+        'requests_hit': requests_by_status.get('hit', 0),
+        'requests_miss': requests_by_status.get('miss', 0),
+        'requests_bypass': requests_by_status.get('bypass', 0),
+        'requests_coalesced': coalesced,
+    }
+
 # ------------------- PERSONA MANAGEMENT LOGIC -------------------
 
 def create_persona(name, prompt_instructions, created_by_user):
@@ -838,112 +1186,494 @@ def create_persona(name, prompt_instructions, created_by_user):
             db.rollback()
         return (False, "A database error occurred.")
 
-# ------------------- POST ANCESTOR LOGIC -------------------
+# ------------------- LLM REQUEST QUEUE LOGIC -------------------
 
-def get_post_ancestors(post_id, db_connection):
+def claim_next_llm_request(db_connection, lease_owner: str, lease_seconds: int,
+                           preferred_models=None, max_affinity_wait_seconds: int | None = None,
+                           only_request_ids=None):
     """
-    Fetches a post and all its ancestors up to the topic root.
-    Returns the posts in chronological order (oldest first).
+    Atomically claims the next claimable llm_requests row for lease_owner.
+    A row is claimable when it is 'pending' and not waiting out a retry backoff (next_attempt_at).
+    Rows left 'processing' by a dead worker are put back to 'pending' by requeue_stuck_llm_requests.
+    Claiming counts as an attempt (attempt_count).
+    Bumped rows are taken first, then rows by priority class. A row below the interactive class gains one
+    priority point per LLM_PRIORITY_AGING_SECONDS waited, up to LLM_PRIORITY_INTERACTIVE, and ties in that
+    class go to the higher base priority, so bulk work still gets served but never ahead of interactive work.
+    Within the same class and base priority, rows whose llm_model is in preferred_models (models Ollama already has loaded) go first,
+    unless an older row has waited longer than max_affinity_wait_seconds; rows that old rank
+    with the preferred ones, so they are served in plain FIFO order and can't starve.
+    only_request_ids, if given, limits the claim to those rows (e.g. the ones that fit before the window ends).
+    The claim is a single UPDATE ... RETURNING inside an IMMEDIATE transaction, so two
+    workers or two server processes can never claim the same row.
+    Returns the claimed row, or None if nothing is claimable.
     """
-    posts = []
-    current_post_id = post_id
-    while current_post_id:
-        cursor = db_connection.execute(
-            """
-            SELECT post_id, topic_id, user_id, parent_post_id, content,
-                   created_at, is_llm_response, llm_model_id AS llm_model_name, llm_persona_id
-            FROM posts
-            WHERE post_id = ?
-            """,
-            (current_post_id,),
-        )
-        post = cursor.fetchone()
-        if post:
-            posts.append(dict(post))
-            current_post_id = post["parent_post_id"]
-        else:
-            # Post not found, break the loop
+    if only_request_ids is not None and not only_request_ids:
+        return None
+    lease_modifier = f"+{int(lease_seconds)} seconds"
+    restriction = ""
+    restriction_params = []
+    if only_request_ids is not None:
+        restriction = f"AND request_id IN ({', '.join('?' for _ in only_request_ids)})"
+        restriction_params = list(only_request_ids)
+    preferred_models = list(preferred_models or [])
+    affinity_conditions = []
+    affinity_params = []
+    if preferred_models:
+        affinity_conditions.append(f"llm_model IN ({', '.join('?' for _ in preferred_models)})")
+        affinity_params.extend(preferred_models)
+    if max_affinity_wait_seconds is not None:
+        affinity_conditions.append("requested_at <= datetime('now', ?)")
+        affinity_params.append(f"-{int(max_affinity_wait_seconds)} seconds")
+    if affinity_conditions:
+        affinity_order = f"CASE WHEN {' OR '.join(affinity_conditions)} THEN 0 ELSE 1 END ASC,"
+    else:
+        affinity_order = ""
+
+    try:
+        db_connection.execute("BEGIN IMMEDIATE")
+        cursor = db_connection.execute(f"""
+            UPDATE llm_requests
+            SET status = 'processing',
+                processed_at = CURRENT_TIMESTAMP,
+                lease_owner = ?,
+                lease_expires_at = datetime('now', ?),
+                attempt_count = attempt_count + 1,
+                queue_wait_seconds = (julianday('now') - julianday(requested_at)) * 86400.0
+            WHERE request_id = (
+                SELECT request_id FROM llm_requests
+                WHERE status = 'pending' AND (next_attempt_at IS NULL OR next_attempt_at <= datetime('now')) {restriction}
+                ORDER BY {_llm_priority_order_sql()}, {affinity_order} requested_at ASC, request_id ASC
+                LIMIT 1
+            )
+            RETURNING request_id, post_id_to_respond_to, llm_model, llm_persona, request_type, request_params, attempt_count,
+                      use_cache
+        """, (lease_owner, lease_modifier, *restriction_params, *_LLM_PRIORITY_ORDER_PARAMS, *affinity_params))
+        claimed_row = cursor.fetchone()
+        db_connection.commit()
+        return claimed_row
+    except sqlite3.Error:
+        db_connection.rollback()
+        raise
+
+def get_llm_retry_delay(attempt_count: int) -> int:
+    """Seconds to wait before retrying a request that has failed attempt_count times (exponential backoff)."""
+    return min(LLM_RETRY_MAX_DELAY_SECONDS, LLM_RETRY_BASE_DELAY_SECONDS * 2 ** max(0, attempt_count - 1))
+
+def retry_or_fail_llm_request(db_connection, request_id: int, error_message: str, retryable: bool = True) -> bool:
+    """
+    Records a failed attempt on a request that is being processed (rows cancelled meanwhile are left alone).
+    If the failure is retryable and the request has attempts left (LLM_MAX_ATTEMPTS), it goes back
+    to 'pending' with next_attempt_at set by get_llm_retry_delay; otherwise it is marked 'error'.
+    Returns True if the request was requeued.
+    """
+    row = db_connection.execute("SELECT attempt_count FROM llm_requests WHERE request_id = ?", (request_id,)).fetchone()
+    attempt_count = row[0] if row else 0
+    if retryable and attempt_count < LLM_MAX_ATTEMPTS:
+        db_connection.execute("""
+            UPDATE llm_requests
+            SET status = 'pending', last_error = ?, next_attempt_at = datetime('now', ?),
+                lease_owner = NULL, lease_expires_at = NULL, partial_response = NULL
+            WHERE request_id = ? AND status = 'processing'
+        """, (error_message, f"+{get_llm_retry_delay(attempt_count)} seconds", request_id))
+        db_connection.commit()
+        return True
+    if retryable:
+        error_message = f"{error_message} (gave up after {attempt_count} attempts)"
+    db_connection.execute("""
+        UPDATE llm_requests
+        SET status = 'error', error_message = ?, last_error = ?, processed_at = CURRENT_TIMESTAMP
+        WHERE request_id = ? AND status = 'processing'
+    """, (error_message, error_message, request_id))
+    db_connection.commit()
+    return False
+
+def requeue_stuck_llm_requests(db_connection, dead_lease_owners=()) -> tuple[int, int]:
+    """
+    Puts 'processing' rows whose worker is gone back in the queue: rows whose lease expired,
+    rows that never had a lease, and rows held by one of dead_lease_owners.
+    A row that has already used LLM_MAX_ATTEMPTS is marked 'error' instead, so a request that
+    keeps killing its worker can't loop forever.
+    Returns (requeued, failed).
+    """
+    dead_lease_owners = list(dead_lease_owners)
+    orphaned = "status = 'processing' AND (lease_expires_at IS NULL OR lease_expires_at < datetime('now')"
+    if dead_lease_owners:
+        orphaned += f" OR lease_owner IN ({', '.join('?' for _ in dead_lease_owners)})"
+    orphaned += ")"
+    error_message = "Worker stopped while processing this request"
+    try:
+        db_connection.execute("BEGIN IMMEDIATE")
+        requeued = db_connection.execute(f"""
+            UPDATE llm_requests
+            SET status = 'pending', last_error = ?, lease_owner = NULL, lease_expires_at = NULL, next_attempt_at = NULL
+            WHERE {orphaned} AND attempt_count < ?
+        """, (error_message, *dead_lease_owners, LLM_MAX_ATTEMPTS)).rowcount
+        failed = db_connection.execute(f"""
+            UPDATE llm_requests
+            SET status = 'error', error_message = ?, last_error = ?, lease_owner = NULL, lease_expires_at = NULL,
+                processed_at = CURRENT_TIMESTAMP
+            WHERE {orphaned}
+        """, (f"{error_message} (gave up after {LLM_MAX_ATTEMPTS} attempts)", error_message, *dead_lease_owners)).rowcount
+        db_connection.commit()
+        return requeued, failed
+    except sqlite3.Error:
+        db_connection.rollback()
+        raise
+
+def relink_stranded_llm_dependents(db_connection) -> int:
+    """
+    Releases 'pending_dependency' requests whose parent will never release them:
+    - parent complete (but the child was left waiting): the child now answers the parent's reply;
+    - parent failed or gone: the child is re-linked to its grandparent and handled the same way,
+      or, at the top of the chain, answers the post it was originally queued for;
+    - parent cancelled: the child is cancelled too.
+    Returns the number of requests changed.
+    """
+    changed = 0
+    while True:
+        stranded = db_connection.execute("""
+            SELECT child.request_id, parent.request_id, parent.status, parent.parent_request_id,
+                   parent.response_post_id, parent.post_id_to_respond_to, parent.llm_persona
+            FROM llm_requests child
+            LEFT JOIN llm_requests parent ON parent.request_id = child.parent_request_id
+            WHERE child.status = 'pending_dependency'
+              AND (parent.request_id IS NULL OR parent.status IN ('complete', 'error', 'cancelled'))
+        """).fetchall()
+        if not stranded:
             break
-    return posts[::-1]  # Reverse to get chronological order
+        for child_id, parent_id, parent_status, grandparent_id, response_post_id, parent_post_id, parent_persona in stranded:
+            if parent_status == 'complete' and response_post_id is None:
+                # Completed before response_post_id was recorded: find the reply it wrote.
+                reply = db_connection.execute("""
+                    SELECT post_id FROM posts
+                    WHERE parent_post_id = ? AND is_llm_response = 1 AND llm_persona_id IS ?
+                    ORDER BY post_id DESC LIMIT 1
+                """, (parent_post_id, parent_persona)).fetchone()
+                response_post_id = reply[0] if reply else None
+            if parent_status == 'cancelled':
+                db_connection.execute("""
+                    UPDATE llm_requests SET status = 'cancelled', error_message = 'Parent request was cancelled',
+                        processed_at = CURRENT_TIMESTAMP
+                    WHERE request_id = ?
+                """, (child_id,))
+            elif parent_status == 'complete' and response_post_id is not None:
+                db_connection.execute("""
+                    UPDATE llm_requests SET status = 'pending', post_id_to_respond_to = ? WHERE request_id = ?
+                """, (response_post_id, child_id))
+            elif parent_id is not None and grandparent_id is not None:
+                db_connection.execute("UPDATE llm_requests SET parent_request_id = ? WHERE request_id = ?", (grandparent_id, child_id))
+            else:
+                db_connection.execute("""
+                    UPDATE llm_requests SET status = 'pending', parent_request_id = NULL WHERE request_id = ?
+                """, (child_id,))
+            changed += 1
+        db_connection.commit()
+    return changed
+
+def cancel_llm_request(db_connection, request_id: int):
+    """
+    Cancels a request that hasn't finished ('pending', 'pending_dependency' or 'processing'),
+    together with every request chained behind it that is still waiting ('pending_dependency').
+    A worker processing it notices the status change and stops (see llm_queue.abort_running_llm_request).
+    Returns (previous_status, cancelled_request_ids). previous_status is None if the request doesn't
+    exist; cancelled_request_ids is empty if it had already finished.
+    """
+    try:
+        db_connection.execute("BEGIN IMMEDIATE")
+        row = db_connection.execute("SELECT status FROM llm_requests WHERE request_id = ?", (request_id,)).fetchone()
+        if row is None or row[0] not in ('pending', 'pending_dependency', 'processing'):
+            db_connection.rollback()
+            return (row[0] if row else None), []
+        cancelled_ids = [r[0] for r in db_connection.execute("""
+            WITH RECURSIVE chain(request_id) AS (
+                SELECT ?
+                UNION
+                SELECT child.request_id FROM llm_requests child
+                JOIN chain ON child.parent_request_id = chain.request_id
+                WHERE child.status = 'pending_dependency'
+            )
+            SELECT request_id FROM chain
+        """, (request_id,))]
+        db_connection.execute(f"""
+            UPDATE llm_requests
+            SET status = 'cancelled', error_message = 'Cancelled by user', processed_at = CURRENT_TIMESTAMP,
+                lease_owner = NULL, lease_expires_at = NULL, next_attempt_at = NULL
+            WHERE request_id IN ({', '.join('?' for _ in cancelled_ids)})
+        """, cancelled_ids)
+        db_connection.commit()
+        return row[0], cancelled_ids
+    except sqlite3.Error:
+        db_connection.rollback()
+        raise
+
+def get_seconds_until_next_llm_retry(db_connection) -> float | None:
+    """Seconds until the earliest backed-off 'pending' request becomes claimable, or None if there is none."""
+    row = db_connection.execute("""
+        SELECT (julianday(MIN(next_attempt_at)) - julianday('now')) * 86400.0
+        FROM llm_requests WHERE status = 'pending' AND next_attempt_at > datetime('now')
+    """).fetchone()
+    return max(0.0, row[0]) if row and row[0] is not None else None
+
+def bump_llm_request_priority(db_connection, request_id: int, priority: int) -> bool:
+    """
+    Raises a queued request (pending or waiting on its parent) to at least `priority`.
+    Returns False if the request doesn't exist or is no longer queued.
+    """
+    cursor = db_connection.execute("""
+        UPDATE llm_requests SET priority = MAX(priority, ?)
+        WHERE request_id = ? AND status IN ('pending', 'pending_dependency')
+    """, (priority, request_id))
+    db_connection.commit()
+    return cursor.rowcount > 0
 
-# ------------------- BRANCH/THREADING LOGIC -------------------
+def renew_llm_request_lease(db_connection, request_id: int, lease_owner: str, lease_seconds: int) -> bool:
+    """
+    Extends the lease on a request that lease_owner is still processing.
+    Returns False once the row is finished or has been reclaimed by another worker.
+    """
+    cursor = db_connection.execute("""
+        UPDATE llm_requests SET lease_expires_at = datetime('now', ?)
+        WHERE request_id = ? AND lease_owner = ? AND status = 'processing'
+    """, (f"+{int(lease_seconds)} seconds", request_id, lease_owner))
+    db_connection.commit()
+    return cursor.rowcount > 0
 
-def get_sibling_branch_roots(topic_id: int, primary_thread_post_ids: list[int], db_connection) -> list[dict]:
+def is_llm_request_leased_to(db_connection, request_id: int, lease_owner: str) -> bool:
+    """True while lease_owner still holds the request as 'processing' (a cheap read for cancel checks)."""
+    return db_connection.execute("""
+        SELECT 1 FROM llm_requests WHERE request_id = ? AND lease_owner = ? AND status = 'processing'
+    """, (request_id, lease_owner)).fetchone() is not None
+
+def get_models_of_queued_llm_requests(db_connection, limit: int) -> list:
+    """The models with the most 'pending' requests, most requested first (at most limit of them)."""
+    return [row[0] for row in db_connection.execute("""
+        SELECT llm_model FROM llm_requests
+        WHERE status = 'pending' AND llm_model IS NOT NULL
+        GROUP BY llm_model ORDER BY COUNT(*) DESC, MIN(requested_at) ASC
+        LIMIT ?
+    """, (int(limit),))]
+
+def count_queued_llm_requests_for_model(db_connection, model: str) -> int:
+    """Requests for model that are still waiting to run, including chained ones."""
+    return db_connection.execute("""
+        SELECT COUNT(*) FROM llm_requests WHERE llm_model = ? AND status IN ('pending', 'pending_dependency')
+    """, (model,)).fetchone()[0]
+
+def get_pending_llm_prompt_token_maxima(db_connection) -> dict:
     """
-    Fetches all root posts in a topic that are not part of the primary thread.
-    These represent the starting points of sibling discussion branches.
+    model -> largest total_prompt_tokens recorded on any of its 'pending' requests (None if none has been built yet),
+    for every model with pending requests.
     """
-    try:
-        # Create a placeholder string for the IN clause
-        placeholders = ','.join('?' for _ in primary_thread_post_ids)
+    return dict(db_connection.execute("""
+        SELECT llm_model, MAX(json_extract(prompt_token_breakdown, '$.total_prompt_tokens'))
+        FROM llm_requests WHERE status = 'pending'
+        GROUP BY llm_model
+    """).fetchall())
 
-        # Base query to get all root posts in the topic
-        query = f"""
-            SELECT post_id, topic_id, user_id, parent_post_id, content,
-                   created_at, is_llm_response, llm_model_id AS llm_model_name, llm_persona_id
-            FROM posts
-            WHERE topic_id = ? AND parent_post_id IS NULL
-        """
+def record_llm_request_metrics(db_connection, request_id: int, metrics: dict):
+    """
+    Stores performance counters for a request. Keys other than the columns in
+    LLM_REQUEST_OLLAMA_METRIC_COLUMNS / LLM_REQUEST_TIMING_COLUMNS (e.g. the rest of Ollama's final chunk) are ignored.
+    """
+    known_columns = [column for column in LLM_REQUEST_OLLAMA_METRIC_COLUMNS + LLM_REQUEST_TIMING_COLUMNS
+                     if metrics.get(column) is not None]
+    if not known_columns:
+        return
+    assignments = ", ".join(f"{column} = ?" for column in known_columns)
+    db_connection.execute(f"UPDATE llm_requests SET {assignments} WHERE request_id = ?",
+                          [metrics[column] for column in known_columns] + [request_id])
+    db_connection.commit()
+
+def _percentiles(sorted_values, quantiles=(0.5, 0.95, 0.99)):
+    """Nearest-rank percentiles of an already sorted list; None for each quantile if it is empty."""
+    if not sorted_values:
+        return {q: None for q in quantiles}
+    return {q: sorted_values[max(0, min(len(sorted_values) - 1, int(math.ceil(q * len(sorted_values))) - 1))]
+            for q in quantiles}
+
+def get_llm_model_throughput(db_connection, window_hours: int) -> dict:
+    """
+    Per-model averages over requests completed in the last window_hours that reported Ollama counters:
+    decode and prompt-eval tokens/s, average prompt and reply length, load time and total generation time.
+    """
+    throughput = {}
+    for (model, requests, eval_count, eval_duration, prompt_eval_count, prompt_eval_duration,
+         avg_eval_count, avg_prompt_eval_count, avg_load_duration, avg_total_duration) in db_connection.execute("""
+        SELECT llm_model, COUNT(*), SUM(eval_count), SUM(eval_duration), SUM(prompt_eval_count), SUM(prompt_eval_duration),
+               AVG(eval_count), AVG(prompt_eval_count), AVG(COALESCE(load_duration, 0)), AVG(total_duration)
+        FROM llm_requests
+        WHERE status = 'complete' AND processed_at >= datetime('now', ?) AND eval_duration > 0
+        GROUP BY llm_model ORDER BY llm_model
+    """, (f"-{int(window_hours)} hours",)):
+        throughput[model] = {
+            'requests': requests,
+            'eval_tokens_per_second': round(eval_count / (eval_duration / 1e9), 2) if eval_count else None,
+            'prompt_eval_tokens_per_second': round(prompt_eval_count / (prompt_eval_duration / 1e9), 2) if prompt_eval_count and prompt_eval_duration else None,
+            'avg_eval_count': avg_eval_count,
+            'avg_prompt_eval_count': avg_prompt_eval_count,
+            'avg_load_seconds': round(avg_load_duration / 1e9, 3),
+            'avg_total_seconds': round(avg_total_duration / 1e9, 3) if avg_total_duration else None,
+        }
+    return throughput
 
-        params = [topic_id]
+def get_llm_requests_awaiting_processing(db_connection) -> list:
+    """
+    Unfinished requests in the order workers will take them: 'processing' first, then 'pending'
+    in claim order (bumped, priority class with aging, base priority, then age; model affinity is ignored), then
+    'pending_dependency' by age, so a chain's parent always comes before its child.
+    """
+    return db_connection.execute(f"""
+        SELECT request_id, status, llm_model, request_type, processed_at, next_attempt_at, parent_request_id,
+               prompt_token_breakdown
+        FROM llm_requests
+        WHERE status IN ('processing', 'pending', 'pending_dependency')
+        ORDER BY CASE status WHEN 'processing' THEN 0 WHEN 'pending' THEN 1 ELSE 2 END,
+                 {_llm_priority_order_sql("status = 'pending'")},
+                 requested_at ASC, request_id ASC
+    """, _LLM_PRIORITY_ORDER_PARAMS).fetchall()
+
+def get_llm_queue_metrics(db_connection, window_hours: int = 24) -> dict:
+    """
+    Throughput and latency aggregates over requests that finished in the last window_hours, plus the
+    current backlog by status and totals over the rows still stored (deleting requests lowers them).
+    Generation time is Ollama's total_duration, so cache hits and persona jobs don't skew it.
+    """
+    window_modifier = f"-{int(window_hours)} hours"
+    backlog = {status: count for status, count in db_connection.execute(
+        "SELECT status, COUNT(*) FROM llm_requests GROUP BY status")}
+
+    completed_by_hour = dict(db_connection.execute("""
+        SELECT strftime('%Y-%m-%dT%H:00:00Z', processed_at) AS hour, COUNT(*)
+        FROM llm_requests
+        WHERE status = 'complete' AND processed_at >= datetime('now', ?)
+        GROUP BY hour
+    """, (window_modifier,)).fetchall())
+    # Every hour of the window gets a bucket, so idle hours show up as 0 rather than as gaps
+    current_hour = datetime.datetime.now(datetime.timezone.utc).replace(minute=0, second=0, microsecond=0)
+    window_hour_starts = [current_hour - datetime.timedelta(hours=offset) for offset in range(int(window_hours), -1, -1)]
+    completed_per_hour = [{'hour': hour, 'completed': completed_by_hour.get(hour, 0)}
+                          for hour in (start.strftime('%Y-%m-%dT%H:00:00Z') for start in window_hour_starts)]
+
+    finished = {status: count for status, count in db_connection.execute("""
+        SELECT status, COUNT(*) FROM llm_requests
+        WHERE status IN ('complete', 'error') AND processed_at >= datetime('now', ?)
+        GROUP BY status
+    """, (window_modifier,))}
+    finished_total = finished.get('complete', 0) + finished.get('error', 0)
+
+    queue_waits = [row[0] for row in db_connection.execute("""
+        SELECT queue_wait_seconds FROM llm_requests
+        WHERE status = 'complete' AND processed_at >= datetime('now', ?) AND queue_wait_seconds IS NOT NULL
+        ORDER BY queue_wait_seconds
+    """, (window_modifier,))]
+    generation_seconds = [row[0] / 1e9 for row in db_connection.execute("""
+        SELECT total_duration FROM llm_requests
+        WHERE status = 'complete' AND processed_at >= datetime('now', ?) AND total_duration IS NOT NULL
+        ORDER BY total_duration
+    """, (window_modifier,))]
+
+    models = [dict(stats, model=model) for model, stats in get_llm_model_throughput(db_connection, window_hours).items()]
+
+    totals = {status: count for status, count in db_connection.execute("""
+        SELECT status, COUNT(*) FROM llm_requests WHERE status IN ('complete', 'error', 'cancelled') GROUP BY status
+    """)}
+
+    return {
+        'window_hours': int(window_hours),
+        'backlog': backlog,
+        'completed_per_hour': completed_per_hour,
+        'completed': finished.get('complete', 0),
+        'errors': finished.get('error', 0),
+        'error_rate': round(finished.get('error', 0) / finished_total, 4) if finished_total else None,
+        'queue_wait_seconds': {str(q): v for q, v in _percentiles(queue_waits).items()},
+        'generation_seconds': {str(q): v for q, v in _percentiles(generation_seconds).items()},
+        'models': models,
+        'totals': {status: totals.get(status, 0) for status in ('complete', 'error', 'cancelled')},
+    }
 
-        # If there are primary thread posts, filter them out
-        if primary_thread_post_ids:
-            query += f" AND post_id NOT IN ({placeholders})"
-            params.extend(primary_thread_post_ids)
+# ------------------- POST ANCESTOR LOGIC -------------------
 
-        cursor = db_connection.execute(query, tuple(params))
-        sibling_roots = [dict(row) for row in cursor.fetchall()]
-        return sibling_roots
-    except sqlite3.Error as e:
-        # Log the error or handle it as appropriate for the application
-        # For now, print it and return an empty list
-        print(f"Database error in get_sibling_branch_roots: {e}")
-        # Consider logging this error with current_app.logger if in Flask context
-        # current_app.logger.error(f"Database error in get_sibling_branch_roots: {e}")
+# posts.thread_path is the post_ids from the root down to the post, each zero-padded to 10 digits and followed
+# by '/'. A post's ancestors are the prefixes of its path, its subtree shares its path as a prefix, and sorting
+# a topic by path lists every thread depth-first in posting order.
+_POST_PATH_SEGMENT_SQL = "printf('%010d/', post_id)"
+
+def set_post_thread_path(db_connection, post_id):
+    """
+    Sets a newly inserted post's thread_path and branch_root_id from its parent's.
+    Call in the same transaction as the insert.
+    """
+    db_connection.execute(f"""
+        UPDATE posts SET thread_path = COALESCE(
+            (SELECT parent.thread_path FROM posts parent WHERE parent.post_id = posts.parent_post_id), ''
+        ) || {_POST_PATH_SEGMENT_SQL},
+        branch_root_id = COALESCE(
+            (SELECT parent.branch_root_id FROM posts parent WHERE parent.post_id = posts.parent_post_id), post_id
+        )
+        WHERE post_id = ?
+    """, (post_id,))
+
+def get_post_ancestors(post_id, db_connection):
+    """
+    Fetches a post and all its ancestors up to the topic root.
+    Returns the posts in chronological order (oldest first).
+    """
+    # The post's thread_path lists its ancestors' ids root first, so they are fetched by primary key
+    row = db_connection.execute("SELECT thread_path FROM posts WHERE post_id = ?", (post_id,)).fetchone()
+    if not row or not row[0]:
         return []
+    ancestor_ids = [int(segment) for segment in row[0].split('/') if segment]
+    placeholders = ','.join('?' for _ in ancestor_ids)
+    cursor = db_connection.execute(
+        f"""
+        SELECT a.post_id, a.topic_id, a.user_id, a.parent_post_id, a.content,
+               a.created_at, a.is_llm_response, a.llm_model_id AS llm_model_name, a.llm_persona_id,
+               a.content_tokens, a.history_line_tokens, per.name AS persona_name
+        FROM posts a
+        LEFT JOIN personas per ON per.persona_id = CAST(a.llm_persona_id AS INTEGER)
+        WHERE a.post_id IN ({placeholders})
+        ORDER BY a.thread_path
+        """,
+        tuple(ancestor_ids),
+    )
+    return [dict(row) for row in cursor.fetchall()]
 
-def get_recent_posts_from_branch(branch_root_id: int, db_connection, max_posts: int = 2) -> list[dict]:
+# ------------------- BRANCH/THREADING LOGIC -------------------
+
+def get_recent_posts_from_sibling_branches(topic_id: int, primary_thread_post_ids: list[int], db_connection,
+                                           max_posts_per_branch: int = 2, max_total_posts: int = 5) -> list[dict]:
     """
-    Fetches the most recent posts from a specific discussion branch.
-    A branch is defined by the branch_root_id and all its descendant posts.
+    The most recent posts across a topic's branches other than the primary thread's: at most max_posts_per_branch
+    from each, max_total_posts overall, oldest first, with persona names joined in.
+    A sibling branch is a root post of the topic (not in the primary thread) with all its replies.
     """
     try:
-        # This query uses a Recursive Common Table Expression (CTE) to find all descendants
-        # of the branch_root_id, then selects the most recent 'max_posts' from that set.
-        query = """
-            WITH RECURSIVE branch_posts AS (
-                -- Anchor member: the root post of the branch
-                SELECT post_id, topic_id, user_id, parent_post_id, content,
-                       created_at, is_llm_response, llm_model_id, llm_persona_id, 0 as depth
-                FROM posts
-                WHERE post_id = :branch_root_id
-
-                UNION ALL
-
-                -- Recursive member: posts that are children of posts already in branch_posts
-                SELECT p.post_id, p.topic_id, p.user_id, p.parent_post_id, p.content,
-                       p.created_at, p.is_llm_response, p.llm_model_id, p.llm_persona_id, bp.depth + 1
+        placeholders = ','.join('?' for _ in primary_thread_post_ids)
+        exclusion = f"AND p.branch_root_id NOT IN ({placeholders})" if primary_thread_post_ids else ""
+        query = f"""
+            SELECT post_id, topic_id, user_id, parent_post_id, content, created_at,
+                   is_llm_response, llm_model_name, llm_persona_id, persona_name
+            FROM (
+                SELECT p.post_id, p.topic_id, p.user_id, p.parent_post_id, p.content, p.created_at,
+                       p.is_llm_response, p.llm_model_id AS llm_model_name, p.llm_persona_id,
+                       per.name AS persona_name,
+                       ROW_NUMBER() OVER (
+                           PARTITION BY p.branch_root_id ORDER BY p.created_at DESC, p.post_id DESC
+                       ) AS branch_rank
                 FROM posts p
-                JOIN branch_posts bp ON p.parent_post_id = bp.post_id
+                JOIN posts root ON root.post_id = p.branch_root_id AND root.parent_post_id IS NULL
+                LEFT JOIN personas per ON per.persona_id = CAST(p.llm_persona_id AS INTEGER)
+                WHERE p.topic_id = ? {exclusion}
             )
-            -- Select the required fields and rename llm_model_id for consistency
-            SELECT post_id, topic_id, user_id, parent_post_id, content,
-                   created_at, is_llm_response, llm_model_id AS llm_model_name, llm_persona_id
-            FROM branch_posts
-            ORDER BY created_at DESC -- Get the most recent first
-            LIMIT :max_posts;
+            WHERE branch_rank <= ?
+            ORDER BY created_at DESC, post_id DESC
+            LIMIT ?
         """
-
-        cursor = db_connection.execute(query, {"branch_root_id": branch_root_id, "max_posts": max_posts})
-        # Fetchall will give them in descending order of created_at (most recent first)
-        recent_posts_desc = [dict(row) for row in cursor.fetchall()]
-        # Reverse to get chronological order (oldest first) as per function spec
-        return recent_posts_desc[::-1]
-
+        params = [topic_id, *primary_thread_post_ids, max_posts_per_branch, max_total_posts]
+        recent_posts_desc = [dict(row) for row in db_connection.execute(query, tuple(params)).fetchall()]
+        return recent_posts_desc[::-1] # Chronological order (oldest first)
     except sqlite3.Error as e:
-        print(f"Database error in get_recent_posts_from_branch: {e}")
-        # current_app.logger.error(f"Database error in get_recent_posts_from_branch: {e}")
+        print(f"Database error in get_recent_posts_from_sibling_branches: {e}")
         return []
 
 # ------------------- USER ACTIVITY LOGIC -------------------
@@ -1375,6 +2105,8 @@ def update_persona(persona_id, name, prompt_instructions, updated_by_user):
             INSERT INTO persona_versions (persona_id, name, prompt_instructions, updated_by_user, version)
             VALUES (?, ?, ?, ?, ?)
         ''', (persona_id, name, prompt_instructions, updated_by_user, new_version))
+        # Stored history-line counts include the persona name; let them be recounted
+        cursor.execute('UPDATE posts SET history_line_tokens = NULL WHERE llm_persona_id = ?', (persona_id,))
         db.commit()
         return True
     except sqlite3.Error as e:
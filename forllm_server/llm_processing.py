@@ -1,20 +1,29 @@
 import requests
 import json
+import threading
 import time
 import sqlite3
 import os
+import bisect
 from flask import current_app
 from requests.exceptions import ConnectionError, RequestException
 from datetime import datetime
 import logging
-from forllm_server.tokenizer_utils import count_tokens
+from forllm_server.tokenizer_utils import count_tokens, count_tokens_batch, is_tokenizer_available
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
-from .config import DATABASE, OLLAMA_GENERATE_URL, DEFAULT_MODEL, CURRENT_USER_ID, UPLOAD_FOLDER
-from .database import get_persona, get_post_ancestors, get_sibling_branch_roots, get_recent_posts_from_branch
+from .config import (DATABASE, OLLAMA_PROMPT_MODE, DEFAULT_MODEL, CURRENT_USER_ID,
+                     UPLOAD_FOLDER, LLM_STREAM_PERSIST_SECONDS, LLM_RESPONSE_CACHE_ENABLED,
+                     LLM_RESPONSE_CACHE_COALESCE_WAIT_SECONDS)
+from .database import (get_persona, get_post_ancestors, get_recent_posts_from_sibling_branches,
+                       retry_or_fail_llm_request, make_llm_response_cache_key, get_cached_llm_response, store_llm_response,
+                       register_llm_request_prompt, defer_llm_request_for_prompt,
+                       release_llm_requests_waiting_for_prompt, record_llm_request_metrics, set_post_thread_path)
 from .ollama_utils import get_model_context_window
+from .llm_streams import start_llm_stream, append_llm_stream, finish_llm_stream
+from .ollama_client import ollama_stream, is_transient_ollama_error
 
 # Default constants for branch-aware history (used as fallbacks)
 DEFAULT_MAX_POSTS_PER_SIBLING_BRANCH = 2
@@ -89,43 +98,129 @@ def get_chat_history_settings(db_conn: sqlite3.Connection) -> dict:
     return settings
 
 
+def _history_persona_name(post: dict, db_connection) -> str:
+    """Name shown for an LLM post in chat history; uses persona_name if the query already joined it in."""
+    persona_name = "Unknown Persona" # Default if no persona
+    llm_persona_id = post.get('llm_persona_id')
+    if 'persona_name' in post:
+        if llm_persona_id and post['persona_name']:
+            persona_name = post['persona_name']
+    elif llm_persona_id:
+        cursor = db_connection.cursor()
+        cursor.execute("SELECT name FROM personas WHERE persona_id = ?", (llm_persona_id,))
+        persona_row = cursor.fetchone()
+        if persona_row and persona_row['name']:
+            persona_name = persona_row['name']
+    return persona_name
+
+
+def _format_history_line(post: dict, db_connection) -> str:
+    """Formats one post as it appears in the primary chat history."""
+    if post.get('is_llm_response'):
+        model_name = post.get('llm_model_name', post.get('llm_model_id', 'LLM'))
+        return f"LLM ({_history_persona_name(post, db_connection)}/{model_name}): {post.get('content', '')}"
+    return f"User: {post.get('content', '')}"
+
+
 def format_linear_history(posts: list, db_connection) -> str:
     """
     Formats a list of posts (e.g., from get_post_ancestors) into a linear string representation.
     """
-    history_str_parts = []
-    for post in posts:
-        if post.get('is_llm_response'):
-            persona_name = "Unknown Persona" # Default if no persona
-            llm_persona_id = post.get('llm_persona_id')
-            if llm_persona_id:
-                cursor = db_connection.cursor()
-                cursor.execute("SELECT name FROM personas WHERE persona_id = ?", (llm_persona_id,))
-                persona_row = cursor.fetchone()
-                if persona_row and persona_row['name']:
-                    persona_name = persona_row['name']
-            model_name = post.get('llm_model_name', post.get('llm_model_id', 'LLM'))
-            history_str_parts.append(f"LLM ({persona_name}/{model_name}): {post.get('content', '')}")
-        else:
-            history_str_parts.append(f"User: {post.get('content', '')}")
+    return "\n".join(_format_history_line(post, db_connection) for post in posts)
 
-    return "\n".join(history_str_parts)
 
+def update_post_token_counts(db_conn: sqlite3.Connection, post_ids: list) -> int:
+    """
+    Stores content_tokens and history_line_tokens for the given posts; the caller commits.
+    history_line_tokens counts the post's history line plus its trailing newline. Every line starts with
+    "User" or "LLM", so no token spans that newline and a thread's history tokens are the sum over its posts.
+    Leaves the columns NULL if the tokenizer is unavailable. Returns the number of posts counted.
+    """
+    if not post_ids or not is_tokenizer_available():
+        return 0
+    placeholders = ','.join('?' for _ in post_ids)
+    cursor = db_conn.cursor()
+    cursor.execute(f"""
+        SELECT p.post_id, p.content, p.is_llm_response, p.llm_model_id AS llm_model_name, p.llm_persona_id,
+               per.name AS persona_name
+        FROM posts p
+        LEFT JOIN personas per ON per.persona_id = CAST(p.llm_persona_id AS INTEGER)
+        WHERE p.post_id IN ({placeholders})
+    """, tuple(post_ids))
+    posts = [dict(row) for row in cursor.fetchall()]
+    texts = []
+    for post in posts:
+        texts.extend((post['content'], _format_history_line(post, db_conn) + "\n"))
+    token_counts = count_tokens_batch(texts)
+    counts = [(token_counts[2 * i], token_counts[2 * i + 1], post['post_id']) for i, post in enumerate(posts)]
+    cursor.executemany("UPDATE posts SET content_tokens = ?, history_line_tokens = ? WHERE post_id = ?", counts)
+    return len(counts)
+
+
+def backfill_post_token_counts(db_conn: sqlite3.Connection, batch_size: int = 500) -> int:
+    """Counts every post still missing stored token counts, committing per batch. Returns the number counted."""
+    if not is_tokenizer_available():
+        print("Tokenizer unavailable; cannot backfill post token counts.")
+        return 0
+    total = 0
+    last_post_id = 0
+    while True:
+        cursor = db_conn.cursor()
+        cursor.execute("""
+            SELECT post_id FROM posts
+            WHERE post_id > ? AND (content_tokens IS NULL OR history_line_tokens IS NULL)
+            ORDER BY post_id LIMIT ?
+        """, (last_post_id, batch_size))
+        post_ids = [row['post_id'] for row in cursor.fetchall()]
+        if not post_ids:
+            break
+        total += update_post_token_counts(db_conn, post_ids)
+        db_conn.commit()
+        last_post_id = post_ids[-1]
+        print(f"Counted tokens for {total} posts so far...")
+    return total
+
+
+def _fill_history_line_tokens(posts: list, post_ids: list, db_conn: sqlite3.Connection):
+    """Counts and stores the token counts of post_ids (posts written before counting, or edited since), then copies them into posts."""
+    try:
+        if not update_post_token_counts(db_conn, post_ids):
+            return
+        db_conn.commit()
+        placeholders = ','.join('?' for _ in post_ids)
+        stored = dict(db_conn.execute(
+            f"SELECT post_id, history_line_tokens FROM posts WHERE post_id IN ({placeholders})", tuple(post_ids)
+        ).fetchall())
+    except sqlite3.Error as e:
+        db_conn.rollback()
+        logger.warning(f"Could not store token counts for posts {post_ids}: {e}")
+        return
+    for post in posts:
+        if post['post_id'] in stored:
+            post['history_line_tokens'] = stored[post['post_id']]
 
 def _get_raw_history_strings(post_id_to_respond_to: int, db_conn: sqlite3.Connection, current_post_topic_id: int = None):
     """
     Fetches and formats raw primary and ambient history content, without headers.
+    Also returns the primary history's entries as (line_count, history_line_tokens) per post for pruning.
+    Posts without a stored count are counted and saved here; entries is None only if that isn't possible.
     """
     raw_primary_history_content = ""
     raw_ambient_history_content = ""
+    primary_history_entries = None
     primary_thread_post_ids_for_ambient_exclusion = []
 
     if not post_id_to_respond_to:
-        return "", ""
+        return "", "", None
 
     ancestors = get_post_ancestors(post_id_to_respond_to, db_conn)
     if ancestors:
         raw_primary_history_content = format_linear_history(ancestors, db_conn)
+        missing_ids = [p['post_id'] for p in ancestors if p.get('history_line_tokens') is None]
+        if missing_ids:
+            _fill_history_line_tokens(ancestors, missing_ids, db_conn)
+        if all(p.get('history_line_tokens') is not None for p in ancestors):
+            primary_history_entries = [(p['content'].count('\n') + 1, p['history_line_tokens']) for p in ancestors]
         primary_thread_post_ids_for_ambient_exclusion = [p['post_id'] for p in ancestors]
         primary_thread_post_ids_for_ambient_exclusion.append(post_id_to_respond_to)
 
@@ -138,24 +233,18 @@ def _get_raw_history_strings(post_id_to_respond_to: int, db_conn: sqlite3.Connec
             topic_id_for_ambient = topic_info['topic_id']
         else:
             logger.error(f"Could not fetch topic_id for post {post_id_to_respond_to} for ambient history.")
-            return raw_primary_history_content, ""
+            return raw_primary_history_content, "", primary_history_entries
 
     if topic_id_for_ambient:
         ch_settings = get_chat_history_settings(db_conn)
         max_posts_per_sibling = ch_settings['max_posts_per_sibling_branch']
         max_total_ambient = ch_settings['max_total_ambient_posts']
 
-        sibling_branch_roots = get_sibling_branch_roots(topic_id_for_ambient, primary_thread_post_ids_for_ambient_exclusion, db_conn)
-
-        all_candidate_ambient_posts = []
         if max_total_ambient > 0 and max_posts_per_sibling > 0:
-            for root in sibling_branch_roots:
-                recent_from_branch = get_recent_posts_from_branch(root['post_id'], db_conn, max_posts=max_posts_per_sibling)
-                all_candidate_ambient_posts.extend(recent_from_branch)
-
-            all_candidate_ambient_posts.sort(key=lambda x: x['created_at'], reverse=True)
-            selected_ambient_posts = all_candidate_ambient_posts[:max_total_ambient]
-            selected_ambient_posts.reverse()
+            selected_ambient_posts = get_recent_posts_from_sibling_branches(
+                topic_id_for_ambient, primary_thread_post_ids_for_ambient_exclusion, db_conn,
+                max_posts_per_branch=max_posts_per_sibling, max_total_posts=max_total_ambient
+            )
         else:
             selected_ambient_posts = []
 
@@ -165,17 +254,14 @@ def _get_raw_history_strings(post_id_to_respond_to: int, db_conn: sqlite3.Connec
                 author_prefix = "User"
                 if post.get('is_llm_response'):
                     persona_name = "LLMAssistant"
-                    if post.get('llm_persona_id'):
-                        p_cursor = db_conn.cursor()
-                        p_cursor.execute("SELECT name FROM personas WHERE persona_id = ?", (post['llm_persona_id'],))
-                        p_row = p_cursor.fetchone()
-                        if p_row: persona_name = p_row['name']
+                    if post.get('llm_persona_id') and post.get('persona_name'):
+                        persona_name = post['persona_name']
                     model_name = post.get('llm_model_name', post.get('llm_model_id', 'LLM'))
                     author_prefix = f"LLM ({persona_name}/{model_name})"
                 ambient_history_parts.append(f"[From other thread by {author_prefix}]: {post.get('content', '')}")
             raw_ambient_history_content = "\n".join(ambient_history_parts)
 
-    return raw_primary_history_content, raw_ambient_history_content
+    return raw_primary_history_content, raw_ambient_history_content, primary_history_entries
 
 
 def _prune_history_sections(
@@ -185,46 +271,50 @@ def _prune_history_sections(
     primary_history_budget_ratio: float,
     primary_header_template: str,
     ambient_header_template: str,
-    request_id_for_logging: str
+    request_id_for_logging: str,
+    primary_history_entries: list = None
 ) -> dict:
     """
     Prunes primary and ambient history content to fit within token budgets.
+    primary_history_entries are the per-post stored counts from _get_raw_history_strings, if available.
     """
     actual_primary_header_tokens = count_tokens(primary_header_template) if raw_primary_content else 0
     actual_ambient_header_tokens = count_tokens(ambient_header_template) if raw_ambient_content else 0
 
     primary_content_budget = int(available_tokens_for_history * primary_history_budget_ratio) - actual_primary_header_tokens
     primary_content_budget = max(0, primary_content_budget)
-    pruned_primary_content_str = _prune_history_string(raw_primary_content, primary_content_budget, "[PrimaryPrune]", request_id_for_logging)
+    pruned_primary_content_str, pruned_primary_content_tokens = _prune_history_lines(raw_primary_content, primary_content_budget, "[PrimaryPrune]", request_id_for_logging, primary_history_entries)
 
     final_primary_history_tokens_inc_header = 0
     formatted_primary_history_string_with_header = ""
     if pruned_primary_content_str:
         formatted_primary_history_string_with_header = f"{primary_header_template}{pruned_primary_content_str}"
-        final_primary_history_tokens_inc_header = count_tokens(formatted_primary_history_string_with_header)
+        final_primary_history_tokens_inc_header = _count_with_header(primary_header_template, actual_primary_header_tokens, pruned_primary_content_str, pruned_primary_content_tokens)
     else:
         actual_primary_header_tokens = 0
 
-    logger.info(f"Request {request_id_for_logging}: Primary content budget: {primary_content_budget}. Pruned primary content tokens (excl header): {count_tokens(pruned_primary_content_str)}. With header: {final_primary_history_tokens_inc_header}")
+    logger.info(f"Request {request_id_for_logging}: Primary content budget: {primary_content_budget}. Pruned primary content tokens (excl header): {pruned_primary_content_tokens}. With header: {final_primary_history_tokens_inc_header}")
 
     tokens_used_by_primary_section_final = final_primary_history_tokens_inc_header
     ambient_content_budget = available_tokens_for_history - tokens_used_by_primary_section_final - actual_ambient_header_tokens
     ambient_content_budget = max(0, ambient_content_budget)
-    pruned_ambient_content_str = _prune_history_string(raw_ambient_content, ambient_content_budget, "[AmbientPrune]", request_id_for_logging)
+    pruned_ambient_content_str, pruned_ambient_content_tokens = _prune_history_lines(raw_ambient_content, ambient_content_budget, "[AmbientPrune]", request_id_for_logging)
 
     final_ambient_history_tokens_inc_header = 0
     formatted_ambient_history_string_with_header = ""
     if pruned_ambient_content_str:
         formatted_ambient_history_string_with_header = f"{ambient_header_template}{pruned_ambient_content_str}"
-        final_ambient_history_tokens_inc_header = count_tokens(formatted_ambient_history_string_with_header)
+        final_ambient_history_tokens_inc_header = _count_with_header(ambient_header_template, actual_ambient_header_tokens, pruned_ambient_content_str, pruned_ambient_content_tokens)
     else:
         actual_ambient_header_tokens = 0
 
-    logger.info(f"Request {request_id_for_logging}: Ambient content budget: {ambient_content_budget}. Pruned ambient content tokens (excl header): {count_tokens(pruned_ambient_content_str)}. With header: {final_ambient_history_tokens_inc_header}")
+    logger.info(f"Request {request_id_for_logging}: Ambient content budget: {ambient_content_budget}. Pruned ambient content tokens (excl header): {pruned_ambient_content_tokens}. With header: {final_ambient_history_tokens_inc_header}")
 
     return {
         "pruned_primary_content_str": pruned_primary_content_str,
         "pruned_ambient_content_str": pruned_ambient_content_str,
+        "pruned_primary_content_tokens": pruned_primary_content_tokens,
+        "pruned_ambient_content_tokens": pruned_ambient_content_tokens,
         "final_primary_history_tokens": final_primary_history_tokens_inc_header,
         "final_ambient_history_tokens": final_ambient_history_tokens_inc_header,
         "primary_header_tokens": actual_primary_header_tokens,
@@ -234,33 +324,160 @@ def _prune_history_sections(
     }
 
 
-def _prune_history_string(history_string: str, max_tokens: int, logger_prefix: str, request_id: int) -> str:
-    """Prunes a history string to fit within a token budget by removing oldest entries."""
-    history_content_stripped = history_string.strip()
-    if not history_content_stripped or count_tokens(history_content_stripped) <= max_tokens:
-        return history_content_stripped
+def _count_with_header(header: str, header_tokens: int, content: str, content_tokens: int) -> int:
+    """Tokens of header + content; no token spans a header's closing newline into non-whitespace, so those add."""
+    if header.endswith("\n") and content and not content[0].isspace():
+        return header_tokens + content_tokens
+    return count_tokens(f"{header}{content}")
+
+
+def _history_entry_starts(lines: list, entries: list):
+    """Line index where each history entry starts, or None if the entries don't describe these lines."""
+    starts = []
+    index = 0
+    for line_count, _ in entries:
+        starts.append(index)
+        index += line_count
+    # Stripping the history can only drop trailing blank lines from the last entry
+    if not starts or starts[-1] >= len(lines) or index < len(lines):
+        return None
+    return starts
+
+
+def _find_history_cut(lines: list, max_tokens: int, entries: list = None) -> tuple:
+    """
+    Finds how many leading lines to drop so the rest, rejoined with newlines, fits in max_tokens.
+    Returns (lines_to_drop, tokens_of_the_rest, tokens_of_all_lines); drops everything if nothing fits.
+
+    entries, if given, is (line_count, tokens) per post as stored in posts.history_line_tokens. Suffixes starting
+    at a post are then sums of stored counts, and any other suffix only tokenizes the text up to the next post.
+    Without them, each line is tokenized once and the per-line counts are summed from the newest line back to
+    place the cut. Tokens can merge across a newline, so that estimate is only trusted once the tokenizer
+    confirms it on the joined text; if it was off, a binary search over the cut settles it. Dropping lines never
+    adds tokens, so this is the same cut as dropping one line at a time, for O(log lines) counts instead of O(lines).
+    """
+    exact_counts = {len(lines): 0}
+    anchors = [len(lines)] # Suffixes known to tokenize independently of what precedes them
+    starts = _history_entry_starts(lines, entries) if entries else None
+    if starts:
+        newest_start = starts[-1]
+        exact_counts[newest_start] = count_tokens("\n".join(lines[newest_start:]))
+        for index in range(len(starts) - 2, -1, -1):
+            exact_counts[starts[index]] = exact_counts[starts[index + 1]] + entries[index][1]
+        anchors = starts + anchors
+
+    def tokens_from(start):
+        if start not in exact_counts:
+            anchor = anchors[bisect.bisect_right(anchors, start)]
+            text = "\n".join(lines[start:anchor])
+            if anchor < len(lines):
+                exact_counts[start] = count_tokens(text + "\n") + exact_counts[anchor]
+            else:
+                exact_counts[start] = count_tokens(text)
+        return exact_counts[start]
+
+    total_tokens = tokens_from(0)
+    if total_tokens <= max_tokens:
+        return 0, total_tokens, total_tokens
+    if max_tokens < 0:
+        return len(lines), 0, total_tokens
+
+    if starts:
+        # Drop whole posts first; the cut is then inside the newest post that doesn't fit
+        fitting = next(i for i, anchor in enumerate(anchors) if tokens_from(anchor) <= max_tokens)
+        low, high = anchors[fitting - 1] + 1, anchors[fitting]
+    else:
+        candidate = len(lines)
+        estimated = -1 # The newest line has no newline after it
+        for index in range(len(lines) - 1, -1, -1):
+            estimated += count_tokens(lines[index]) + 1
+            if estimated > max_tokens:
+                break
+            candidate = index
+
+        if tokens_from(candidate) <= max_tokens:
+            if candidate == 0 or tokens_from(candidate - 1) > max_tokens:
+                return candidate, tokens_from(candidate), total_tokens
+            low, high = 0, candidate - 1
+        else:
+            low, high = candidate + 1, len(lines)
 
-    logger.info(f"{logger_prefix} Request {request_id}: History ({count_tokens(history_content_stripped)} tokens) exceeds budget ({max_tokens}). Pruning.")
+    while low < high: # Smallest cut in [low, high] that fits; high always fits
+        middle = (low + high) // 2
+        if tokens_from(middle) <= max_tokens:
+            high = middle
+        else:
+            low = middle + 1
+    return low, tokens_from(low), total_tokens
+
+
+def _prune_history_lines(history_string: str, max_tokens: int, logger_prefix: str, request_id: int, entries: list = None) -> tuple:
+    """Like _prune_history_string, but also returns the token count of the pruned history."""
+    history_content_stripped = history_string.strip()
+    if not history_content_stripped:
+        return history_content_stripped, 0
     lines = history_content_stripped.split('\n')
-    current_content = history_content_stripped
-    while count_tokens(current_content) > max_tokens and lines:
-        lines.pop(0)
-        current_content = "\n".join(lines)
+    lines_to_drop, final_tokens, total_tokens = _find_history_cut(lines, max_tokens, entries)
+    if lines_to_drop == 0:
+        return history_content_stripped, total_tokens
 
-    final_tokens = count_tokens(current_content)
-    if final_tokens > max_tokens:
-        logger.warning(f"{logger_prefix} Request {request_id}: After removing lines, content ({final_tokens} tokens) might still be over budget ({max_tokens}), or became empty. Returning best effort.")
-        if not lines:
-             return ""
+    logger.info(f"{logger_prefix} Request {request_id}: History ({total_tokens} tokens) exceeds budget ({max_tokens}). Pruning.")
+    current_content = "\n".join(lines[lines_to_drop:])
 
     logger.info(f"{logger_prefix} Request {request_id}: After pruning, history token count: {final_tokens}. Budget: {max_tokens}.")
-    return current_content
+    return current_content, final_tokens
 
 
+def _prune_history_string(history_string: str, max_tokens: int, logger_prefix: str, request_id: int) -> str:
+    """Prunes a history string to fit within a token budget by removing oldest entries."""
+    return _prune_history_lines(history_string, max_tokens, logger_prefix, request_id)[0]
+
+
+def _save_llm_reply(db, request_id, post_id, content, model, persona_id, cache_status):
+    """
+    Writes the reply post, marks the request complete and releases requests chained behind it, in one transaction.
+    Returns the new post_id, or None if the request was cancelled meanwhile (nothing is written then).
+    """
+    cursor = db.cursor()
+    cursor.execute("""
+        INSERT INTO posts (topic_id, user_id, parent_post_id, content, is_llm_response, llm_model_id, llm_persona_id)
+        SELECT topic_id, ?, ?, ?, TRUE, ?, ?
+        FROM posts WHERE post_id = ?
+    """, (CURRENT_USER_ID, post_id, content, model, persona_id, post_id))
+    new_post_id = cursor.lastrowid
+    set_post_thread_path(db, new_post_id)
+    update_post_token_counts(db, [new_post_id])
+
+    cursor.execute("UPDATE llm_requests SET status = 'complete', processed_at = CURRENT_TIMESTAMP, partial_response = NULL, response_post_id = ?, cache_status = ? WHERE request_id = ? AND status = 'processing'", (new_post_id, cache_status, request_id))
+    if cursor.rowcount == 0: # Cancelled just as the reply was ready; drop it
+        db.rollback()
+        return None
+
+    cursor.execute("""
+        UPDATE llm_requests
+        SET status = 'pending', post_id_to_respond_to = ?
+        WHERE parent_request_id = ? AND status = 'pending_dependency'
+    """, (new_post_id, request_id))
+
+    if cursor.rowcount > 0:
+        print(f"Request {request_id}: Activated {cursor.rowcount} dependent request(s).")
+
+    db.commit()
+    return new_post_id
+
 def process_llm_request(request_details, flask_app):
-    """Handles the actual LLM interaction for a given request."""
+    """
+    Handles the actual LLM interaction for a given request.
+    request_details may carry a 'cancel_event'; once it is set (the row was cancelled) the
+    generation is abandoned and nothing is written. 'use_cache': False skips the response cache,
+    'keep_alive' (seconds) is passed on to Ollama.
+    """
     request_id = request_details['request_id']
     post_id = request_details['post_id']
+    cancel_event = request_details.get('cancel_event') or threading.Event()
+    build_started = time.time()
+    cache_key = None
+    generated_cache_key = None # Set once this request generates its prompt; requests coalesced onto it are released at the end
     
     db = sqlite3.connect(DATABASE)
     db.row_factory = sqlite3.Row 
@@ -335,7 +552,7 @@ def process_llm_request(request_details, flask_app):
             else:
                 print(f"No valid persona_id provided or parsed for request {request_id}. Using default instructions.")
 
-        cursor.execute("SELECT content, tagged_files_in_content FROM posts WHERE post_id = ?", (post_id,))
+        cursor.execute("SELECT content, content_tokens, tagged_files_in_content FROM posts WHERE post_id = ?", (post_id,))
         original_post = cursor.fetchone()
         if not original_post:
             error_message = f"Original post {post_id} not found for request {request_id}."
@@ -399,25 +616,32 @@ def process_llm_request(request_details, flask_app):
             else:
                 logger.error(f"Request {request_id}: Could not fetch topic_id for current post {post_id} for history construction.")
 
-        raw_primary_content, raw_ambient_content = _get_raw_history_strings(post_id, db, topic_id_for_history)
-        logger.info(f"Request {request_id}: Raw primary history ({count_tokens(raw_primary_content)} tokens), Raw ambient history ({count_tokens(raw_ambient_content)} tokens)")
+        raw_primary_content, raw_ambient_content, primary_history_entries = _get_raw_history_strings(post_id, db, topic_id_for_history)
+        logger.info(f"Request {request_id}: Raw primary history ({len(raw_primary_content)} chars), Raw ambient history ({len(raw_ambient_content)} chars)")
 
         safety_margin_percentage = 0.95
         max_allowed_tokens = int(effective_context_window * safety_margin_percentage)
-        persona_prompt_tokens = count_tokens(persona_instructions)
-        user_post_tokens = count_tokens(original_post['content'])
-        attachments_token_count = count_tokens(attachments_string.strip())
-        tagged_files_token_count = count_tokens(tagged_files_string.strip())
         user_post_content_for_count = original_post['content']
-        final_instruction_tokens = count_tokens(FINAL_INSTRUCTION)
-
-        fixed_elements_tokens = count_tokens(
-           f"{attachments_string}"
-           f"{tagged_files_string}"
-           f"{persona_instructions}\n\n"
-           f"User wrote: {user_post_content_for_count}\n\n"
-           f"{FINAL_INSTRUCTION}"
-        )
+        (persona_prompt_tokens,
+         user_post_tokens,
+         attachments_token_count,
+         tagged_files_token_count,
+         final_instruction_tokens,
+         fixed_elements_tokens) = count_tokens_batch([
+            persona_instructions,
+            # Stored on write, so only counted here for posts from before that
+            original_post['content'] if original_post['content_tokens'] is None else "",
+            attachments_string.strip(),
+            tagged_files_string.strip(),
+            FINAL_INSTRUCTION,
+            f"{attachments_string}"
+            f"{tagged_files_string}"
+            f"{persona_instructions}\n\n"
+            f"User wrote: {user_post_content_for_count}\n\n"
+            f"{FINAL_INSTRUCTION}"
+        ])
+        if original_post['content_tokens'] is not None:
+            user_post_tokens = original_post['content_tokens']
         logger.info(f"Request {request_id}: Fixed elements token count: {fixed_elements_tokens}")
 
         available_tokens_for_history_sections = max_allowed_tokens - fixed_elements_tokens
@@ -434,27 +658,58 @@ def process_llm_request(request_details, flask_app):
             primary_history_budget_ratio=current_primary_history_budget_ratio,
             primary_header_template=f"{PRIMARY_HISTORY_HEADER}\n\n",
             ambient_header_template=f"{AMBIENT_HISTORY_HEADER}\n\n",
-            request_id_for_logging=str(request_id)
+            request_id_for_logging=str(request_id),
+            primary_history_entries=primary_history_entries
         )
 
         formatted_primary_history_string_final = pruning_results["formatted_primary_history_string_with_header"]
         formatted_ambient_history_string_final = pruning_results["formatted_ambient_history_string_with_header"]
 
-        prompt_parts = []
-        if attachments_string: prompt_parts.append(attachments_string)
-        if tagged_files_string: prompt_parts.append(tagged_files_string)
-        prompt_parts.append(f"{persona_instructions}\n\n")
-        if formatted_ambient_history_string_final:
-            prompt_parts.append(formatted_ambient_history_string_final)
-            if not formatted_ambient_history_string_final.endswith("\n\n"):
-                prompt_parts.append("\n\n" if not formatted_ambient_history_string_final.endswith("\n") else "\n")
+        # Primary thread first, then the ambient block, directly before the current post's attachments
+        # and FINAL_INSTRUCTION.
+        history_parts = []
         if formatted_primary_history_string_final:
-            prompt_parts.append(formatted_primary_history_string_final)
+            history_parts.append(formatted_primary_history_string_final)
             if not formatted_primary_history_string_final.endswith("\n"):
-                 prompt_parts.append("\n")
-            prompt_parts.append("\n")
-        prompt_parts.append(FINAL_INSTRUCTION)
-        prompt_content = "".join(prompt_parts)
+                 history_parts.append("\n")
+            history_parts.append("\n")
+        if formatted_ambient_history_string_final:
+            history_parts.append(formatted_ambient_history_string_final)
+            if not formatted_ambient_history_string_final.endswith("\n\n"):
+                history_parts.append("\n\n" if not formatted_ambient_history_string_final.endswith("\n") else "\n")
+
+        if OLLAMA_PROMPT_MODE == 'chat':
+            # Prefix-stable layout: persona (system message), then the primary thread, then the ambient
+            # block and what belongs to the post being answered. The next request in the thread shares
+            # the persona and primary-thread prefix, so Ollama reuses its prompt cache for it.
+            user_message_parts = list(history_parts)
+            if attachments_string: user_message_parts.append(attachments_string)
+            if tagged_files_string: user_message_parts.append(tagged_files_string)
+            user_message_parts.append(FINAL_INSTRUCTION)
+            user_message_content = "".join(user_message_parts)
+            prompt_content = f"{persona_instructions}\n\n{user_message_content}" # What the queue view shows
+            ollama_path = '/api/chat'
+            ollama_payload = {
+                'model': model,
+                'messages': [
+                    {'role': 'system', 'content': persona_instructions},
+                    {'role': 'user', 'content': user_message_content}
+                ],
+                'stream': True
+            }
+        else:
+            prompt_parts = []
+            if attachments_string: prompt_parts.append(attachments_string)
+            if tagged_files_string: prompt_parts.append(tagged_files_string)
+            prompt_parts.append(f"{persona_instructions}\n\n")
+            prompt_parts.extend(history_parts)
+            prompt_parts.append(FINAL_INSTRUCTION)
+            prompt_content = "".join(prompt_parts)
+            ollama_path = '/api/generate'
+            ollama_payload = {'model': model, 'prompt': prompt_content, 'stream': True}
+
+        if request_details.get('keep_alive') is not None: # Set by the queue from backlog depth and the window end
+            ollama_payload['keep_alive'] = request_details['keep_alive']
 
         actual_final_prompt_tokens = count_tokens(prompt_content)
         logger.info(f"Request {request_id}: Final prompt constructed. Total tokens: {actual_final_prompt_tokens}.")
@@ -464,14 +719,18 @@ def process_llm_request(request_details, flask_app):
             "user_post_tokens": user_post_tokens,
             "attachments_token_count": attachments_token_count,
             "tagged_files_token_count": tagged_files_token_count,
-            "primary_chat_history_tokens": count_tokens(pruning_results["pruned_primary_content_str"]),
-            "ambient_chat_history_tokens": count_tokens(pruning_results["pruned_ambient_content_str"]),
+            "primary_chat_history_tokens": pruning_results["pruned_primary_content_tokens"],
+            "ambient_chat_history_tokens": pruning_results["pruned_ambient_content_tokens"],
             "headers_tokens": pruning_results["primary_header_tokens"] + pruning_results["ambient_header_tokens"],
             "final_instruction_tokens": final_instruction_tokens,
             "total_prompt_tokens": actual_final_prompt_tokens
         }
         token_breakdown_json = json.dumps(token_breakdown)
 
+        if LLM_RESPONSE_CACHE_ENABLED and request_details.get('use_cache', True):
+            cache_options = {'mode': ollama_path, 'options': ollama_payload.get('options')}
+            cache_key, prompt_hash = make_llm_response_cache_key(model, cache_options, prompt_content)
+
         cursor.execute("UPDATE llm_requests SET full_prompt_sent = ?, prompt_token_breakdown = ? WHERE request_id = ?", (prompt_content, token_breakdown_json, request_id))
         db.commit()
         logger.info(f"Request {request_id}: Stored final prompt and token breakdown.")
@@ -479,118 +738,121 @@ def process_llm_request(request_details, flask_app):
         if actual_final_prompt_tokens > max_allowed_tokens:
             error_message_for_db = f"Error: Prompt too long after assembly. Tokens: {actual_final_prompt_tokens}, Max Allowed: {max_allowed_tokens}."
             logger.error(f"Request {request_id}: {error_message_for_db}")
-            cursor.execute("UPDATE llm_requests SET status = 'error', error_message = ?, processed_at = CURRENT_TIMESTAMP WHERE request_id = ?", (error_message_for_db, request_id))
+            cursor.execute("UPDATE llm_requests SET status = 'error', error_message = ?, processed_at = CURRENT_TIMESTAMP WHERE request_id = ? AND status = 'processing'", (error_message_for_db, request_id))
             db.commit()
             return
 
+        if cancel_event.is_set():
+            print(f"Request {request_id} was cancelled before it was sent to Ollama.")
+            return
+
+        prompt_build_seconds = time.time() - build_started
+
+        if cache_key:
+            cached = get_cached_llm_response(db, cache_key)
+            if cached:
+                cached_response, generation_seconds = cached
+                start_llm_stream(request_id, topic_id_for_history, post_id)
+                append_llm_stream(request_id, cached_response)
+                new_post_id = _save_llm_reply(db, request_id, post_id, cached_response, model, persona_id, 'hit')
+                if new_post_id is None:
+                    finish_llm_stream(request_id, 'cancelled')
+                    return
+                record_llm_request_metrics(db, request_id, {'prompt_build_seconds': prompt_build_seconds})
+                finish_llm_stream(request_id, 'complete', new_post_id=new_post_id)
+                print(f"Request {request_id} served from the response cache (saved ~{generation_seconds or 0:.0f}s of generation).")
+                return
+            leader_request_id = register_llm_request_prompt(db, request_id, cache_key)
+            if leader_request_id is not None:
+                # The same prompt is being generated right now; wait for its reply to land in the cache.
+                if defer_llm_request_for_prompt(db, request_id, leader_request_id, LLM_RESPONSE_CACHE_COALESCE_WAIT_SECONDS):
+                    print(f"Request {request_id} has the same prompt as in-flight request {leader_request_id}; waiting for its reply.")
+                return
+            generated_cache_key = cache_key
+
         try:
-            print(f"Sending prompt to Ollama for model '{model}'...")
+            print(f"Sending prompt to Ollama ({ollama_path}) for model '{model}'...")
             full_response_content = ""
-            last_chunk_time = time.time()
-            inter_chunk_timeout = 300
-            initial_connection_timeout = 300
-
-            response = requests.post(
-                OLLAMA_GENERATE_URL,
-                json={'model': model, 'prompt': prompt_content, 'stream': True},
-                headers={'Content-Type': 'application/json'},
-                stream=True,
-                timeout=initial_connection_timeout
-            )
-            response.raise_for_status()
 
+            # The client's read timeout bounds both the wait for the first byte and any gap between chunks.
+            start_llm_stream(request_id, topic_id_for_history, post_id)
+            generation_started = time.time()
+            last_persist_time = time.time()
             stream_done = False
-            for line in response.iter_lines():
-                if line:
-                    current_time = time.time()
-                    if current_time - last_chunk_time > inter_chunk_timeout:
-                        raise TimeoutError(f"Ollama response timed out after {inter_chunk_timeout} seconds of inactivity.")
-                    last_chunk_time = current_time
-                    try:
-                        chunk = json.loads(line.decode('utf-8'))
-                        response_part = chunk.get('response', '')
-                        full_response_content += response_part
-                        if chunk.get('done', False):
-                            stream_done = True
-                            break
-                    except json.JSONDecodeError:
-                        print(f"Warning: Received non-JSON line from Ollama stream for request {request_id}: {line}")
-                        continue
+            stream_timing = {}
+            final_chunk = {}
+            # stream_id lets a cancel (llm_queue.abort_running_llm_request) cut the stream off mid-read.
+            for chunk in ollama_stream(ollama_path, ollama_payload, timing=stream_timing, stream_id=request_id):
+                if cancel_event.is_set():
+                    break
+                if 'message' in chunk: # /api/chat
+                    response_part = chunk['message'].get('content', '')
+                else:
+                    response_part = chunk.get('response', '')
+                full_response_content += response_part
+                append_llm_stream(request_id, response_part)
+                current_time = time.time()
+                if current_time - last_persist_time >= LLM_STREAM_PERSIST_SECONDS:
+                    cursor.execute("UPDATE llm_requests SET partial_response = ? WHERE request_id = ?", (full_response_content, request_id))
+                    db.commit()
+                    last_persist_time = current_time
+                if chunk.get('done', False):
+                    stream_done = True
+                    final_chunk = chunk # Carries Ollama's load / prompt eval / decode counters
+                    break
+
+            if cancel_event.is_set():
+                finish_llm_stream(request_id, 'cancelled')
+                print(f"Request {request_id} was cancelled; generation stopped.")
+                return
 
             if not stream_done:
                  print(f"Warning: Ollama stream ended for request {request_id} without receiving 'done': true.")
                  if not full_response_content:
                      raise ValueError("Ollama stream ended unexpectedly with no content and no 'done' flag.")
 
-            cursor.execute("""
-                INSERT INTO posts (topic_id, user_id, parent_post_id, content, is_llm_response, llm_model_id, llm_persona_id)
-                SELECT topic_id, ?, ?, ?, TRUE, ?, ?
-                FROM posts WHERE post_id = ?
-            """, (CURRENT_USER_ID, post_id, full_response_content, model, persona_id, post_id))
-            new_post_id = cursor.lastrowid
-
-            cursor.execute("UPDATE llm_requests SET status = 'complete', processed_at = CURRENT_TIMESTAMP WHERE request_id = ?", (request_id,))
-            
-            cursor.execute("""
-                UPDATE llm_requests
-                SET status = 'pending', post_id_to_respond_to = ?
-                WHERE parent_request_id = ? AND status = 'pending_dependency'
-            """, (new_post_id, request_id))
-            
-            if cursor.rowcount > 0:
-                print(f"Request {request_id}: Activated {cursor.rowcount} dependent request(s).")
-
-            db.commit()
+            new_post_id = _save_llm_reply(db, request_id, post_id, full_response_content, model, persona_id,
+                                          'miss' if cache_key else 'bypass')
+            if new_post_id is None:
+                finish_llm_stream(request_id, 'cancelled')
+                print(f"Request {request_id} was cancelled; discarding the finished response.")
+                return
+            record_llm_request_metrics(db, request_id, dict(final_chunk, prompt_build_seconds=prompt_build_seconds,
+                                                            time_to_first_token_seconds=stream_timing.get('first_chunk_seconds')))
+            if cache_key and stream_done:
+                store_llm_response(db, cache_key, model, cache_options, prompt_hash, full_response_content,
+                                   time.time() - generation_started)
+            finish_llm_stream(request_id, 'complete', new_post_id=new_post_id)
             print(f"Request {request_id} marked as complete.")
 
-        except (ConnectionError, requests.exceptions.Timeout) as e:
-            print(f"Ollama connection failed or timed out: {type(e).__name__}. Using dummy LLM processor for request {request_id}.")
-            _dummy_llm_processor(request_id, post_id, model, persona_id, prompt_content, DATABASE, flask_app)
         except requests.exceptions.RequestException as e:
-            print(f"Ollama API request failed: {type(e).__name__}. Using dummy LLM processor for request {request_id}.")
-            _dummy_llm_processor(request_id, post_id, model, persona_id, prompt_content, DATABASE, flask_app)
+            if cancel_event.is_set(): # The cancel cut the stream off
+                finish_llm_stream(request_id, 'cancelled')
+                print(f"Request {request_id} was cancelled; generation stopped.")
+                return
+            # Transient failures (Ollama down, timed out, busy) put the request back in the queue with backoff;
+            # the circuit breaker in ollama_client pauses claiming while Ollama stays unreachable.
+            error_message = f"Ollama request failed: {type(e).__name__}: {e}"
+            requeued = retry_or_fail_llm_request(db, request_id, error_message, retryable=is_transient_ollama_error(e))
+            finish_llm_stream(request_id, 'retrying' if requeued else 'error', error=error_message)
+            if requeued:
+                print(f"Request {request_id}: {error_message}. Requeued for retry.")
+            else:
+                print(f"Request {request_id}: {error_message}. Marked as error.")
         except Exception as e:
             raise Exception(f"Error during Ollama interaction: {e}") from e
 
     except Exception as e:
         print(f"Error in process_llm_request for request {request_id}: {e}")
-        cursor.execute("UPDATE llm_requests SET status = 'error', error_message = ?, processed_at = CURRENT_TIMESTAMP WHERE request_id = ?", (f"Pre-processing error: {str(e)}", request_id))
+        cursor.execute("UPDATE llm_requests SET status = 'error', error_message = ?, processed_at = CURRENT_TIMESTAMP WHERE request_id = ? AND status = 'processing'", (f"Pre-processing error: {str(e)}", request_id))
         db.commit()
+        finish_llm_stream(request_id, 'error', error=str(e))
     finally:
-        db.close()
-
-def _dummy_llm_processor(request_id, post_id, model, persona_id, prompt_content, db_path, flask_app):
-    print(f"Dummy LLM processing request {request_id} for post {post_id}.")
-    dummy_response_content = f"This is a dummy LLM response for post {post_id} using model {model} and persona_id {persona_id}. The intended prompt was: {prompt_content}"
-    dummy_db = None
-    try:
-        dummy_db = sqlite3.connect(db_path)
-        dummy_db.row_factory = sqlite3.Row 
-        dummy_cursor = dummy_db.cursor()
-        dummy_cursor.execute("SELECT topic_id FROM posts WHERE post_id = ?", (post_id,))
-        original_post_topic = dummy_cursor.fetchone()
-        if not original_post_topic:
-            error_message = f"Dummy LLM: Original post {post_id} not found."
-            dummy_cursor.execute("UPDATE llm_requests SET status = 'error', error_message = ?, processed_at = CURRENT_TIMESTAMP WHERE request_id = ?", (error_message, request_id))
-            dummy_db.commit()
-            return
-        topic_id = original_post_topic['topic_id']
-        dummy_cursor.execute(
-            "INSERT INTO posts (topic_id, user_id, parent_post_id, content, is_llm_response, llm_model_id, llm_persona_id) VALUES (?, ?, ?, ?, TRUE, ?, ?)",
-            (topic_id, CURRENT_USER_ID, post_id, dummy_response_content, model, persona_id) 
-        )
-        dummy_cursor.execute("UPDATE llm_requests SET status = 'complete', processed_at = CURRENT_TIMESTAMP WHERE request_id = ?", (request_id,))
-        dummy_db.commit()
-    except Exception as e:
-        error_message = f"Error in dummy LLM processor for request {request_id}: {str(e)}"
-        print(error_message)
-        if dummy_db: 
+        # Covers any path that ended a started stream without finishing it.
+        finish_llm_stream(request_id, 'complete')
+        if generated_cache_key:
             try:
-                error_cursor = dummy_db.cursor()
-                error_cursor.execute("UPDATE llm_requests SET status = 'error', error_message = ? WHERE request_id = ?", (error_message, request_id))
-                dummy_db.commit()
-            except Exception as db_error:
-                print(f"Could not update LLM request status to error after dummy processor failure: {db_error}")
-    finally:
-        if dummy_db:
-            dummy_db.close()
+                release_llm_requests_waiting_for_prompt(db, generated_cache_key)
+            except sqlite3.Error as e:
+                print(f"Request {request_id}: could not release requests waiting on the same prompt: {e}")
+        db.close()
@@ -1,18 +1,113 @@
 import threading
-import queue
 import time
+import datetime
+import heapq
 import sqlite3
 import json # Added
-from .config import DATABASE, CURRENT_USER_ID # Added CURRENT_USER_ID
+import os
+import socket
+import uuid
+from .config import (DATABASE, CURRENT_USER_ID, LLM_WORKER_COUNT, LLM_REQUEST_LEASE_SECONDS, LLM_REAPER_INTERVAL_SECONDS, # Added CURRENT_USER_ID
+                     LLM_QUEUE_POLL_SECONDS, LLM_SCHEDULE_RECHECK_SECONDS, LLM_CANCEL_CHECK_SECONDS, LLM_ETA_CACHE_SECONDS,
+                     LLM_MODEL_AFFINITY_MAX_WAIT_SECONDS, OLLAMA_LOADED_MODELS_CACHE_SECONDS, LLM_ETA_HISTORY_HOURS,
+                     LLM_ETA_DEFAULT_SECONDS, LLM_WARMUP_MAX_MODELS, LLM_KEEP_ALIVE_BUSY_SECONDS, LLM_KEEP_ALIVE_IDLE_SECONDS,
+                     LLM_RELEASE_MODELS_AT_WINDOW_END)
 from .llm_processing import process_llm_request
-from .scheduler import is_processing_time
+from .scheduler import get_processing_window_state, get_processing_window_at, get_next_processing_time
 from .persona_generator import generate_persona_from_details # Added
-from .database import save_generated_persona # Added
+from .ollama_utils import get_loaded_ollama_models, warm_ollama_model, release_ollama_model
+from .ollama_client import model_name_variants, ollama_circuit_wait_seconds, abort_ollama_stream
+from .database import (save_generated_persona, claim_next_llm_request, renew_llm_request_lease, is_llm_request_leased_to, # Added
+                       retry_or_fail_llm_request, get_seconds_until_next_llm_retry, requeue_stuck_llm_requests,
+                       relink_stranded_llm_dependents, get_llm_model_throughput, get_llm_requests_awaiting_processing,
+                       get_models_of_queued_llm_requests, count_queued_llm_requests_for_model,
+                       get_pending_llm_prompt_token_maxima)
 
-llm_request_queue = queue.Queue()
 processing_active = threading.Event() # To signal if processing is allowed by schedule
+# Idle workers block on this instead of polling; the generation counter means a
+# notify that lands between a worker's empty claim and its wait is never lost.
+_queue_wakeup = threading.Condition()
+_queue_wakeup_generation = 0
+# Identifies this server process in lease_owner so leases from different processes never collide
+WORKER_INSTANCE_ID = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+# Model affinity: what Ollama reported as loaded (refreshed at most every
+# OLLAMA_LOADED_MODELS_CACHE_SECONDS) and the model this process claimed last.
+_loaded_models_lock = threading.Lock()
+_loaded_models = []
+_loaded_models_fetched_at = 0.0
+_last_claimed_model = None
+# Models this process warmed up or generated with during the current processing window; unloaded when it closes.
+# Models still generating when it closed (grace, or the 'any' policy) wait in _models_to_release until they finish.
+_window_models = set()
+_models_to_release = set()
+_window_models_lock = threading.Lock()
+# Requests being worked on in this process -> Event that tells the handler to stop (see abort_running_llm_request),
+# and the model each one runs on
+_running_requests = {}
+_running_request_models = {}
+_running_requests_lock = threading.Lock()
+# Size of the worker pool start_llm_workers started (None until then), for queue ETAs
+_worker_pool_size = None
+# Last queue ETA replay: (queue wakeup generation, monotonic time, etas); see get_llm_queue_etas
+_eta_cache = None
+_eta_cache_lock = threading.Lock()
 
-def _handle_persona_generation_request(request_id, request_params_json, flask_app):
+def notify_llm_queue():
+    """
+    Wakes idle LLM workers immediately.
+    Call after committing rows a worker could claim (new 'pending' requests)
+    or after changing the processing schedule, so sleeping workers re-check it.
+    """
+    global _queue_wakeup_generation
+    with _queue_wakeup:
+        _queue_wakeup_generation += 1
+        _queue_wakeup.notify_all()
+
+def _wait_for_queue_activity(seen_generation, timeout=None):
+    """Blocks until notify_llm_queue() has been called since seen_generation was read, or timeout elapses."""
+    with _queue_wakeup:
+        return _queue_wakeup.wait_for(lambda: _queue_wakeup_generation != seen_generation, timeout)
+
+def _min_timeout(*timeouts):
+    """The shortest of several wait timeouts, where None means no limit."""
+    timeouts = [t for t in timeouts if t is not None]
+    return min(timeouts) if timeouts else None
+
+def _idle_poll_seconds():
+    """Upper bound on an idle worker's wait, so rows written by other server processes are noticed."""
+    return max(1, min(LLM_QUEUE_POLL_SECONDS, LLM_REQUEST_LEASE_SECONDS))
+
+def _get_preferred_models(flask_app):
+    """
+    Returns the llm_model values workers should claim first: models Ollama has loaded,
+    falling back to the last model claimed here when /api/ps can't be reached.
+    """
+    global _loaded_models, _loaded_models_fetched_at
+    with _loaded_models_lock:
+        refresh = time.monotonic() - _loaded_models_fetched_at >= OLLAMA_LOADED_MODELS_CACHE_SECONDS
+        if refresh:
+            # Claim the refresh so other workers keep using the current list instead of queueing on the lock
+            _loaded_models_fetched_at = time.monotonic()
+        model_names = list(_loaded_models)
+    if refresh:
+        with flask_app.app_context():
+            loaded = get_loaded_ollama_models()
+        model_names = loaded if loaded is not None else []
+        with _loaded_models_lock:
+            _loaded_models = model_names
+            _loaded_models_fetched_at = time.monotonic()
+        model_names = list(model_names)
+    if _last_claimed_model and _last_claimed_model not in model_names:
+        model_names.append(_last_claimed_model)
+
+    preferred = []
+    for model_name in model_names:
+        for variant in model_name_variants(model_name):
+            if variant not in preferred:
+                preferred.append(variant)
+    return preferred
+
+def _handle_persona_generation_request(request_id, request_params_json, flask_app, cancel_event=None):
     # This function manages its own DB connection for all its operations including final status updates.
     db_conn = None 
     try:
@@ -27,7 +122,13 @@ def _handle_persona_generation_request(request_id, request_params_json, flask_ap
 
         request_params_dict = json.loads(request_params_json)
         
-        generation_result = generate_persona_from_details(request_params_dict, flask_app)
+        generation_result = generate_persona_from_details(request_params_dict, flask_app, cancel_event=cancel_event, stream_id=request_id)
+
+        cursor.execute("SELECT status FROM llm_requests WHERE request_id = ?", (request_id,))
+        status_row = cursor.fetchone()
+        if status_row and status_row[0] == 'cancelled':
+            print(f"Persona generation request {request_id} was cancelled; discarding the result.")
+            return
 
         if generation_result and generation_result.get('status') == 'success':
             persona_name = generation_result['persona_name']
@@ -51,6 +152,12 @@ def _handle_persona_generation_request(request_id, request_params_json, flask_ap
             else:
                 print(f"Error: Failed to save generated persona for request {request_id}.")
                 cursor.execute("UPDATE llm_requests SET status = 'error', error_message = 'Failed to save persona to DB', processed_at = CURRENT_TIMESTAMP WHERE request_id = ?", (request_id,))
+        elif generation_result and generation_result.get('retryable'):
+            error_msg = generation_result.get('error_message')
+            if retry_or_fail_llm_request(db_conn, request_id, error_msg):
+                print(f"Persona generation for request {request_id} hit a transient error and was requeued: {error_msg}")
+            else:
+                print(f"Error: Persona generation failed for request {request_id}: {error_msg}")
         else:
             error_msg = generation_result.get('error_message', 'Persona generation failed (no specific error message)')
             print(f"Error: Persona generation failed for request {request_id}: {error_msg}")
@@ -74,86 +181,489 @@ def _handle_persona_generation_request(request_id, request_params_json, flask_ap
         if db_conn:
             db_conn.close()
 
-def llm_worker(flask_app): # Added flask_app parameter
-    """Background worker thread to process LLM requests from the queue."""
-    print(f"LLM Worker thread started. Received Flask app: {flask_app}") # Log the received app
-    while True:
-        if is_processing_time():
-            processing_active.set() # Signal that processing is allowed
-            print("Processing time active. Checking queue...")
+def _mark_request_error(db_conn, request_id, error_message):
+    """Marks a request this worker is processing as errored, using the worker's own connection. Cancelled or reclaimed rows are left alone."""
+    db_conn.execute("UPDATE llm_requests SET status = 'error', error_message = ?, processed_at = CURRENT_TIMESTAMP WHERE request_id = ? AND status = 'processing'", (error_message, request_id))
+    db_conn.commit()
+
+def abort_running_llm_request(request_id):
+    """
+    Stops a request this process is working on, after its row was cancelled: the handler is told
+    to stop and its Ollama stream is cut off so the backend is freed at once.
+    Other server processes find out through their lease heartbeat's cancel check. Returns True if it was running here.
+    """
+    with _running_requests_lock:
+        cancel_event = _running_requests.get(request_id)
+    if cancel_event is None:
+        return False
+    cancel_event.set()
+    abort_ollama_stream(request_id)
+    return True
+
+def _lease_heartbeat(request_id, lease_owner, stop_event):
+    """
+    Renews the lease on a claimed request until stop_event is set or the row is no longer ours.
+    Between renewals it checks every LLM_CANCEL_CHECK_SECONDS that the row is still ours, so a cancel
+    made by another process stops the work within seconds.
+    """
+    heartbeat_db = sqlite3.connect(DATABASE, timeout=30)
+    renewed_at = time.monotonic()
+    try:
+        while not stop_event.wait(min(LLM_CANCEL_CHECK_SECONDS, LLM_REQUEST_LEASE_SECONDS / 3)):
             try:
-                # Prioritize getting items from the software queue first
-                request_details = llm_request_queue.get(timeout=5) # Wait 5 seconds for an item
-                # Pass flask_app to process_llm_request (this is for requests from the software queue)
-                process_llm_request(request_details, flask_app)
-                llm_request_queue.task_done()
-            except queue.Empty:
-                print("Software queue empty, checking DB queue...")
-                db_conn_poll = None 
-                try:
-                    db_conn_poll = sqlite3.connect(DATABASE)
-                    db_conn_poll.row_factory = sqlite3.Row
-                    cursor_poll = db_conn_poll.cursor()
-                    
-                    cursor_poll.execute("SELECT request_id, post_id_to_respond_to, llm_model, llm_persona, request_type, request_params FROM llm_requests WHERE status = 'pending' ORDER BY requested_at ASC LIMIT 1")
-                    db_request_data = cursor_poll.fetchone()
+                if time.monotonic() - renewed_at >= LLM_REQUEST_LEASE_SECONDS / 3:
+                    still_ours = renew_llm_request_lease(heartbeat_db, request_id, lease_owner, LLM_REQUEST_LEASE_SECONDS)
+                    renewed_at = time.monotonic()
+                else:
+                    still_ours = is_llm_request_leased_to(heartbeat_db, request_id, lease_owner)
+                if not still_ours:
+                    # Finished, cancelled (possibly from another process) or reclaimed; stop working on it if still running.
+                    abort_running_llm_request(request_id)
+                    break
+            except sqlite3.Error as e:
+                print(f"SQLite error renewing lease for request {request_id}: {e}")
+    finally:
+        heartbeat_db.close()
+
+def _keep_alive_seconds(db_conn, model_name, window):
+    """
+    How long Ollama should keep model_name loaded after a request: longer while more requests for it are queued,
+    but not past the end of the processing window (plus the overrun grace requests may run into) when models
+    are released there.
+    """
+    keep_alive = LLM_KEEP_ALIVE_BUSY_SECONDS if count_queued_llm_requests_for_model(db_conn, model_name) else LLM_KEEP_ALIVE_IDLE_SECONDS
+    if LLM_RELEASE_MODELS_AT_WINDOW_END and window['active'] and window['seconds_until_change'] is not None:
+        window_left = window['seconds_until_change'] + window.get('overrun_grace_seconds', 0)
+        keep_alive = min(keep_alive, max(0, int(window_left)))
+    return keep_alive
+
+def _dispatch_claimed_request(db_request_data, db_conn, flask_app, worker_name, cancel_event=None):
+    """Routes a claimed llm_requests row to the handler for its request_type. cancel_event is set if the request is cancelled."""
+    request_id = db_request_data['request_id']
+    post_id_to_respond_to = db_request_data['post_id_to_respond_to']
+    llm_model_for_response = db_request_data['llm_model']
+    llm_persona_for_response = db_request_data['llm_persona']
+
+    request_type = db_request_data['request_type'] if 'request_type' in db_request_data.keys() and db_request_data['request_type'] else 'respond_to_post'
+    request_params_json = db_request_data['request_params'] if 'request_params' in db_request_data.keys() and db_request_data['request_params'] else None
 
+    # Dispatching: handlers manage their own DB connections for final status updates.
+    if request_type == 'generate_persona':
+        print(f"{worker_name}: Delegating persona generation for request_id {request_id}")
+        _handle_persona_generation_request(request_id, request_params_json, flask_app, cancel_event)
+    elif request_type == 'respond_to_post' or request_type == 'respond_to_post_tag': # Modified condition
+        if post_id_to_respond_to is None:
+            print(f"Error: post_id_to_respond_to is missing for {request_type} request_id {request_id}. Marking as error.")
+            _mark_request_error(db_conn, request_id, f"Missing post_id_to_respond_to for {request_type} type")
+        else:
+            print(f"{worker_name}: Delegating {request_type} for request_id {request_id}")
+            process_llm_request({
+                'request_id': request_id,
+                'post_id': post_id_to_respond_to,
+                'model': llm_model_for_response, # Keep as is, process_llm_request will handle default
+                'persona': llm_persona_for_response,
+                'use_cache': bool(db_request_data['use_cache']) if 'use_cache' in db_request_data.keys() else True,
+                'keep_alive': _keep_alive_seconds(db_conn, llm_model_for_response, get_processing_window_state()) if llm_model_for_response else None,
+                'cancel_event': cancel_event
+            }, flask_app)
+    else:
+        print(f"Unknown request_type: {request_type} for request_id {request_id}. Marking as error.")
+        _mark_request_error(db_conn, request_id, f"Unknown request_type: {request_type}")
+
+def llm_worker(flask_app, worker_id=0): # Added flask_app parameter
+    """
+    Background worker thread to process LLM requests from the queue.
+    Several of these run side by side (see start_llm_workers); each one owns its DB connection.
+    """
+    global _last_claimed_model
+    worker_name = f"LLM Worker {worker_id}"
+    lease_owner = f"{WORKER_INSTANCE_ID}/{worker_id}"
+    print(f"{worker_name} thread started. Received Flask app: {flask_app}") # Log the received app
+    db_conn_poll = sqlite3.connect(DATABASE, timeout=30)
+    db_conn_poll.row_factory = sqlite3.Row
+    try:
+        while True:
+            seen_generation = _queue_wakeup_generation # Read before any check so no notify is missed
+            window = get_processing_window_state()
+            if window['active']:
+                processing_active.set() # Signal that processing is allowed
+                circuit_wait = ollama_circuit_wait_seconds()
+                if circuit_wait:
+                    # Ollama is down: leave the backlog queued rather than failing through it.
+                    print(f"{worker_name}: Ollama unavailable (circuit open). Checking again in {circuit_wait:.0f}s...")
+                    _wait_for_queue_activity(seen_generation, _min_timeout(circuit_wait, window['seconds_until_change'],
+                                                                           LLM_SCHEDULE_RECHECK_SECONDS))
+                    continue
+                try:
+                    # Near the end of the window only requests predicted to finish before it closes are started.
+                    fitting_ids = _requests_fitting_window(db_conn_poll, window)
+                    db_request_data = claim_next_llm_request(
+                        db_conn_poll, lease_owner, LLM_REQUEST_LEASE_SECONDS,
+                        preferred_models=_get_preferred_models(flask_app),
+                        max_affinity_wait_seconds=LLM_MODEL_AFFINITY_MAX_WAIT_SECONDS,
+                        only_request_ids=fitting_ids
+                    )
                     if db_request_data:
-                        request_id = db_request_data['request_id']
-                        post_id_to_respond_to = db_request_data['post_id_to_respond_to']
-                        llm_model_for_response = db_request_data['llm_model'] 
-                        llm_persona_for_response = db_request_data['llm_persona']
-                        
-                        request_type = db_request_data['request_type'] if 'request_type' in db_request_data.keys() and db_request_data['request_type'] else 'respond_to_post'
-                        request_params_json = db_request_data['request_params'] if 'request_params' in db_request_data.keys() and db_request_data['request_params'] else None
-
-                        cursor_poll.execute("UPDATE llm_requests SET status = 'processing', processed_at = CURRENT_TIMESTAMP WHERE request_id = ?", (request_id,))
-                        db_conn_poll.commit()
-                        
-                        # Dispatching: handlers manage their own DB connections for final status updates.
-                        if request_type == 'generate_persona':
-                            print(f"LLM Worker: Delegating persona generation for request_id {request_id}")
-                            _handle_persona_generation_request(request_id, request_params_json, flask_app)
-                        elif request_type == 'respond_to_post' or request_type == 'respond_to_post_tag': # Modified condition
-                            if post_id_to_respond_to is None:
-                                print(f"Error: post_id_to_respond_to is missing for {request_type} request_id {request_id}. Marking as error.")
-                                # This error case needs its own DB connection to update status
-                                temp_db_err = sqlite3.connect(DATABASE)
-                                temp_cur_err = temp_db_err.cursor()
-                                temp_cur_err.execute("UPDATE llm_requests SET status = 'error', error_message = ?, processed_at = CURRENT_TIMESTAMP WHERE request_id = ?", (f"Missing post_id_to_respond_to for {request_type} type", request_id))
-                                temp_db_err.commit()
-                                temp_db_err.close()
-                            else:
-                                print(f"LLM Worker: Delegating {request_type} for request_id {request_id}")
-                                process_llm_request({
-                                    'request_id': request_id,
-                                    'post_id': post_id_to_respond_to,
-                                    'model': llm_model_for_response, # Keep as is, process_llm_request will handle default
-                                    'persona': llm_persona_for_response
-                                }, flask_app)
+                        if db_request_data['llm_model']:
+                            _last_claimed_model = db_request_data['llm_model']
+                            with _window_models_lock:
+                                _window_models.add(db_request_data['llm_model'])
+                        stop_heartbeat = threading.Event()
+                        cancel_event = threading.Event()
+                        with _running_requests_lock:
+                            _running_requests[db_request_data['request_id']] = cancel_event
+                            _running_request_models[db_request_data['request_id']] = db_request_data['llm_model']
+                        threading.Thread(target=_lease_heartbeat, args=(db_request_data['request_id'], lease_owner, stop_heartbeat), daemon=True).start()
+                        try:
+                            _dispatch_claimed_request(db_request_data, db_conn_poll, flask_app, worker_name, cancel_event)
+                        finally:
+                            stop_heartbeat.set()
+                            with _running_requests_lock:
+                                _running_requests.pop(db_request_data['request_id'], None)
+                                _running_request_models.pop(db_request_data['request_id'], None)
+                            if db_request_data['llm_model']:
+                                _release_model_if_deferred(flask_app, db_request_data['llm_model'])
+                        # Completing a request may have released 'pending_dependency' children; let idle workers look.
+                        notify_llm_queue()
+                    else:
+                        if fitting_ids is not None:
+                            print(f"{worker_name}: Nothing left that can finish before the window closes "
+                                  f"({window['seconds_until_change']:.0f}s). Waiting...")
                         else:
-                            print(f"Unknown request_type: {request_type} for request_id {request_id}. Marking as error.")
-                            temp_db_err = sqlite3.connect(DATABASE)
-                            temp_cur_err = temp_db_err.cursor()
-                            temp_cur_err.execute("UPDATE llm_requests SET status = 'error', error_message = ?, processed_at = CURRENT_TIMESTAMP WHERE request_id = ?", (f"Unknown request_type: {request_type}", request_id))
-                            temp_db_err.commit()
-                            temp_db_err.close()
-                    else: 
-                        print("DB queue also empty. Sleeping...")
-                        time.sleep(10) 
-                
+                            print(f"{worker_name}: DB queue empty. Waiting for new requests...")
+                        # Also wake when the window closes so processing_active is cleared on time,
+                        # when a request's retry backoff runs out, and to poll for requests queued by other processes.
+                        _wait_for_queue_activity(seen_generation, _min_timeout(window['seconds_until_change'],
+                                                                               get_seconds_until_next_llm_retry(db_conn_poll),
+                                                                               _idle_poll_seconds()))
+
                 except sqlite3.Error as e:
-                    print(f"SQLite error in LLM worker (DB queue processing): {e}")
+                    print(f"SQLite error in {worker_name} (DB queue processing): {e}")
                     # Potentially add a longer sleep or specific error handling here
-                    time.sleep(10) 
+                    db_conn_poll.rollback()
+                    time.sleep(10)
                 except Exception as e:
                     # Catching generic Exception to log and prevent worker thread crash
-                    print(f"General error in LLM worker (DB queue processing): {e.__class__.__name__}: {e}")
-                    time.sleep(10) 
-                finally:
-                    if db_conn_poll:
-                        db_conn_poll.close()
+                    print(f"General error in {worker_name} (DB queue processing): {e.__class__.__name__}: {e}")
+                    time.sleep(10)
+            else:
+                processing_active.clear() # Signal that processing is paused
+                seconds_until_start = window['seconds_until_change']
+                if seconds_until_start is None:
+                    print(f"{worker_name}: Outside processing hours and no upcoming schedule. Sleeping until schedules change...")
+                else:
+                    print(f"{worker_name}: Outside processing hours. Worker sleeping until next window ({seconds_until_start:.0f}s)...")
+                # Schedule edits call notify_llm_queue(), which cuts this sleep short; the recheck cap covers the rest.
+                _wait_for_queue_activity(seen_generation, _min_timeout(seconds_until_start, LLM_SCHEDULE_RECHECK_SECONDS))
+    finally:
+        db_conn_poll.close()
+
+def _is_dead_instance(instance_id):
+    """
+    True if instance_id (a WORKER_INSTANCE_ID from a lease_owner) was an earlier server process on this host.
+    Leases held by other hosts, or by a process that may still be running, are left to expire.
+    """
+    if instance_id == WORKER_INSTANCE_ID:
+        return False
+    try:
+        hostname, pid, _ = instance_id.rsplit('-', 2)
+        pid = int(pid)
+    except ValueError:
+        return False
+    if hostname != socket.gethostname():
+        return False
+    if pid == os.getpid():
+        return True # Same PID, different instance: we were restarted (typical in containers)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        return False # Exists but belongs to someone else
+    return False
+
+def reap_stuck_llm_requests():
+    """
+    Recovers requests orphaned by a crash or restart: 'processing' rows whose lease expired or whose
+    server process on this host is gone go back to 'pending' (attempt_count carries over),
+    and 'pending_dependency' chains whose parent can no longer release them are re-linked.
+    Returns (requeued, failed, relinked).
+    """
+    reaper_db = sqlite3.connect(DATABASE, timeout=30)
+    try:
+        lease_owners = [row[0] for row in reaper_db.execute(
+            "SELECT DISTINCT lease_owner FROM llm_requests WHERE status = 'processing' AND lease_owner IS NOT NULL")]
+        dead_lease_owners = [owner for owner in lease_owners if _is_dead_instance(owner.rsplit('/', 1)[0])]
+        requeued, failed = requeue_stuck_llm_requests(reaper_db, dead_lease_owners)
+        relinked = relink_stranded_llm_dependents(reaper_db)
+    finally:
+        reaper_db.close()
+    if requeued or failed or relinked:
+        print(f"LLM reaper: requeued {requeued} stuck request(s), failed {failed} out of attempts, re-linked {relinked} dependent request(s).")
+        notify_llm_queue()
+    return requeued, failed, relinked
+
+def _reaper_loop():
+    while True:
+        time.sleep(LLM_REAPER_INTERVAL_SECONDS)
+        try:
+            reap_stuck_llm_requests()
+        except sqlite3.Error as e:
+            print(f"SQLite error in LLM reaper: {e}")
+
+def _warm_models_for_backlog(flask_app, db_conn, window):
+    """Preloads the most requested models of the pending backlog that Ollama doesn't have loaded yet."""
+    models = get_models_of_queued_llm_requests(db_conn, LLM_WARMUP_MAX_MODELS)
+    if not models:
+        return
+    with flask_app.app_context():
+        loaded = set(get_loaded_ollama_models() or [])
+        for model_name in models:
+            if loaded.intersection(model_name_variants(model_name)):
+                continue
+            if warm_ollama_model(model_name, _keep_alive_seconds(db_conn, model_name, window)) is not None:
+                with _window_models_lock:
+                    _window_models.add(model_name)
+
+def _models_in_use(models):
+    with _running_requests_lock:
+        running = set(_running_request_models.values())
+    return {model_name for model_name in models if running.intersection(model_name_variants(model_name))}
+
+def _release_window_models(flask_app):
+    """
+    Unloads the models used during the window that just closed. Models that requests are still generating
+    with are left loaded; the worker releases them when their last request finishes (_release_model_if_deferred).
+    """
+    with _window_models_lock:
+        in_use = _models_in_use(_window_models)
+        models = sorted(_window_models - in_use)
+        _models_to_release.update(in_use)
+        _window_models.clear()
+    if not models:
+        return
+    with flask_app.app_context():
+        get_loaded_ollama_models() # Current /api/ps state, so only models still loaded are unloaded
+        for model_name in models:
+            release_ollama_model(model_name)
+
+def _release_model_if_deferred(flask_app, model_name):
+    """After a request finishes: unloads model_name if the window closed while it ran and nothing else still uses it."""
+    with _window_models_lock:
+        if model_name not in _models_to_release or _models_in_use([model_name]):
+            return
+        _models_to_release.discard(model_name)
+    if get_processing_window_state()['active']: # A new window opened meanwhile; keep the model for it
+        return
+    try:
+        with flask_app.app_context():
+            get_loaded_ollama_models()
+            release_ollama_model(model_name)
+    except Exception as e:
+        print(f"Error releasing model '{model_name}' after the window closed: {e.__class__.__name__}: {e}")
+
+def _model_lifecycle_loop(flask_app):
+    """
+    Follows the processing schedule: when a window opens (or at startup inside one) the backlog's models are
+    preloaded, so the first request doesn't pay the load; when it closes they are unloaded again.
+    """
+    was_active = None
+    db_conn = sqlite3.connect(DATABASE, timeout=30)
+    db_conn.row_factory = sqlite3.Row
+    while True:
+        seen_generation = _queue_wakeup_generation
+        window = get_processing_window_state()
+        try:
+            if window['active'] and not was_active:
+                with _window_models_lock: # Still-running models from the last window are this window's now
+                    _window_models.update(_models_to_release)
+                    _models_to_release.clear()
+                _warm_models_for_backlog(flask_app, db_conn, window)
+            elif not window['active'] and was_active and LLM_RELEASE_MODELS_AT_WINDOW_END:
+                _release_window_models(flask_app)
+        except sqlite3.Error as e:
+            print(f"SQLite error in model warmup/release: {e}")
+        except Exception as e: # Keep the thread alive; the next window change tries again
+            print(f"Error in model warmup/release: {e.__class__.__name__}: {e}")
+        was_active = window['active']
+        # Schedule edits call notify_llm_queue(), which cuts this short; the recheck cap covers the rest.
+        _wait_for_queue_activity(seen_generation, _min_timeout(window['seconds_until_change'], LLM_SCHEDULE_RECHECK_SECONDS))
+
+def _db_utc_to_local(timestamp):
+    """SQLite CURRENT_TIMESTAMP text (UTC) -> naive local datetime, the clock the scheduler works in."""
+    if not timestamp:
+        return None
+    utc_dt = datetime.datetime.strptime(str(timestamp)[:19], '%Y-%m-%d %H:%M:%S').replace(tzinfo=datetime.timezone.utc)
+    return utc_dt.astimezone().replace(tzinfo=None)
+
+def _estimate_llm_request_seconds(row, throughput, fallback_seconds):
+    """Expected run time: model load + prompt eval + a typical-length reply at the model's recent speed."""
+    prompt_tokens = None
+    if row['prompt_token_breakdown']: # Known once the prompt has been built (retries, running requests)
+        try:
+            prompt_tokens = json.loads(row['prompt_token_breakdown']).get('total_prompt_tokens')
+        except (json.JSONDecodeError, AttributeError):
+            pass
+    return _estimate_llm_run_seconds(row['llm_model'], prompt_tokens, throughput, fallback_seconds)
+
+def _estimate_llm_run_seconds(model, prompt_tokens, throughput, fallback_seconds):
+    """_estimate_llm_request_seconds for a model and prompt size; None prompt_tokens means the model's average."""
+    stats = throughput.get(model)
+    if not stats or not stats['eval_tokens_per_second']:
+        return fallback_seconds
+    prompt_tokens = prompt_tokens or stats['avg_prompt_eval_count'] or 0
+    seconds = stats['avg_load_seconds'] + (stats['avg_eval_count'] or 0) / stats['eval_tokens_per_second']
+    if stats['prompt_eval_tokens_per_second']:
+        seconds += prompt_tokens / stats['prompt_eval_tokens_per_second']
+    return seconds
+
+def _get_llm_run_time_model(db_conn):
+    """Recent per-model throughput, plus the run time assumed for models without any history."""
+    throughput = get_llm_model_throughput(db_conn, LLM_ETA_HISTORY_HOURS)
+    model_totals = [stats['avg_total_seconds'] for stats in throughput.values() if stats['avg_total_seconds']]
+    fallback_seconds = sum(model_totals) / len(model_totals) if model_totals else LLM_ETA_DEFAULT_SECONDS
+    return throughput, fallback_seconds
+
+def _fits_processing_window(run_seconds, window):
+    """
+    Whether a request predicted to take run_seconds may start in `window` (a get_processing_window_at state).
+    Under the 'fit' policy it must finish before the window closes (plus the schedule's grace); a request
+    longer than the whole window can never fit, so it is let through rather than held back forever.
+    """
+    if window.get('admission_policy', 'any') != 'fit' or window['seconds_until_change'] is None:
+        return True
+    if run_seconds <= window['seconds_until_change'] + window.get('overrun_grace_seconds', 0):
+        return True
+    window_seconds = window.get('window_seconds')
+    return window_seconds is not None and run_seconds > window_seconds + window.get('overrun_grace_seconds', 0)
+
+def _requests_fitting_window(db_conn, window):
+    """
+    Window-end admission: None if every pending request may start now, otherwise the ids of those that
+    may (predicted to finish before the window closes). Shorter jobs are thus picked near the boundary,
+    and an empty list means the rest waits for the next window.
+    """
+    if window.get('admission_policy', 'any') != 'fit' or window['seconds_until_change'] is None:
+        return None
+    throughput, fallback_seconds = _get_llm_run_time_model(db_conn)
+    # Most of the window: if even the longest pending request fits, skip replaying the queue row by row
+    longest_seconds = 0
+    for model, max_prompt_tokens in get_pending_llm_prompt_token_maxima(db_conn).items():
+        longest_seconds = max(longest_seconds,
+                              _estimate_llm_run_seconds(model, max_prompt_tokens, throughput, fallback_seconds),
+                              _estimate_llm_run_seconds(model, None, throughput, fallback_seconds))
+    if longest_seconds <= window['seconds_until_change'] + window.get('overrun_grace_seconds', 0):
+        return None
+    fitting_ids = []
+    all_fit = True
+    for row in get_llm_requests_awaiting_processing(db_conn):
+        if row['status'] != 'pending':
+            continue
+        if _fits_processing_window(_estimate_llm_request_seconds(row, throughput, fallback_seconds), window):
+            fitting_ids.append(row['request_id'])
         else:
-            processing_active.clear() # Signal that processing is paused
-            print(f"Outside processing hours. Worker sleeping... (Will check again in 60s)")
-            time.sleep(60) # Sleep longer when outside processing hours
\ No newline at end of file
+            all_fit = False
+    return None if all_fit else fitting_ids
+
+def estimate_llm_queue_etas(db_conn, num_workers=None):
+    """
+    Estimates, for every unfinished request, its queue position and when it will start and finish.
+    Replays the queue in claim order over num_workers slots (default: the pool start_llm_workers started),
+    with each request's run time taken from its model's throughput over the last LLM_ETA_HISTORY_HOURS,
+    and starts deferred to the next processing window (or the one after, if it would not finish in time
+    under that window's admission policy). Chained requests start when their parent finishes.
+    Returns {request_id: {'position', 'estimated_start', 'estimated_finish'}} with ISO local times; the
+    times are None when no schedule will ever run the request. A chained request whose parent isn't
+    queued or running also gets 'blocked_on_parent' (the parent's request_id) instead.
+    """
+    if num_workers is None:
+        num_workers = _worker_pool_size or LLM_WORKER_COUNT
+    throughput, fallback_seconds = _get_llm_run_time_model(db_conn)
+
+    now = datetime.datetime.now()
+    slots = [now] * max(1, num_workers) # When each worker slot is next free
+    heapq.heapify(slots)
+    finishes = {}
+    etas = {}
+    position = 0
+    for row in get_llm_requests_awaiting_processing(db_conn):
+        request_id = row['request_id']
+        run_seconds = datetime.timedelta(seconds=_estimate_llm_request_seconds(row, throughput, fallback_seconds))
+        if row['status'] == 'processing':
+            started = _db_utc_to_local(row['processed_at']) or now
+            finish = max(now, started + run_seconds)
+            heapq.heapreplace(slots, finish)
+            finishes[request_id] = finish
+            etas[request_id] = {'position': 0, 'estimated_start': started.astimezone().isoformat(timespec='seconds'),
+                                'estimated_finish': finish.astimezone().isoformat(timespec='seconds')}
+            continue
+
+        position += 1
+        earliest = slots[0]
+        if row['status'] == 'pending_dependency':
+            parent_finish = finishes.get(row['parent_request_id'])
+            if parent_finish is None: # Parent finished without releasing it, or is itself blocked; the reaper sorts it out
+                etas[request_id] = {'position': position, 'estimated_start': None, 'estimated_finish': None,
+                                    'blocked_on_parent': row['parent_request_id']}
+                continue
+            earliest = max(earliest, parent_finish)
+        elif row['next_attempt_at']: # Waiting out a retry backoff
+            earliest = max(earliest, _db_utc_to_local(row['next_attempt_at']))
+        start = get_next_processing_time(earliest) if earliest else None
+        for _ in range(14): # Skip windows it wouldn't finish in; a week of twice-daily windows is plenty
+            if start is None:
+                break
+            window = get_processing_window_at(start)
+            if _fits_processing_window(run_seconds.total_seconds(), window):
+                break
+            start = get_next_processing_time(start + datetime.timedelta(seconds=window['seconds_until_change']))
+        if start is None:
+            etas[request_id] = {'position': position, 'estimated_start': None, 'estimated_finish': None}
+            continue
+        finish = start + run_seconds
+        heapq.heapreplace(slots, finish)
+        finishes[request_id] = finish
+        etas[request_id] = {'position': position, 'estimated_start': start.astimezone().isoformat(timespec='seconds'),
+                            'estimated_finish': finish.astimezone().isoformat(timespec='seconds')}
+    return etas
+
+def get_llm_queue_etas(db_conn):
+    """
+    estimate_llm_queue_etas for the queue page, reused for LLM_ETA_CACHE_SECONDS while nothing in this
+    process has called notify_llm_queue(). The result must not be modified.
+    """
+    global _eta_cache
+    generation = _queue_wakeup_generation
+    with _eta_cache_lock:
+        cached = _eta_cache
+        if cached and cached[0] == generation and time.monotonic() - cached[1] < LLM_ETA_CACHE_SECONDS:
+            return cached[2]
+    etas = estimate_llm_queue_etas(db_conn)
+    with _eta_cache_lock:
+        _eta_cache = (generation, time.monotonic(), etas)
+    return etas
+
+def start_llm_workers(flask_app, num_workers=LLM_WORKER_COUNT):
+    """
+    Starts a pool of daemon worker threads that drain llm_requests concurrently, after recovering
+    requests a previous run left stuck, plus the reaper thread that keeps doing so and the thread
+    that preloads and unloads models as processing windows open and close.
+    Size the pool to the number of requests Ollama can serve at once (OLLAMA_NUM_PARALLEL).
+    Returns the list of started worker threads.
+    """
+    try:
+        reap_stuck_llm_requests()
+    except sqlite3.Error as e:
+        print(f"SQLite error recovering stuck LLM requests at startup: {e}")
+    threading.Thread(target=_reaper_loop, name="llm-reaper", daemon=True).start()
+    threading.Thread(target=_model_lifecycle_loop, args=(flask_app,), name="llm-model-lifecycle", daemon=True).start()
+    global _worker_pool_size
+    num_workers = max(1, int(num_workers))
+    _worker_pool_size = num_workers # Queue ETAs replay over the pool actually running
+    worker_threads = []
+    for worker_id in range(num_workers):
+        worker_thread = threading.Thread(target=llm_worker, args=(flask_app, worker_id), name=f"llm-worker-{worker_id}", daemon=True)
+        worker_thread.start()
+        worker_threads.append(worker_thread)
+    print(f"Started {num_workers} LLM worker thread(s).")
+    return worker_threads
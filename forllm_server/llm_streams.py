@@ -0,0 +1,124 @@
+import json
+import threading
+import time
+
+from .config import LLM_STREAM_RETENTION_SECONDS
+
+# In-memory relay of LLM output while it is being generated, so the browser can show tokens
+# as they arrive instead of waiting for the finished post. Workers publish here;
+# the SSE routes in llm_routes.py subscribe. Finished streams are kept for
+# LLM_STREAM_RETENTION_SECONDS so a subscriber that connects late still sees the result.
+_streams = {} # request_id -> dict(request_id, seq, topic_id, post_id, text, status, new_post_id, error, finished_at)
+_streams_changed = threading.Condition()
+_streams_version = 0
+_streams_seq = 0 # Distinguishes a retried request's new stream from its earlier, finished one
+
+def _bump_version_locked():
+    global _streams_version
+    _streams_version += 1
+    _streams_changed.notify_all()
+
+def _prune_finished_streams_locked():
+    cutoff = time.monotonic() - LLM_STREAM_RETENTION_SECONDS
+    for request_id in [rid for rid, s in _streams.items() if s['finished_at'] is not None and s['finished_at'] < cutoff]:
+        del _streams[request_id]
+
+def start_llm_stream(request_id, topic_id, post_id):
+    """Registers a request whose output is about to be streamed from Ollama (again, if it is being retried)."""
+    global _streams_seq
+    with _streams_changed:
+        _prune_finished_streams_locked()
+        _streams_seq += 1
+        _streams[request_id] = {
+            'request_id': request_id, 'seq': _streams_seq, 'topic_id': topic_id, 'post_id': post_id,
+            'text': '', 'status': 'streaming', 'new_post_id': None, 'error': None, 'finished_at': None
+        }
+        _bump_version_locked()
+
+def append_llm_stream(request_id, text):
+    """Adds newly generated text to a live stream. No-op for unknown or finished streams."""
+    if not text:
+        return
+    with _streams_changed:
+        stream = _streams.get(request_id)
+        if stream is None or stream['finished_at'] is not None:
+            return
+        stream['text'] += text
+        _bump_version_locked()
+
+def finish_llm_stream(request_id, status, new_post_id=None, error=None):
+    """
+    Marks a stream as finished ('complete', 'error', or 'retrying' when the request was requeued). Only the first call counts,
+    so it is safe to call again from cleanup paths.
+    """
+    with _streams_changed:
+        stream = _streams.get(request_id)
+        if stream is None or stream['finished_at'] is not None:
+            return
+        stream.update(status=status, new_post_id=new_post_id, error=error, finished_at=time.monotonic())
+        _bump_version_locked()
+
+def get_llm_stream_snapshot(request_id):
+    """Returns a copy of the live stream for request_id, or None if it isn't streaming here."""
+    with _streams_changed:
+        stream = _streams.get(request_id)
+        return dict(stream) if stream else None
+
+def format_sse_event(event, data):
+    """Formats one Server-Sent Events message."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def iter_llm_stream_events(stream_filter, heartbeat_seconds, stop_when_finished=False, on_heartbeat=None):
+    """
+    Yields SSE messages for every stream matching stream_filter(stream_dict):
+    'start' when a stream is seen, 'token' with each new piece of text, and 'done' when it finishes.
+    Text generated before the subscriber connected is sent as the first 'token'.
+    A comment line is sent every heartbeat_seconds while idle so dead connections are noticed;
+    on_heartbeat() may return True to end the subscription (e.g. the request finished elsewhere).
+    With stop_when_finished, iteration ends once a matching stream has finished.
+    """
+    sent_offsets = {} # (request_id, seq) -> number of characters already sent
+    finished_sent = set() # (request_id, seq)
+    seen_version = -1
+    while True:
+        with _streams_changed:
+            if not _streams_changed.wait_for(lambda: _streams_version != seen_version, heartbeat_seconds):
+                pending_messages = None
+            else:
+                seen_version = _streams_version
+                # Forget streams _prune_finished_streams_locked has dropped; a (request_id, seq) never comes back.
+                live_keys = {(s['request_id'], s['seq']) for s in _streams.values()}
+                for key in [k for k in sent_offsets if k not in live_keys]:
+                    del sent_offsets[key]
+                finished_sent &= live_keys
+                matching = [dict(s) for s in _streams.values() if stream_filter(s)]
+                pending_messages = []
+                for stream in matching:
+                    request_id = stream['request_id']
+                    key = (request_id, stream['seq'])
+                    if key in finished_sent:
+                        continue
+                    if key not in sent_offsets:
+                        sent_offsets[key] = 0
+                        pending_messages.append(format_sse_event('start', {'request_id': request_id, 'post_id': stream['post_id']}))
+                    new_text = stream['text'][sent_offsets[key]:]
+                    if new_text:
+                        sent_offsets[key] = len(stream['text'])
+                        pending_messages.append(format_sse_event('token', {'request_id': request_id, 'text': new_text}))
+                    if stream['finished_at'] is not None:
+                        finished_sent.add(key)
+                        pending_messages.append(format_sse_event('done', {
+                            'request_id': request_id, 'status': stream['status'],
+                            'new_post_id': stream['new_post_id'], 'error': stream['error']
+                        }))
+
+        # Yield outside the lock: a slow client must never block the worker publishing tokens.
+        if pending_messages is None:
+            yield ": heartbeat\n\n"
+            if on_heartbeat and on_heartbeat():
+                return
+            continue
+        for message in pending_messages:
+            yield message
+        if stop_when_finished and finished_sent:
+            return
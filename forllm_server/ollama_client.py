@@ -0,0 +1,409 @@
+import json
+import logging
+import socket
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .config import (OLLAMA_BACKENDS, OLLAMA_CONNECT_TIMEOUT, OLLAMA_READ_TIMEOUT, OLLAMA_METADATA_READ_TIMEOUT,
+                     OLLAMA_HTTP_POOL_SIZE, OLLAMA_STREAM_CHUNK_SIZE, OLLAMA_NUM_PARALLEL, OLLAMA_BACKEND_RETRY_SECONDS,
+                     OLLAMA_MODEL_LIST_CACHE_SECONDS,
+                     OLLAMA_CIRCUIT_FAILURE_THRESHOLD, OLLAMA_CIRCUIT_OPEN_SECONDS, OLLAMA_CIRCUIT_MAX_OPEN_SECONDS)
+
+logger = logging.getLogger(__name__)
+
+# All HTTP traffic to Ollama goes through this module: one keep-alive session with a
+# connection pool shared by every worker and route, consistent (connect, read) timeouts,
+# per-endpoint call timing, and routing across the Ollama servers in OLLAMA_BACKENDS.
+# Errors are the usual requests exceptions, so callers keep catching requests.exceptions.* as before.
+_session = None
+_session_lock = threading.Lock()
+
+# base_url -> routing state. 'outstanding' counts requests in flight; 'loaded_models' is what
+# /api/ps last reported plus models this process has since run there; 'available_models' is
+# what /api/tags last listed (None until it has been read).
+_backends = {
+    base_url: {'base_url': base_url, 'healthy': True, 'failed_at': None, 'last_error': None,
+               'outstanding': 0, 'requests': 0, 'last_assigned': 0.0, 'loaded_models': set(),
+               'available_models': None, 'available_fetched_at': None}
+    for base_url in OLLAMA_BACKENDS
+}
+_backends_lock = threading.Lock()
+
+# Circuit breaker over routed requests (see OLLAMA_CIRCUIT_* in config.py). Workers consult
+# ollama_circuit_wait_seconds() before claiming, so an Ollama outage pauses the queue instead
+# of failing through it.
+_circuit = {'state': 'closed', 'consecutive_failures': 0, 'open_until': 0.0, 'open_seconds': 0, 'last_error': None}
+_circuit_lock = threading.Lock()
+_circuit_probe_lock = threading.Lock()
+
+# Streams started with a stream_id, so another thread can cut them off (abort_ollama_stream).
+_open_streams = {} # stream_id -> requests.Response being read
+_aborted_streams = set()
+_open_streams_lock = threading.Lock()
+
+_call_stats = {} # "POST /api/chat" -> {'calls', 'errors', 'total_seconds', 'max_seconds', 'last_seconds'}
+_call_stats_lock = threading.Lock()
+
+def _get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=max(4, len(OLLAMA_BACKENDS)), pool_maxsize=OLLAMA_HTTP_POOL_SIZE)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _session = session
+    return _session
+
+def _record_call(method, path, elapsed_seconds, ok):
+    key = f"{method} {path}"
+    with _call_stats_lock:
+        stats = _call_stats.setdefault(key, {'calls': 0, 'errors': 0, 'total_seconds': 0.0, 'max_seconds': 0.0, 'last_seconds': 0.0})
+        stats['calls'] += 1
+        if not ok:
+            stats['errors'] += 1
+        stats['total_seconds'] += elapsed_seconds
+        stats['max_seconds'] = max(stats['max_seconds'], elapsed_seconds)
+        stats['last_seconds'] = elapsed_seconds
+
+def get_ollama_call_stats():
+    """Returns a copy of the per-endpoint call counters and timings collected so far."""
+    with _call_stats_lock:
+        return {key: dict(stats) for key, stats in _call_stats.items()}
+
+def model_name_variants(model_name):
+    """Ollama reports 'llama3:latest' where requests may store plain 'llama3', and vice versa."""
+    if model_name.endswith(':latest'):
+        return [model_name, model_name[:-len(':latest')]]
+    if ':' not in model_name:
+        return [model_name, f"{model_name}:latest"]
+    return [model_name]
+
+def _refresh_available_models():
+    """Re-reads /api/tags on every backend whose model list is older than OLLAMA_MODEL_LIST_CACHE_SECONDS."""
+    now = time.monotonic()
+    with _backends_lock: # Claim the stale lists so concurrent requests don't all fetch them
+        stale = [b['base_url'] for b in _backends.values()
+                 if b['available_fetched_at'] is None or now - b['available_fetched_at'] >= OLLAMA_MODEL_LIST_CACHE_SECONDS]
+        for base_url in stale:
+            _backends[base_url]['available_fetched_at'] = now
+    for base_url in stale:
+        try:
+            models = ollama_get_json('/api/tags', base_url=base_url).get('models', [])
+            names = {model.get('name') or model.get('model') for model in models} - {None}
+        except (requests.exceptions.RequestException, ValueError, AttributeError) as e:
+            logger.warning(f"Could not list the models on Ollama backend {base_url}: {e}")
+            continue # Keep the last known list; it is retried after the cache period
+        with _backends_lock:
+            _backends[base_url]['available_models'] = names
+
+def _acquire_backend(model_name=None):
+    """
+    Picks the backend for a request and counts it as outstanding there. With several backends,
+    a model request only goes to backends whose /api/tags lists the model (unless none does).
+    Among those, in order of preference: a backend with model_name loaded and a free slot, any
+    backend with a free slot, then the least busy one (still preferring the model). Backends
+    that recently refused connections are skipped unless nothing else is left.
+    """
+    if model_name and len(_backends) > 1:
+        _refresh_available_models()
+    now = time.monotonic()
+    with _backends_lock:
+        candidates = [b for b in _backends.values()
+                      if b['healthy'] or now - b['failed_at'] >= OLLAMA_BACKEND_RETRY_SECONDS]
+        if not candidates: # Everything looks down; try anyway so the caller gets a real error
+            candidates = list(_backends.values())
+        variants = set(model_name_variants(model_name)) if model_name else set()
+        if variants:
+            # A backend that doesn't have the model would answer 404 or start pulling it
+            listed = [b for b in candidates if b['available_models'] is not None and variants & b['available_models']]
+            unknown = [b for b in candidates if b['available_models'] is None]
+            candidates = listed or unknown or candidates
+
+        def has_model(backend):
+            return bool(variants & backend['loaded_models'])
+
+        free = [b for b in candidates if b['outstanding'] < OLLAMA_NUM_PARALLEL]
+        pool = [b for b in free if has_model(b)] or free or [b for b in candidates if has_model(b)] or candidates
+        backend = min(pool, key=lambda b: (b['outstanding'], b['last_assigned']))
+        backend['outstanding'] += 1
+        backend['requests'] += 1
+        backend['last_assigned'] = now
+        return backend['base_url']
+
+def is_transient_ollama_error(error):
+    """True for failures worth retrying later: Ollama unreachable, timed out, cut off mid-stream, busy or 5xx."""
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                          requests.exceptions.ChunkedEncodingError)):
+        return True
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return False
+
+def _open_circuit_locked():
+    reopening = _circuit['state'] == 'open'
+    open_seconds = min(OLLAMA_CIRCUIT_MAX_OPEN_SECONDS, _circuit['open_seconds'] * 2) if reopening else OLLAMA_CIRCUIT_OPEN_SECONDS
+    _circuit.update(state='open', open_seconds=open_seconds, open_until=time.monotonic() + open_seconds)
+    logger.warning(f"Ollama circuit breaker open for {open_seconds}s after {_circuit['consecutive_failures']} failures: {_circuit['last_error']}")
+
+def _close_circuit_locked():
+    if _circuit['state'] != 'closed':
+        logger.info("Ollama circuit breaker closed; Ollama is answering again.")
+    _circuit.update(state='closed', consecutive_failures=0, open_seconds=0, open_until=0.0)
+
+def _record_circuit_outcome(error):
+    with _circuit_lock:
+        if error is None or not is_transient_ollama_error(error): # Ollama answered
+            _close_circuit_locked()
+            return
+        _circuit['consecutive_failures'] += 1
+        _circuit['last_error'] = str(error)
+        if _circuit['state'] == 'closed' and _circuit['consecutive_failures'] >= OLLAMA_CIRCUIT_FAILURE_THRESHOLD:
+            _open_circuit_locked()
+
+def ollama_circuit_wait_seconds():
+    """
+    Returns 0 if requests may be sent to Ollama, otherwise the seconds to wait before asking again.
+    Once an open breaker's pause has run out, one caller probes every backend's /api/ps:
+    if any answers the breaker closes, otherwise it stays open for twice as long.
+    """
+    with _circuit_lock:
+        if _circuit['state'] == 'closed':
+            return 0
+        remaining = _circuit['open_until'] - time.monotonic()
+        if remaining > 0:
+            return remaining
+    if not _circuit_probe_lock.acquire(blocking=False):
+        return 1.0 # Another worker is probing right now
+    try:
+        answered = refresh_ollama_backends() is not None
+    finally:
+        _circuit_probe_lock.release()
+    with _circuit_lock:
+        if answered or _circuit['state'] == 'closed':
+            _close_circuit_locked()
+            return 0
+        _open_circuit_locked()
+        return _circuit['open_seconds']
+
+def get_ollama_circuit_state():
+    """Returns a snapshot of the circuit breaker: state, consecutive_failures, seconds_until_probe, last_error."""
+    with _circuit_lock:
+        return {
+            'state': _circuit['state'],
+            'consecutive_failures': _circuit['consecutive_failures'],
+            'seconds_until_probe': max(0.0, _circuit['open_until'] - time.monotonic()) if _circuit['state'] == 'open' else 0.0,
+            'last_error': _circuit['last_error'],
+        }
+
+def _release_backend(base_url, model_name=None, error=None):
+    """Ends a request started with _acquire_backend and records what it says about the backend and the breaker."""
+    _record_circuit_outcome(error)
+    with _backends_lock:
+        backend = _backends[base_url]
+        backend['outstanding'] -= 1
+        if isinstance(error, requests.exceptions.ConnectionError):
+            backend.update(healthy=False, failed_at=time.monotonic(), last_error=str(error))
+            logger.warning(f"Ollama backend {base_url} is unreachable; routing around it for {OLLAMA_BACKEND_RETRY_SECONDS}s: {error}")
+        else: # It answered, even if with an HTTP error
+            backend.update(healthy=True, failed_at=None, last_error=None)
+            if error is None and model_name:
+                backend['loaded_models'].add(model_name) # Running it loaded it
+
+def refresh_ollama_backends():
+    """
+    Polls /api/ps on every backend, updating its health and the models it has loaded.
+    Returns the names of models loaded on any backend, or None if no backend answered.
+    """
+    loaded_anywhere = None
+    for base_url in list(_backends):
+        try:
+            models = ollama_get_json('/api/ps', read_timeout=5, base_url=base_url).get('models', [])
+            names = {model.get('name') or model.get('model') for model in models} - {None}
+        except (requests.exceptions.RequestException, ValueError, AttributeError) as e:
+            with _backends_lock:
+                _backends[base_url].update(healthy=False, failed_at=time.monotonic(), last_error=str(e))
+            logger.warning(f"Ollama backend {base_url} failed its health check: {e}")
+            continue
+        with _backends_lock:
+            _backends[base_url].update(healthy=True, failed_at=None, last_error=None, loaded_models=names)
+        loaded_anywhere = (loaded_anywhere or set()) | names
+    return loaded_anywhere
+
+def get_ollama_backend_states():
+    """Returns a snapshot of each backend's health, load and loaded models."""
+    with _backends_lock:
+        return [{**backend, 'loaded_models': sorted(backend['loaded_models']),
+                 'available_models': sorted(backend['available_models']) if backend['available_models'] is not None else None}
+                for backend in _backends.values()]
+
+def _timeout(read_timeout):
+    return (OLLAMA_CONNECT_TIMEOUT, OLLAMA_READ_TIMEOUT if read_timeout is None else read_timeout)
+
+def _send(method, base_url, path, payload, read_timeout, stream):
+    started = time.perf_counter()
+    try:
+        response = _get_session().request(method, f"{base_url}{path}", json=payload, stream=stream, timeout=_timeout(read_timeout))
+        response.raise_for_status()
+    except requests.exceptions.RequestException:
+        _record_call(method, path, time.perf_counter() - started, ok=False)
+        raise
+    if not stream:
+        _record_call(method, path, time.perf_counter() - started, ok=True)
+    return response
+
+def ollama_request(method, path, payload=None, read_timeout=None, base_url=None, stream=False):
+    """
+    Sends one request to Ollama on the shared session and raises for HTTP errors.
+    Without base_url the request is routed to a backend (by the payload's model, if any).
+    read_timeout bounds the wait for each read (defaults to OLLAMA_READ_TIMEOUT).
+    Returns the requests.Response; with stream=True the caller must consume or close it.
+    Streaming generations should use ollama_stream, which keeps the backend counted as busy until done.
+    """
+    if base_url is not None:
+        return _send(method, base_url, path, payload, read_timeout, stream)
+    model_name = (payload or {}).get('model') or (payload or {}).get('name')
+    base_url = _acquire_backend(model_name)
+    try:
+        response = _send(method, base_url, path, payload, read_timeout, stream)
+    except requests.exceptions.RequestException as e:
+        _release_backend(base_url, error=e)
+        raise
+    _release_backend(base_url, model_name if path in ('/api/generate', '/api/chat') else None)
+    return response
+
+def ollama_get_json(path, read_timeout=OLLAMA_METADATA_READ_TIMEOUT, base_url=None):
+    """GETs an Ollama endpoint (e.g. /api/tags, /api/ps) and returns the decoded JSON."""
+    return ollama_request('GET', path, read_timeout=read_timeout, base_url=base_url).json()
+
+def ollama_get_json_all(path, read_timeout=OLLAMA_METADATA_READ_TIMEOUT):
+    """
+    GETs path from every backend and returns the decoded JSON of those that answered.
+    Raises the last error if none did.
+    """
+    results, last_error = [], None
+    for base_url in list(_backends):
+        try:
+            results.append(ollama_get_json(path, read_timeout=read_timeout, base_url=base_url))
+        except requests.exceptions.RequestException as e:
+            last_error = e
+    if not results and last_error is not None:
+        raise last_error
+    return results
+
+def ollama_post_json(path, payload, read_timeout=None, base_url=None):
+    """POSTs to an Ollama endpoint without streaming and returns the decoded JSON."""
+    return ollama_request('POST', path, payload=payload, read_timeout=read_timeout, base_url=base_url).json()
+
+def abort_ollama_stream(stream_id):
+    """
+    Cuts off the ollama_stream started with stream_id, from any thread. The socket is shut down,
+    which wakes the reader even while Ollama is still evaluating the prompt; it then gets a
+    requests exception. Returns True if such a stream was open.
+    """
+    with _open_streams_lock:
+        response = _open_streams.get(stream_id)
+        if response is None:
+            return False
+        _aborted_streams.add(stream_id)
+    # response.close() would wait for the reading thread; shutting the socket down doesn't.
+    sock = getattr(getattr(response.raw, '_connection', None), 'sock', None)
+    try:
+        if sock is not None:
+            sock.shutdown(socket.SHUT_RDWR)
+        else:
+            response.close()
+    except OSError:
+        pass
+    return True
+
+def ollama_stream(path, payload, read_timeout=None, base_url=None, timing=None, stream_id=None):
+    """
+    POSTs a streaming request (/api/generate or /api/chat) and yields each NDJSON object.
+    Without base_url the request is routed to a backend by model, which stays counted as busy
+    until the stream ends. With a stream_id, abort_ollama_stream(stream_id) can end it early.
+    The body is read in OLLAMA_STREAM_CHUNK_SIZE pieces and split into lines here, rather than
+    via iter_lines' 512-byte reads; chunked responses still yield as soon as Ollama flushes.
+    If a dict is passed as timing it is filled in as the call progresses:
+      backend             - base URL of the Ollama server that handled it
+      response_seconds    - until response headers arrived (includes queueing in Ollama)
+      first_chunk_seconds - until the first object was decoded (time to first token)
+      total_seconds       - until the stream ended
+    """
+    timing = timing if timing is not None else {}
+    model_name = payload.get('model')
+    routed = base_url is None
+    if routed:
+        base_url = _acquire_backend(model_name)
+    timing['backend'] = base_url
+    started = time.perf_counter()
+    error = None
+    response = None
+    ok = False
+    saw_done = False
+    try:
+        response = _send('POST', base_url, path, {**payload, 'stream': True}, read_timeout, stream=True)
+        timing['response_seconds'] = time.perf_counter() - started
+        if stream_id is not None:
+            with _open_streams_lock:
+                _open_streams[stream_id] = response
+        buffer = b''
+        for data in response.iter_content(chunk_size=OLLAMA_STREAM_CHUNK_SIZE):
+            buffer += data
+            *lines, buffer = buffer.split(b'\n')
+            for line in lines:
+                chunk = _decode_ndjson_line(line, path)
+                if chunk is None:
+                    continue
+                if 'first_chunk_seconds' not in timing:
+                    timing['first_chunk_seconds'] = time.perf_counter() - started
+                saw_done = bool(chunk.get('done'))
+                yield chunk
+        chunk = _decode_ndjson_line(buffer, path)
+        if chunk is not None:
+            yield chunk
+        ok = True
+    except GeneratorExit: # The caller stopped reading (normally after 'done')
+        ok = True
+        if saw_done:
+            # Only the chunked-encoding terminator is left; reading it lets the connection
+            # go back to the pool instead of being closed.
+            try:
+                for _ in response.iter_content(chunk_size=OLLAMA_STREAM_CHUNK_SIZE):
+                    pass
+            except requests.exceptions.RequestException:
+                pass
+        raise
+    except requests.exceptions.RequestException as e:
+        with _open_streams_lock:
+            aborted = stream_id in _aborted_streams
+        if aborted: # Says nothing about the backend's health
+            ok = True
+        else:
+            error = e
+        raise
+    finally:
+        if stream_id is not None:
+            with _open_streams_lock:
+                _open_streams.pop(stream_id, None)
+                _aborted_streams.discard(stream_id)
+        if response is not None:
+            response.close()
+            timing['total_seconds'] = time.perf_counter() - started
+            _record_call('POST', path, timing['total_seconds'], ok=ok)
+        if routed:
+            _release_backend(base_url, model_name, error=error)
+
+def _decode_ndjson_line(line, path):
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        return json.loads(line)
+    except json.JSONDecodeError:
+        logger.warning(f"Skipping non-JSON line from Ollama {path} stream: {line[:200]!r}")
+        return None
@@ -1,8 +1,10 @@
 import requests
 import json
+import time
 from flask import current_app
 
 from .database import get_cached_model_context_window, cache_model_context_window
+from .ollama_client import ollama_post_json, refresh_ollama_backends, get_ollama_backend_states, model_name_variants
 
 def get_ollama_model_details(model_name: str) -> dict | None:
     """
@@ -18,17 +20,13 @@ def get_ollama_model_details(model_name: str) -> dict | None:
         current_app.logger.error("get_ollama_model_details: model_name cannot be empty.")
         return None
 
-    ollama_base_url = current_app.config.get('OLLAMA_API_BASE_URL', 'http://localhost:11434')
-    show_url = f"{ollama_base_url}/api/show"
+    show_url = "/api/show" # Routed by ollama_client to a backend whose /api/tags lists the model
     payload = {"name": model_name}
 
     current_app.logger.info(f"Fetching details for model '{model_name}' from {show_url}")
 
     try:
-        response = requests.post(show_url, json=payload, timeout=10) # Added timeout
-        response.raise_for_status()  # Raises an HTTPError for bad responses (4XX or 5XX)
-
-        details = response.json()
+        details = ollama_post_json(show_url, payload, read_timeout=10) # Raises an HTTPError for bad responses (4XX or 5XX)
         current_app.logger.info(f"Successfully fetched details for model '{model_name}'")
         # current_app.logger.debug(f"Model details for '{model_name}': {json.dumps(details, indent=2)}")
         return details
@@ -49,9 +47,62 @@ def get_ollama_model_details(model_name: str) -> dict | None:
         return None
     except json.JSONDecodeError as e:
         current_app.logger.error(f"Error decoding JSON response for model '{model_name}': {e}")
-        current_app.logger.error(f"Response text: {response.text if 'response' in locals() else 'Response object not available'}")
         return None
 
+def get_loaded_ollama_models() -> list[str] | None:
+    """
+    Lists the models loaded in memory on any Ollama backend, via their /api/ps endpoints.
+    Also refreshes the health and loaded-model state used to route requests between backends.
+
+    Returns:
+        A list of model names (e.g. 'llama3:latest') if any backend answered, None otherwise.
+    """
+    loaded_models = refresh_ollama_backends()
+    if loaded_models is None:
+        current_app.logger.warning("Could not list loaded models: no Ollama backend answered /api/ps.")
+        return None
+    return sorted(loaded_models)
+
+def warm_ollama_model(model_name: str, keep_alive_seconds: int) -> float | None:
+    """
+    Loads a model into memory ahead of use: a /api/generate call without a prompt only loads it.
+    It then stays loaded for keep_alive_seconds. Routed like a request, so the backend that
+    gets it is the one requests for the model will prefer.
+
+    Returns:
+        The seconds the load took, or None if it failed.
+    """
+    started = time.perf_counter()
+    try:
+        ollama_post_json('/api/generate', {'model': model_name, 'keep_alive': int(keep_alive_seconds), 'stream': False})
+    except (requests.exceptions.RequestException, json.JSONDecodeError) as e:
+        current_app.logger.warning(f"Could not preload model '{model_name}': {e}")
+        return None
+    load_seconds = time.perf_counter() - started
+    current_app.logger.info(f"Preloaded model '{model_name}' in {load_seconds:.1f}s (keep_alive {int(keep_alive_seconds)}s).")
+    return load_seconds
+
+def release_ollama_model(model_name: str) -> int:
+    """
+    Unloads a model (keep_alive 0) from every backend that has it loaded.
+
+    Returns:
+        The number of backends it was unloaded from.
+    """
+    variants = set(model_name_variants(model_name))
+    released = 0
+    for backend in get_ollama_backend_states():
+        for loaded_name in variants.intersection(backend['loaded_models']):
+            try:
+                ollama_post_json('/api/generate', {'model': loaded_name, 'keep_alive': 0, 'stream': False}, base_url=backend['base_url'])
+                released += 1
+            except (requests.exceptions.RequestException, json.JSONDecodeError) as e:
+                current_app.logger.warning(f"Could not unload model '{loaded_name}' from {backend['base_url']}: {e}")
+    if released:
+        refresh_ollama_backends() # So routing stops preferring the backends it was on
+        current_app.logger.info(f"Unloaded model '{model_name}' from {released} backend(s).")
+    return released
+
 def parse_model_context_window(model_details: dict) -> int | None:
     """
     Parses the model details to find the context window size (num_ctx).
@@ -2,37 +2,45 @@ import json
 import os
 import requests
 from flask import current_app # For potential future use with app_context in _call_llm
-from forllm_server.config import OLLAMA_GENERATE_URL
+from forllm_server.ollama_client import ollama_stream, is_transient_ollama_error
 from .database import get_subforum_details # New import
 
 # Helper function for LLM calls
-def _call_llm(prompt, model_id, flask_app): # flask_app for context, if needed later
+def _call_llm(prompt, model_id, flask_app, cancel_event=None, stream_id=None): # flask_app for context, if needed later
     print(f"Calling LLM: Model '{model_id}', Prompt (start): '{prompt[:200]}...'")
+    cancelled = {"status": "error", "error_message": "Cancelled", "text": None}
+    if cancel_event is not None and cancel_event.is_set():
+        return cancelled
     try:
-        response = requests.post(
-            OLLAMA_GENERATE_URL,
-            json={'model': model_id, 'prompt': prompt, 'stream': False},
-            headers={'Content-Type': 'application/json'},
-            timeout=300  # 5 minutes, adjust as needed
-        )
-        response.raise_for_status()
-        response_data = response.json()
-        response_text = response_data.get('response', '')
+        # Streamed with stream_id so cancelling the request (llm_queue.abort_running_llm_request) cuts the call off.
+        response_text = ''
+        for chunk in ollama_stream('/api/generate', {'model': model_id, 'prompt': prompt},
+                                   read_timeout=300, stream_id=stream_id): # 5 minutes between reads, adjust as needed
+            if cancel_event is not None and cancel_event.is_set():
+                return cancelled
+            response_text += chunk.get('response', '')
         if not response_text:
             print("Warning: LLM returned empty response.")
             return {"status": "error", "error_message": "LLM returned empty response", "text": None}
         return {"status": "success", "text": response_text}
     except requests.exceptions.Timeout:
         print("Error: LLM request timed out.")
-        return {"status": "error", "error_message": "LLM request timed out", "text": None}
+        return {"status": "error", "error_message": "LLM request timed out", "text": None, "retryable": True}
     except requests.exceptions.RequestException as e:
+        if cancel_event is not None and cancel_event.is_set(): # The stream was aborted on purpose
+            return cancelled
         print(f"Error: LLM request failed: {e}")
-        return {"status": "error", "error_message": f"LLM request failed: {str(e)}", "text": None}
+        return {"status": "error", "error_message": f"LLM request failed: {str(e)}", "text": None,
+                "retryable": is_transient_ollama_error(e)}
     except json.JSONDecodeError:
         print("Error: Could not decode JSON response from LLM.")
         return {"status": "error", "error_message": "Invalid JSON response from LLM", "text": None}
 
-def generate_persona_from_details(request_details, flask_app):
+def generate_persona_from_details(request_details, flask_app, cancel_event=None, stream_id=None):
+    """
+    Two-stage persona generation (expansion, then refinement). When run from the queue, cancel_event and
+    stream_id (the request_id) let a cancel stop it between stages and abort the Ollama call in progress.
+    """
     generation_type = request_details.get('generation_type', 'from_name_and_description') # Default
     input_details = request_details.get('input_details', {})
     llm_model_for_generation = request_details.get('llm_model_for_generation')
@@ -93,11 +101,11 @@ def generate_persona_from_details(request_details, flask_app):
         expansion_prompt = expansion_prompt.replace("{{name_hint}}", name_hint or '')
         expansion_prompt = expansion_prompt.replace("{{description_hint}}", description_hint or '')
     
-    expansion_result = _call_llm(expansion_prompt, llm_model_for_generation, flask_app) 
+    expansion_result = _call_llm(expansion_prompt, llm_model_for_generation, flask_app, cancel_event, stream_id)
     if expansion_result["status"] == "error":
         return {"status": "error", "error_message": f"Expansion stage failed: {expansion_result['error_message']}", 
                 "persona_name": name_hint or "Expansion Failed", 
-                "prompt_instructions": expansion_result.get('text', '')}
+                "prompt_instructions": expansion_result.get('text', ''), "retryable": expansion_result.get('retryable', False)}
     brainstormed_text_from_stage_1 = expansion_result["text"]
     print(f"Stage 1 (Expansion) successful. Brainstormed text length: {len(brainstormed_text_from_stage_1)}")
 
@@ -134,11 +142,11 @@ def generate_persona_from_details(request_details, flask_app):
     refinement_prompt = refinement_prompt.replace("{{tone_preference}}", output_preferences.get('tone_preference', ''))
     refinement_prompt = refinement_prompt.replace("{{length_preference}}", output_preferences.get('length_preference', ''))
 
-    refinement_result = _call_llm(refinement_prompt, llm_model_for_generation, flask_app)
+    refinement_result = _call_llm(refinement_prompt, llm_model_for_generation, flask_app, cancel_event, stream_id)
     if refinement_result["status"] == "error":
         return {"status": "error", "error_message": f"Refinement stage failed: {refinement_result['error_message']}", 
                 "persona_name": name_hint or "Refinement Failed", 
-                "prompt_instructions": refinement_result.get('text', '')}
+                "prompt_instructions": refinement_result.get('text', ''), "retryable": refinement_result.get('retryable', False)}
     final_instructions_text = refinement_result["text"]
     print(f"Stage 2 (Refinement) successful. Final text length: {len(final_instructions_text)}")
     
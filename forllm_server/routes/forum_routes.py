@@ -11,9 +11,11 @@ from ..database import (
     set_subforum_default_persona, get_subforum_default_persona, update_user_activity,
     get_subforums_with_status, get_topics_for_subforum_with_status,
     get_persona, # Import get_persona for validation
-    soft_delete_post, hard_delete_topic, update_post
+    soft_delete_post, hard_delete_topic, update_post, cancel_llm_request, set_post_thread_path
 )
 from ..markdown_config import md
+from ..llm_queue import notify_llm_queue, abort_running_llm_request
+from ..llm_processing import update_post_token_counts
 from ..config import CURRENT_USER_ID, DEFAULT_MODEL
 
 forum_api_bp = Blueprint('forum_api', __name__, url_prefix='/api')
@@ -166,6 +168,8 @@ def handle_topics(subforum_id):
             cursor.execute('INSERT INTO posts (topic_id, user_id, content, tagged_personas_in_content, tagged_files_in_content) VALUES (?, ?, ?, ?, ?)',
                            (topic_id, CURRENT_USER_ID, content, tagged_personas_json, tagged_files_json))
             post_id = cursor.lastrowid
+            set_post_thread_path(db, post_id)
+            update_post_token_counts(db, [post_id])
 
             # --- Create LLM Requests for tagged personas ---
             parent_request_id_map = {} # Maps persona_id to its created llm_request_id
@@ -198,6 +202,8 @@ def handle_topics(subforum_id):
             # --- End LLM Requests ---
 
             db.commit()
+            if parent_request_id_map:
+                notify_llm_queue()
             return jsonify({'topic_id': topic_id, 'title': title, 'initial_post_id': post_id, 'tagged_personas': unique_tagged_persona_ids}), 201
         except Exception as e:
             db.rollback()
@@ -301,6 +307,8 @@ def handle_posts(topic_id):
             cursor.execute('INSERT INTO posts (topic_id, user_id, parent_post_id, content, tagged_personas_in_content, tagged_files_in_content) VALUES (?, ?, ?, ?, ?, ?)',
                            (topic_id, CURRENT_USER_ID, parent_post_id, content, tagged_personas_json, tagged_files_json))
             post_id = cursor.lastrowid
+            set_post_thread_path(db, post_id)
+            update_post_token_counts(db, [post_id])
 
             # --- Create LLM Requests for tagged personas ---
             parent_request_id_map = {}
@@ -333,6 +341,8 @@ def handle_posts(topic_id):
             # --- End LLM Requests ---
             
             db.commit()
+            if parent_request_id_map:
+                notify_llm_queue()
             
             cursor.execute("SELECT p.*, u.username FROM posts p JOIN users u ON p.user_id = u.user_id WHERE p.post_id = ?", (post_id,))
             new_post_row = cursor.fetchone()
@@ -350,33 +360,20 @@ def handle_posts(topic_id):
             current_app.logger.error(f"Error creating post reply or LLM requests: {e}")
             return jsonify({'error': f'Failed to create post: {e}'}), 500
     else: # GET
+        # thread_path order lists each thread depth-first, replies in posting order; depth is its number of segments
         cursor.execute("""
-            WITH RECURSIVE ThreadCTE AS (
-                SELECT
-                    p.post_id, p.topic_id, p.user_id, u.username, p.parent_post_id, p.content, p.created_at,
-                    p.is_llm_response, p.llm_model_id, p.llm_persona_id,
-                    per.name AS persona_name,
-                    CAST(p.created_at AS TEXT) AS sort_key,
-                    0 AS depth
-                FROM posts p
-                JOIN users u ON p.user_id = u.user_id
-                LEFT JOIN personas per ON CAST(p.llm_persona_id AS INTEGER) = per.persona_id
-                WHERE p.topic_id = ? AND p.parent_post_id IS NULL
-                UNION ALL
-                SELECT
-                    p2.post_id, p2.topic_id, p2.user_id, u2.username, p2.parent_post_id, p2.content, p2.created_at,
-                    p2.is_llm_response, p2.llm_model_id, p2.llm_persona_id,
-                    per2.name AS persona_name,
-                    cte.sort_key || '_' || CAST(p2.created_at AS TEXT),
-                    cte.depth + 1
-                FROM posts p2
-                JOIN users u2 ON p2.user_id = u2.user_id
-                JOIN ThreadCTE cte ON p2.parent_post_id = cte.post_id
-                LEFT JOIN personas per2 ON CAST(p2.llm_persona_id AS INTEGER) = per2.persona_id
-                WHERE p2.topic_id = ?
-            )
-            SELECT * FROM ThreadCTE ORDER BY sort_key;
-        """, (topic_id, topic_id))
+            SELECT
+                p.post_id, p.topic_id, p.user_id, u.username, p.parent_post_id, p.content, p.created_at,
+                p.is_llm_response, p.llm_model_id, p.llm_persona_id,
+                per.name AS persona_name,
+                p.thread_path AS sort_key,
+                length(p.thread_path) - length(replace(p.thread_path, '/', '')) - 1 AS depth
+            FROM posts p
+            JOIN users u ON p.user_id = u.user_id
+            LEFT JOIN personas per ON CAST(p.llm_persona_id AS INTEGER) = per.persona_id
+            WHERE p.topic_id = ?
+            ORDER BY p.thread_path;
+        """, (topic_id,))
         posts_raw = cursor.fetchall()
         processed_posts = []
         for row in posts_raw:
@@ -756,6 +753,7 @@ def edit_post(post_id):
 
     # 4. Queue LLM requests for genuinely new tags
     try:
+        update_post_token_counts(db, [post_id])
         parent_request_id_map = {}
         for req_info in llm_requests_to_create:
             p_id = req_info['p_id']
@@ -786,6 +784,8 @@ def edit_post(post_id):
             parent_request_id_map[p_id] = cursor.lastrowid
         
         db.commit()
+        if parent_request_id_map:
+            notify_llm_queue()
     except Exception as e:
         db.rollback()
         current_app.logger.error(f"Error creating LLM requests for edited post {post_id}: {e}")
@@ -844,7 +844,15 @@ def delete_post(post_id):
     if root_post and root_post['post_id'] == post_id:
         return jsonify({'error': 'Cannot delete the root post of a topic. Please delete the topic instead.'}), 400
 
+    # soft_delete_post drops queued requests for the post; stop any that are already generating.
+    cursor.execute("SELECT request_id FROM llm_requests WHERE post_id_to_respond_to = ? AND status = 'processing'", (post_id,))
+    for running_request in cursor.fetchall():
+        cancel_llm_request(db, running_request['request_id'])
+        abort_running_llm_request(running_request['request_id'])
+
     if soft_delete_post(post_id):
+        update_post_token_counts(db, [post_id])
+        db.commit()
         return jsonify({'message': f'Post {post_id} soft-deleted successfully'}), 200
     else:
         return jsonify({'error': 'Failed to soft-delete post'}), 500
\ No newline at end of file
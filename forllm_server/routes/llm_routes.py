@@ -1,10 +1,15 @@
 import sqlite3
 import requests
 import math # Import math for ceiling function
-from flask import Blueprint, request, jsonify, current_app # Added current_app
-from ..database import get_db, get_effective_persona_for_subforum, get_persona # Import get_persona
-from ..config import OLLAMA_TAGS_URL, DEFAULT_MODEL, CURRENT_USER_ID # Added CURRENT_USER_ID
+from flask import Blueprint, request, jsonify, current_app, Response # Added current_app
+from ..database import (get_db, get_effective_persona_for_subforum, get_persona, bump_llm_request_priority, cancel_llm_request,
+                        get_llm_response_cache_stats, get_llm_queue_metrics) # Import get_persona
+from ..config import DEFAULT_MODEL, CURRENT_USER_ID, LLM_PRIORITY_BUMPED, DATABASE, LLM_STREAM_HEARTBEAT_SECONDS # Added CURRENT_USER_ID
 from ..ollama_utils import get_model_context_window # Changed import
+from ..llm_queue import notify_llm_queue, abort_running_llm_request, get_llm_queue_etas
+from ..ollama_client import ollama_get_json_all
+from ..llm_streams import get_llm_stream_snapshot, iter_llm_stream_events, format_sse_event
+from ..tokenizer_utils import get_token_count_cache_stats
 
 llm_api_bp = Blueprint('llm_api', __name__, url_prefix='/api')
 
@@ -26,6 +31,7 @@ def request_llm_response(post_id):
 
     # Persona selection logic
     data = request.get_json(silent=True) or {}
+    use_cache = data.get('use_cache', True) is not False # Opt out to force a fresh generation
     persona_id = data.get('persona_id')
     if persona_id:
         persona_row = get_effective_persona_for_subforum(topic_id, persona_id)
@@ -36,11 +42,12 @@ def request_llm_response(post_id):
 
     try:
         cursor.execute("""
-            INSERT INTO llm_requests (post_id_to_respond_to, status, llm_model, llm_persona)
-            VALUES (?, 'pending', ?, ?)
-        """, (post_id, llm_model_to_use, persona_id_to_use))
+            INSERT INTO llm_requests (post_id_to_respond_to, status, llm_model, llm_persona, use_cache)
+            VALUES (?, 'pending', ?, ?, ?)
+        """, (post_id, llm_model_to_use, persona_id_to_use, 1 if use_cache else 0))
         request_id = cursor.lastrowid
         db.commit()
+        notify_llm_queue()
         print(f"Queued LLM request {request_id} for post {post_id} using model {llm_model_to_use} and persona_id {persona_id_to_use}")
         return jsonify({'message': 'LLM response requested successfully', 'request_id': request_id}), 202
     except Exception as e:
@@ -50,10 +57,11 @@ def request_llm_response(post_id):
 @llm_api_bp.route('/ollama/models', methods=['GET'])
 def get_ollama_models():
     try:
-        response = requests.get(OLLAMA_TAGS_URL, timeout=10)
-        response.raise_for_status()
-        models_data = response.json()
-        model_names = [model['name'] for model in models_data.get('models', [])]
+        model_names = []
+        for models_data in ollama_get_json_all('/api/tags'): # Union of the models on every backend
+            for model in models_data.get('models', []):
+                if model['name'] not in model_names:
+                    model_names.append(model['name'])
         return jsonify(model_names)
     except requests.exceptions.RequestException as e:
         print(f"Error fetching Ollama models: {e}")
@@ -123,6 +131,21 @@ def get_queue():
             lr.post_id_to_respond_to,
             lr.requested_at,
             lr.status,
+            lr.priority,
+            lr.attempt_count,
+            lr.last_error,
+            lr.next_attempt_at,
+            lr.cache_status,
+            lr.coalesced_into,
+            lr.queue_wait_seconds,
+            lr.prompt_build_seconds,
+            lr.time_to_first_token_seconds,
+            lr.total_duration,
+            lr.load_duration,
+            lr.prompt_eval_count,
+            lr.prompt_eval_duration,
+            lr.eval_count,
+            lr.eval_duration,
             lr.llm_model,
             lr.llm_persona, -- This is the persona_id
             lr.prompt_token_breakdown,
@@ -139,12 +162,166 @@ def get_queue():
     # Convert Row objects to dictionaries
     queue_list = [dict(item) for item in queue_items]
 
+    # Position and estimated start/finish for requests still waiting or running
+    etas = get_llm_queue_etas(db)
+    for item in queue_list:
+        item.update(etas.get(item['request_id'], {}))
+
     return jsonify({
         'items': queue_list,
         'total_pages': total_pages,
         'current_page': page
     })
 
+# Queue totals by status plus response cache effectiveness (hits, coalesced requests, generation time saved)
+@llm_api_bp.route('/queue/stats', methods=['GET'])
+def get_queue_stats():
+    db = get_db()
+    try:
+        cursor = db.execute("SELECT status, COUNT(*) AS count FROM llm_requests GROUP BY status")
+        status_counts = {row['status']: row['count'] for row in cursor.fetchall()}
+        return jsonify(status_counts=status_counts, response_cache=get_llm_response_cache_stats(db),
+                       token_count_cache=get_token_count_cache_stats())
+    except sqlite3.Error as e:
+        print(f"Database error fetching queue stats: {e}")
+        return jsonify(error="Failed to fetch queue stats."), 500
+
+def _prometheus_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_prometheus_metrics(metrics):
+    """Renders get_llm_queue_metrics output in the Prometheus text exposition format."""
+    lines = []
+    def metric(name, metric_type, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in samples:
+            if value is None:
+                continue
+            label_text = ",".join(f'{key}="{_prometheus_label(val)}"' for key, val in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+    window = f"{metrics['window_hours']}h"
+    metric('forllm_llm_requests', 'gauge', 'LLM requests currently in each status.',
+           [({'status': status}, count) for status, count in sorted(metrics['backlog'].items())])
+    # A gauge, not a counter: it counts stored rows, which drop when topics or requests are deleted
+    metric('forllm_llm_requests_finished', 'gauge', 'Stored LLM requests that reached a final status.',
+           [({'status': status}, count) for status, count in metrics['totals'].items()])
+    metric('forllm_llm_error_rate', 'gauge', 'Share of finished LLM requests that failed.',
+           [({'window': window}, metrics['error_rate'])])
+    metric('forllm_llm_queue_wait_seconds', 'gauge', 'Time from request to (last) claim, by quantile.',
+           [({'window': window, 'quantile': q}, v) for q, v in metrics['queue_wait_seconds'].items()])
+    metric('forllm_llm_generation_seconds', 'gauge', 'Ollama total_duration of completed requests, by quantile.',
+           [({'window': window, 'quantile': q}, v) for q, v in metrics['generation_seconds'].items()])
+    metric('forllm_llm_eval_tokens_per_second', 'gauge', 'Decode throughput per model.',
+           [({'window': window, 'model': m['model']}, m['eval_tokens_per_second']) for m in metrics['models']])
+    metric('forllm_llm_prompt_eval_tokens_per_second', 'gauge', 'Prompt evaluation throughput per model.',
+           [({'window': window, 'model': m['model']}, m['prompt_eval_tokens_per_second']) for m in metrics['models']])
+    return "\n".join(lines) + "\n"
+
+# Throughput, latency percentiles, per-model tokens/s, error rate and backlog; ?format=prometheus for scraping
+@llm_api_bp.route('/queue/metrics', methods=['GET'])
+def get_queue_metrics():
+    window_hours = request.args.get('hours', 24, type=int)
+    if window_hours is None or window_hours <= 0:
+        return jsonify(error="hours must be a positive integer."), 400
+    try:
+        metrics = get_llm_queue_metrics(get_db(), window_hours)
+    except sqlite3.Error as e:
+        print(f"Database error computing queue metrics: {e}")
+        return jsonify(error="Failed to compute queue metrics."), 500
+    if request.args.get('format') == 'prometheus':
+        return Response(_format_prometheus_metrics(metrics), mimetype='text/plain; version=0.0.4')
+    return jsonify(metrics)
+
+# Moves a queued request ahead of bulk work (e.g. a reply to the post being read)
+@llm_api_bp.route('/queue/<int:request_id>/bump', methods=['POST'])
+def bump_queue_request(request_id):
+    db = get_db()
+    try:
+        if not bump_llm_request_priority(db, request_id, LLM_PRIORITY_BUMPED):
+            cursor = db.execute("SELECT status FROM llm_requests WHERE request_id = ?", (request_id,))
+            row = cursor.fetchone()
+            if not row:
+                return jsonify(error=f"Request ID {request_id} not found."), 404
+            return jsonify(error=f"Request {request_id} is no longer queued (status: {row['status']})."), 409
+        print(f"Bumped LLM request {request_id} to priority {LLM_PRIORITY_BUMPED}.")
+        return jsonify(request_id=request_id, priority=LLM_PRIORITY_BUMPED)
+    except sqlite3.Error as e:
+        db.rollback()
+        print(f"Database error bumping request {request_id}: {e}")
+        return jsonify(error="Failed to bump request."), 500
+
+# Cancels a queued or running request and everything chained behind it; a running generation is cut off
+@llm_api_bp.route('/queue/<int:request_id>', methods=['DELETE'])
+def cancel_queue_request(request_id):
+    db = get_db()
+    try:
+        previous_status, cancelled_ids = cancel_llm_request(db, request_id)
+    except sqlite3.Error as e:
+        print(f"Database error cancelling request {request_id}: {e}")
+        return jsonify(error="Failed to cancel request."), 500
+    if previous_status is None:
+        return jsonify(error=f"Request ID {request_id} not found."), 404
+    if not cancelled_ids:
+        return jsonify(error=f"Request {request_id} has already finished (status: {previous_status})."), 409
+    if previous_status == 'processing':
+        abort_running_llm_request(request_id) # Another server process notices via its lease heartbeat instead
+    print(f"Cancelled LLM request(s) {cancelled_ids}.")
+    return jsonify(request_id=request_id, status='cancelled', cancelled_request_ids=cancelled_ids)
+
+def _sse_response(event_iterator):
+    return Response(event_iterator, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Server-Sent Events: relays the reply for one request token by token as Ollama generates it
+@llm_api_bp.route('/queue/<int:request_id>/stream', methods=['GET'])
+def stream_queue_request(request_id):
+    db = get_db()
+    cursor = db.cursor()
+    cursor.execute("SELECT status, partial_response, error_message FROM llm_requests WHERE request_id = ?", (request_id,))
+    request_row = cursor.fetchone()
+    if not request_row:
+        return jsonify(error=f"Request ID {request_id} not found."), 404
+    request_row = dict(request_row)
+
+    def generate():
+        if get_llm_stream_snapshot(request_id) is None:
+            # Not streaming in this process (yet): report what the DB knows first.
+            if request_row['partial_response']:
+                yield format_sse_event('start', {'request_id': request_id})
+                yield format_sse_event('token', {'request_id': request_id, 'text': request_row['partial_response']})
+            if request_row['status'] in ('complete', 'error', 'cancelled'):
+                yield format_sse_event('done', {'request_id': request_id, 'status': request_row['status'], 'new_post_id': None, 'error': request_row['error_message']})
+                return
+
+        finished_elsewhere = {}
+        def check_finished_elsewhere():
+            # Catches requests that finish without a live stream here (e.g. persona generation, other processes).
+            if get_llm_stream_snapshot(request_id) is not None:
+                return False
+            status_db = sqlite3.connect(DATABASE)
+            try:
+                row = status_db.execute("SELECT status, error_message FROM llm_requests WHERE request_id = ?", (request_id,)).fetchone()
+            finally:
+                status_db.close()
+            if row is None or row[0] in ('complete', 'error', 'cancelled'):
+                finished_elsewhere.update(status=row[0] if row else 'error', error=row[1] if row else 'Request was deleted.')
+                return True
+            return False
+
+        yield from iter_llm_stream_events(lambda stream: stream['request_id'] == request_id, LLM_STREAM_HEARTBEAT_SECONDS,
+                                          stop_when_finished=True, on_heartbeat=check_finished_elsewhere)
+        if finished_elsewhere:
+            yield format_sse_event('done', {'request_id': request_id, 'status': finished_elsewhere['status'], 'new_post_id': None, 'error': finished_elsewhere['error']})
+
+    return _sse_response(generate())
+
+# Server-Sent Events: relays every reply being generated for posts in a topic (used by the topic view)
+@llm_api_bp.route('/topics/<int:topic_id>/stream', methods=['GET'])
+def stream_topic_responses(topic_id):
+    return _sse_response(iter_llm_stream_events(lambda stream: stream['topic_id'] == topic_id, LLM_STREAM_HEARTBEAT_SECONDS))
+
 # New route to get the full prompt for a specific queued request
 @llm_api_bp.route('/queue/<int:request_id>/prompt', methods=['GET'])
 def get_queue_prompt(request_id):
@@ -270,6 +447,7 @@ def tag_persona_on_post(post_id):
         request_id = cursor.lastrowid
         
         db.commit()
+        notify_llm_queue()
         
         return jsonify({
             'message': 'Persona tagged successfully and LLM request created.',
@@ -5,6 +5,8 @@ from forllm_server.database import get_db, list_personas # Import list_personas
 # CURRENT_USER_ID might be used later for ownership or logging, keep if part of standard imports
 from forllm_server.config import CURRENT_USER_ID 
 from forllm_server.config import DEFAULT_MODEL # Import for fallback
+from forllm_server.config import LLM_PRIORITY_BULK
+from forllm_server.llm_queue import notify_llm_queue
 
 persona_routes_bp = Blueprint('persona_routes_bp', __name__, url_prefix='/api/personas')
 
@@ -62,12 +64,13 @@ def generate_persona_from_details_api():
         # post_id_to_respond_to is NULL because this is not a reply to a post.
         # llm_persona is also NULL because we are generating a persona, not using one.
         cursor.execute("""
-            INSERT INTO llm_requests (request_type, request_params, status, llm_model, post_id_to_respond_to, llm_persona)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, ('generate_persona', request_params_json, 'pending', llm_model_for_generation, None, None))
+            INSERT INTO llm_requests (request_type, request_params, status, llm_model, post_id_to_respond_to, llm_persona, priority)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, ('generate_persona', request_params_json, 'pending', llm_model_for_generation, None, None, LLM_PRIORITY_BULK))
         
         request_id = cursor.lastrowid
         db.commit()
+        notify_llm_queue()
         
         print(f"Persona generation request queued. Request ID: {request_id}, Model: {llm_model_for_generation}")
         return jsonify({"message": "Persona generation queued", "request_id": request_id}), 202
@@ -130,11 +133,12 @@ def generate_subforum_expert_persona_api():
         db = get_db()
         cursor = db.cursor()
         cursor.execute("""
-            INSERT INTO llm_requests (request_type, request_params, status, llm_model, post_id_to_respond_to, llm_persona)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, ('generate_persona', request_params_json, 'pending', llm_model_for_generation, None, None))
+            INSERT INTO llm_requests (request_type, request_params, status, llm_model, post_id_to_respond_to, llm_persona, priority)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, ('generate_persona', request_params_json, 'pending', llm_model_for_generation, None, None, LLM_PRIORITY_BULK))
         request_id = cursor.lastrowid
         db.commit()
+        notify_llm_queue()
         
         print(f"Subforum expert persona generation queued. Request ID: {request_id}, Subforum ID: {subforum_id}, Model: {llm_model_for_generation}")
         return jsonify({"message": "Subforum expert persona generation queued", "request_id": request_id}), 202
@@ -187,11 +191,12 @@ def generate_expert_persona_for_subforum_api(subforum_id):
         db = get_db()
         cursor = db.cursor()
         cursor.execute("""
-            INSERT INTO llm_requests (request_type, request_params, status, llm_model, post_id_to_respond_to, llm_persona)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, ('generate_persona', request_params_json, 'pending', llm_model_for_generation, None, None))
+            INSERT INTO llm_requests (request_type, request_params, status, llm_model, post_id_to_respond_to, llm_persona, priority)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, ('generate_persona', request_params_json, 'pending', llm_model_for_generation, None, None, LLM_PRIORITY_BULK))
         request_id = cursor.lastrowid
         db.commit()
+        notify_llm_queue()
         
         print(f"Subforum expert persona generation queued via path. Request ID: {request_id}, Subforum ID: {subforum_id}, Model: {llm_model_for_generation}")
         return jsonify({"message": "Subforum expert persona generation queued", "request_id": request_id}), 202
@@ -268,12 +273,13 @@ def generate_subforum_experts_batch_api():
             request_params_json = json.dumps(persona_generation_request_payload)
 
             cursor.execute("""
-                INSERT INTO llm_requests (request_type, request_params, status, llm_model, post_id_to_respond_to, llm_persona)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, ('generate_persona', request_params_json, 'pending', llm_model_for_generation, None, None))
+                INSERT INTO llm_requests (request_type, request_params, status, llm_model, post_id_to_respond_to, llm_persona, priority)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, ('generate_persona', request_params_json, 'pending', llm_model_for_generation, None, None, LLM_PRIORITY_BULK))
             queued_request_ids.append(cursor.lastrowid)
         
         db.commit() # Commit all inserts as a transaction
+        notify_llm_queue()
         
         print(f"Batch subforum expert persona generation queued. Count: {number_to_generate}, Subforum ID: {subforum_id}, Request IDs: {queued_request_ids}")
         return jsonify({
@@ -1,17 +1,26 @@
 import sqlite3
 from flask import Blueprint, request, jsonify
 from ..database import get_db
-from ..scheduler import get_current_status, get_next_schedule_info
+from ..scheduler import get_current_status, get_next_schedule_info, invalidate_schedule_cache, mark_schedule_changed
 from ..config import DAY_MAP
+from ..llm_queue import notify_llm_queue
 
 schedule_api_bp = Blueprint('schedule_api', __name__, url_prefix='/api') # Align prefix with other API blueprints
 
+ADMISSION_POLICIES = ('fit', 'any') # See the schedule table's admission_policy column
+
+def _parse_overrun_grace_minutes(value):
+    grace = int(value)
+    if grace < 0:
+        raise ValueError("Grace minutes can't be negative")
+    return grace
+
 @schedule_api_bp.route('/schedules', methods=['GET']) # Full path for clarity
 def get_schedules():
     db = get_db()
     cursor = db.cursor()
     try:
-        cursor.execute("SELECT id, start_hour, end_hour, days_active, enabled FROM schedule ORDER BY id")
+        cursor.execute("SELECT id, start_hour, end_hour, days_active, enabled, admission_policy, overrun_grace_minutes FROM schedule ORDER BY id")
         schedules = cursor.fetchall()
         return jsonify([dict(row) for row in schedules])
     except Exception as e:
@@ -27,6 +36,8 @@ def add_schedule():
     end_hour = data.get('end_hour')
     days_active_list = data.get('days_active', [])
     enabled = data.get('enabled', True)
+    admission_policy = data.get('admission_policy', 'fit')
+    overrun_grace_minutes = data.get('overrun_grace_minutes', 0)
 
     if start_hour is None or end_hour is None:
         return jsonify({'error': 'Start and end hours are required'}), 400
@@ -40,15 +51,24 @@ def add_schedule():
     if not isinstance(days_active_list, list) or not all(day in DAY_MAP.values() for day in days_active_list):
          return jsonify({'error': 'Invalid days_active format. Must be a list of valid day abbreviations (Mon, Tue, etc.)'}), 400
     days_active_str = ",".join(sorted(days_active_list, key=list(DAY_MAP.values()).index))
+    if admission_policy not in ADMISSION_POLICIES:
+        return jsonify({'error': f"Invalid admission_policy. Must be one of: {', '.join(ADMISSION_POLICIES)}"}), 400
+    try:
+        overrun_grace_minutes = _parse_overrun_grace_minutes(overrun_grace_minutes)
+    except (ValueError, TypeError):
+        return jsonify({'error': 'Invalid overrun_grace_minutes. Must be a non-negative integer'}), 400
 
     try:
         cursor.execute("""
-            INSERT INTO schedule (start_hour, end_hour, days_active, enabled)
-            VALUES (?, ?, ?, ?)
-        """, (start_hour, end_hour, days_active_str, bool(enabled)))
+            INSERT INTO schedule (start_hour, end_hour, days_active, enabled, admission_policy, overrun_grace_minutes)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (start_hour, end_hour, days_active_str, bool(enabled), admission_policy, overrun_grace_minutes))
         new_id = cursor.lastrowid
+        mark_schedule_changed(cursor) # Other server processes pick the edit up too
         db.commit()
-        cursor.execute("SELECT id, start_hour, end_hour, days_active, enabled FROM schedule WHERE id = ?", (new_id,))
+        invalidate_schedule_cache()
+        notify_llm_queue() # Workers sleeping until the next window re-check the schedule
+        cursor.execute("SELECT id, start_hour, end_hour, days_active, enabled, admission_policy, overrun_grace_minutes FROM schedule WHERE id = ?", (new_id,))
         new_schedule = cursor.fetchone()
         return jsonify(dict(new_schedule)), 201
     except Exception as e:
@@ -93,6 +113,17 @@ def update_schedule(schedule_id):
     if 'enabled' in data:
         updates.append("enabled = ?")
         params.append(bool(data['enabled']))
+    if 'admission_policy' in data:
+        if data['admission_policy'] not in ADMISSION_POLICIES:
+            return jsonify({'error': f"Invalid admission_policy. Must be one of: {', '.join(ADMISSION_POLICIES)}"}), 400
+        updates.append("admission_policy = ?")
+        params.append(data['admission_policy'])
+    if 'overrun_grace_minutes' in data:
+        try:
+            updates.append("overrun_grace_minutes = ?")
+            params.append(_parse_overrun_grace_minutes(data['overrun_grace_minutes']))
+        except (ValueError, TypeError):
+            return jsonify({'error': 'Invalid overrun_grace_minutes format'}), 400
 
     if not updates:
         return jsonify({'error': 'No valid fields provided for update'}), 400
@@ -100,8 +131,11 @@ def update_schedule(schedule_id):
     sql = f"UPDATE schedule SET {', '.join(updates)} WHERE id = ?"
     try:
         cursor.execute(sql, tuple(params))
+        mark_schedule_changed(cursor) # Other server processes pick the edit up too
         db.commit()
-        cursor.execute("SELECT id, start_hour, end_hour, days_active, enabled FROM schedule WHERE id = ?", (schedule_id,))
+        invalidate_schedule_cache()
+        notify_llm_queue() # Workers sleeping until the next window re-check the schedule
+        cursor.execute("SELECT id, start_hour, end_hour, days_active, enabled, admission_policy, overrun_grace_minutes FROM schedule WHERE id = ?", (schedule_id,))
         updated_schedule = cursor.fetchone()
         return jsonify(dict(updated_schedule))
     except Exception as e:
@@ -118,7 +152,10 @@ def delete_schedule(schedule_id):
         return jsonify({'error': 'Schedule not found'}), 404
     try:
         cursor.execute("DELETE FROM schedule WHERE id = ?", (schedule_id,))
+        mark_schedule_changed(cursor) # Other server processes pick the edit up too
         db.commit()
+        invalidate_schedule_cache()
+        notify_llm_queue() # Workers sleeping until the next window re-check the schedule
         return jsonify({'message': 'Schedule deleted successfully'}), 200
     except Exception as e:
         db.rollback()
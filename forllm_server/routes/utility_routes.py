@@ -1,6 +1,6 @@
 from flask import Blueprint, request, jsonify, current_app
-from forllm_server.tokenizer_utils import count_tokens
-from forllm_server.database import get_persona, get_db, get_post_ancestors, get_sibling_branch_roots, get_recent_posts_from_branch # Added for history functions called by helpers
+from forllm_server.tokenizer_utils import count_tokens, count_tokens_batch
+from forllm_server.database import get_persona, get_db, get_post_ancestors # Added for history functions called by helpers
 from forllm_server.ollama_utils import get_model_context_window
 from forllm_server.config import DEFAULT_MODEL, DATABASE # SAFETY_MARGIN_PERCENTAGE might be here or defined locally
 from forllm_server.llm_processing import ( # Import refactored helpers and constants
@@ -57,10 +57,6 @@ def estimate_tokens_route():
         parent_post_id = data.get('parent_post_id') # Expecting null or integer
         client_request_id = data.get('request_id', "estimate_tokens_unknown") # For logging in helpers
 
-        # --- Basic Token Counts (excluding history for now) ---
-        current_post_content_tokens = count_tokens(current_post_text) # This is the user's *new* message
-        attachments_tokens = count_tokens(attachments_text) # Tokens for the attachment string provided
-
         persona_prompt_tokens = 0
         persona_instructions_for_calc = "You are a helpful assistant." # Default
         persona_name = "Default / None Selected"
@@ -82,7 +78,19 @@ def estimate_tokens_route():
             else:
                 logger.warning(f"Persona with ID {selected_persona_id} not found for estimation.")
                 persona_name = f"Unknown Persona (ID: {selected_persona_id})"
-        persona_prompt_tokens = count_tokens(persona_instructions_for_calc)
+
+        # --- Basic Token Counts (excluding history for now), encoded as one batch ---
+        # The user's current message with "User wrote: " prefix and trailing newlines
+        user_post_formatted_for_calc = f"User wrote: {current_post_text}\n\n"
+        (current_post_content_tokens, # This is the user's *new* message
+         attachments_tokens, # Tokens for the attachment string provided
+         persona_prompt_tokens,
+         persona_block_tokens,
+         user_post_tokens_inc_formatting,
+         final_instruction_tokens) = count_tokens_batch([
+            current_post_text, attachments_text, persona_instructions_for_calc,
+            f"{persona_instructions_for_calc}\n\n", user_post_formatted_for_calc, FINAL_INSTRUCTION
+        ])
 
         # --- Model and Context Window ---
         db = get_db() # Use Flask's g.db for all DB ops in this request
@@ -109,11 +117,6 @@ def estimate_tokens_route():
 
         # --- Calculate Fixed Elements Tokens ---
         # This includes the current post (as "User wrote: ..."), persona, attachments, and final instruction.
-        # The user's current message with "User wrote: " prefix and trailing newlines
-        user_post_formatted_for_calc = f"User wrote: {current_post_text}\n\n"
-        user_post_tokens_inc_formatting = count_tokens(user_post_formatted_for_calc)
-
-        final_instruction_tokens = count_tokens(FINAL_INSTRUCTION)
 
         # Attachments string formatting (mirroring llm_processing.py for fixed calculation)
         # For estimation, we assume attachments_text is the content that would be inside the "--- BEGIN/END ATTACHED FILE ---" block.
@@ -127,7 +130,7 @@ def estimate_tokens_route():
 
         fixed_elements_tokens = (
             attachments_tokens + # Assuming attachments_text is the full formatted string from client, or content to be wrapped
-            count_tokens(f"{persona_instructions_for_calc}\n\n") +
+            persona_block_tokens +
             user_post_tokens_inc_formatting + # Already includes "User wrote: ..." and "\n\n"
             final_instruction_tokens
         )
@@ -143,6 +146,7 @@ def estimate_tokens_route():
         # --- Simulate History Construction and Pruning ---
         raw_primary_hist_content = ""
         raw_ambient_hist_content = ""
+        primary_history_entries = None
         pruned_primary_content_tokens = 0
         pruned_ambient_content_tokens = 0
         actual_headers_tokens = 0
@@ -160,7 +164,7 @@ def estimate_tokens_route():
 
                 if topic_id_for_history: # Only proceed if parent_post_id was valid and topic_id found
                     # Pass db connection (g.db) to helpers
-                    raw_primary_hist_content, raw_ambient_hist_content = _get_raw_history_strings(parent_post_id, db, topic_id_for_history)
+                    raw_primary_hist_content, raw_ambient_hist_content, primary_history_entries = _get_raw_history_strings(parent_post_id, db, topic_id_for_history)
             except ValueError:
                 logger.warning(f"Estimator: Invalid parent_post_id format: {parent_post_id}. Assuming no history.")
                 parent_post_id = None # Ensure it's None if invalid
@@ -177,10 +181,11 @@ def estimate_tokens_route():
                 primary_history_budget_ratio=current_primary_budget_ratio, # Use fetched ratio
                 primary_header_template=f"{PRIMARY_HISTORY_HEADER}\n\n",
                 ambient_header_template=f"{AMBIENT_HISTORY_HEADER}\n\n",
-                request_id_for_logging=str(client_request_id)
+                request_id_for_logging=str(client_request_id),
+                primary_history_entries=primary_history_entries
             )
-            pruned_primary_content_tokens = count_tokens(pruning_results["pruned_primary_content_str"])
-            pruned_ambient_content_tokens = count_tokens(pruning_results["pruned_ambient_content_str"])
+            pruned_primary_content_tokens = pruning_results["pruned_primary_content_tokens"]
+            pruned_ambient_content_tokens = pruning_results["pruned_ambient_content_tokens"]
             actual_headers_tokens = pruning_results["primary_header_tokens"] + pruning_results["ambient_header_tokens"]
 
         # --- Final Token Summation ---
@@ -1,21 +1,64 @@
 import datetime
 import sqlite3
-import time # Added time for consistency, though not directly used in these functions
-from .config import DATABASE, DAY_MAP
-
-def is_processing_time():
-    """Checks if the current time is within ANY active scheduled processing window."""
+import threading
+import time
+from .config import DATABASE, DAY_MAP, SCHEDULE_VERSION_CHECK_SECONDS
+
+HOURS_PER_WEEK = 7 * 24
+# Any Monday works as the reference week for compiling; slot index = weekday() * 24 + hour
+_REFERENCE_MONDAY = datetime.datetime(2024, 1, 1)
+
+# Enabled schedules compiled into an hour-per-slot week, so status and "next window"
+# lookups don't query the schedule table. Rebuilt lazily after invalidate_schedule_cache(),
+# or when the schedule_version setting (bumped by mark_schedule_changed) no longer matches.
+_compiled_schedule = None
+_compiled_schedule_version = None
+_schedule_version_checked_at = 0.0
+_compiled_schedule_lock = threading.Lock()
+
+SCHEDULE_VERSION_KEY = 'schedule_version'
+
+def _read_schedule_version(cursor):
+    cursor.execute("SELECT setting_value FROM settings WHERE setting_key = ?", (SCHEDULE_VERSION_KEY,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def _fetch_enabled_schedules():
+    """Returns (schedule_version, enabled schedule rows), read in one transaction."""
     db = sqlite3.connect(DATABASE)
     db.row_factory = sqlite3.Row
-    cursor = db.cursor()
-    cursor.execute('SELECT start_hour, end_hour, days_active, enabled FROM schedule WHERE enabled = TRUE')
-    schedules = cursor.fetchall()
-    db.close()
-
-    if not schedules:
-        return False # No enabled schedules
-
-    now = datetime.datetime.now()
+    try:
+        cursor = db.cursor()
+        cursor.execute("BEGIN")
+        version = _read_schedule_version(cursor)
+        cursor.execute('''
+            SELECT id, start_hour, end_hour, days_active, enabled, admission_policy, overrun_grace_minutes
+            FROM schedule WHERE enabled = TRUE ORDER BY id
+        ''') # Order for consistency
+        schedules = cursor.fetchall()
+    finally:
+        db.close()
+    return version, schedules
+
+def _fetch_schedule_version():
+    db = sqlite3.connect(DATABASE)
+    try:
+        return _read_schedule_version(db.cursor())
+    finally:
+        db.close()
+
+def mark_schedule_changed(cursor):
+    """
+    Bumps the schedule_version setting so every server process recompiles its schedule.
+    Call in the same transaction as the schedule table change, then invalidate_schedule_cache() after commit.
+    """
+    cursor.execute('''
+        INSERT INTO settings (setting_key, setting_value) VALUES (?, '1')
+        ON CONFLICT(setting_key) DO UPDATE SET setting_value = CAST(setting_value AS INTEGER) + 1
+    ''', (SCHEDULE_VERSION_KEY,))
+
+def _is_active_at(schedules, now):
+    """Checks if `now` falls within ANY of the given schedule rows."""
     current_time = now.time()
     current_day_str = DAY_MAP[now.weekday()] # Get 'Mon', 'Tue', etc.
 
@@ -56,52 +99,155 @@ def is_processing_time():
 
     return False # No active schedule found for the current time/day
 
+def _compile_schedule(schedules):
+    """
+    Builds the in-memory week from schedule rows. Every schedule boundary is on the hour,
+    so one slot per hour is exact. Per slot it stores:
+      active        - whether processing is allowed during that hour
+      change_offset - hours until `active` flips (None if it never does)
+      start_offset  - hours until the next schedule start strictly after this slot begins
+      starts        - the schedule row (lowest id wins) starting at that slot, if any
+      admission     - for active slots, how requests near the window end are admitted: (policy, grace_seconds)
+                      from the schedules covering the slot; 'any' wins over 'fit', the largest grace wins
+      window_hours  - for active slots, the length of the whole window containing the slot (None if always on)
+    """
+    active_by_row = [[_is_active_at([schedule_row], _REFERENCE_MONDAY + datetime.timedelta(hours=slot)) for slot in range(HOURS_PER_WEEK)]
+                     for schedule_row in schedules]
+    active = [any(row_active[slot] for row_active in active_by_row) for slot in range(HOURS_PER_WEEK)]
+
+    admission = [None] * HOURS_PER_WEEK
+    for slot in range(HOURS_PER_WEEK):
+        covering = [schedule_row for schedule_row, row_active in zip(schedules, active_by_row) if row_active[slot]]
+        if covering:
+            policies = [schedule_row['admission_policy'] or 'fit' for schedule_row in covering]
+            grace_minutes = max((schedule_row['overrun_grace_minutes'] or 0) for schedule_row in covering)
+            admission[slot] = ('any' if 'any' in policies else 'fit', grace_minutes * 60)
+
+    starts = [None] * HOURS_PER_WEEK
+    day_index = {day: index for index, day in DAY_MAP.items()}
+    for schedule_row in schedules: # Already ordered by id
+        active_days = schedule_row['days_active'].split(',') if schedule_row['days_active'] else []
+        for day in active_days:
+            if day not in day_index:
+                continue
+            slot = day_index[day] * 24 + schedule_row['start_hour']
+            if starts[slot] is None:
+                starts[slot] = dict(schedule_row)
+
+    change_offset = [None] * HOURS_PER_WEEK
+    start_offset = [None] * HOURS_PER_WEEK
+    for slot in range(HOURS_PER_WEEK):
+        for offset in range(1, HOURS_PER_WEEK + 1):
+            other = (slot + offset) % HOURS_PER_WEEK
+            if change_offset[slot] is None and active[other] != active[slot]:
+                change_offset[slot] = offset
+            if start_offset[slot] is None and starts[other] is not None:
+                start_offset[slot] = offset
+            if change_offset[slot] is not None and start_offset[slot] is not None:
+                break
+
+    window_hours = [None] * HOURS_PER_WEEK
+    for slot in range(HOURS_PER_WEEK):
+        if active[slot] and change_offset[slot] is not None:
+            hours_before = 0
+            while active[(slot - hours_before - 1) % HOURS_PER_WEEK]:
+                hours_before += 1
+            window_hours[slot] = hours_before + change_offset[slot]
+
+    return {"active": active, "change_offset": change_offset, "start_offset": start_offset, "starts": starts,
+            "admission": admission, "window_hours": window_hours}
+
+def _get_compiled_schedule():
+    global _compiled_schedule, _compiled_schedule_version, _schedule_version_checked_at
+    compiled = _compiled_schedule
+    if compiled is None or time.monotonic() - _schedule_version_checked_at >= SCHEDULE_VERSION_CHECK_SECONDS:
+        with _compiled_schedule_lock:
+            now = time.monotonic()
+            if _compiled_schedule is not None and now - _schedule_version_checked_at >= SCHEDULE_VERSION_CHECK_SECONDS:
+                # Another process may have edited the schedule; one indexed settings lookup tells.
+                _schedule_version_checked_at = now
+                if _fetch_schedule_version() != _compiled_schedule_version:
+                    _compiled_schedule = None
+            if _compiled_schedule is None:
+                _compiled_schedule_version, schedules = _fetch_enabled_schedules()
+                _compiled_schedule = _compile_schedule(schedules)
+                _schedule_version_checked_at = now
+            compiled = _compiled_schedule
+    return compiled
+
+def invalidate_schedule_cache():
+    """Drops the compiled week. Call after committing any change to the schedule table."""
+    global _compiled_schedule
+    with _compiled_schedule_lock: # Waits out an in-flight compile so it can't store stale rows afterwards
+        _compiled_schedule = None
+
+def _current_slot(now):
+    return now.weekday() * 24 + now.hour, now.replace(minute=0, second=0, microsecond=0)
+
+def is_processing_time():
+    """Checks if the current time is within ANY active scheduled processing window."""
+    slot, _ = _current_slot(datetime.datetime.now())
+    return _get_compiled_schedule()["active"][slot]
+
+def get_processing_window_at(when):
+    """
+    Returns whether processing is allowed at `when` (local, naive) and how many seconds until that changes.
+    seconds_until_change is None when it never changes (no enabled schedules, or always on).
+    While active it also carries the window's admission rules (see the schedule table's admission_policy):
+    admission_policy ('fit' or 'any'), overrun_grace_seconds, and window_seconds, the length of the whole
+    window (None if always on).
+    """
+    compiled = _get_compiled_schedule()
+    slot, slot_start = _current_slot(when)
+    state = {"active": compiled["active"][slot], "seconds_until_change": None}
+    offset = compiled["change_offset"][slot]
+    if offset is not None:
+        change_dt = slot_start + datetime.timedelta(hours=offset)
+        state["seconds_until_change"] = (change_dt - when).total_seconds()
+    if compiled["admission"][slot] is not None:
+        state["admission_policy"], state["overrun_grace_seconds"] = compiled["admission"][slot]
+        window_hours = compiled["window_hours"][slot]
+        state["window_seconds"] = window_hours * 3600 if window_hours is not None else None
+    return state
+
+def get_processing_window_state():
+    """get_processing_window_at(now): whether processing is allowed right now, and until when."""
+    return get_processing_window_at(datetime.datetime.now())
+
+def get_next_processing_time(after):
+    """
+    Returns the earliest (local, naive) datetime at or after `after` when processing is allowed,
+    or None if no enabled schedule ever allows it.
+    """
+    compiled = _get_compiled_schedule()
+    slot, slot_start = _current_slot(after)
+    if compiled["active"][slot]:
+        return after
+    offset = compiled["change_offset"][slot]
+    if offset is None:
+        return None
+    return slot_start + datetime.timedelta(hours=offset)
+
 def get_current_status():
     """Returns the current processing status."""
     return {"active": is_processing_time()}
 
 def get_next_schedule_info():
     """Calculates the next upcoming schedule start time."""
-    db = sqlite3.connect(DATABASE)
-    db.row_factory = sqlite3.Row
-    cursor = db.cursor()
-    cursor.execute('SELECT id, start_hour, end_hour, days_active, enabled FROM schedule WHERE enabled = TRUE ORDER BY id') # Order for consistency
-    schedules = cursor.fetchall()
-    db.close()
-
-    if not schedules:
-        return None
-
+    compiled = _get_compiled_schedule()
     now = datetime.datetime.now()
-    next_start_dt = None
-    next_schedule_details = None
-
-    # Check for up to 7 days ahead
-    for day_offset in range(8): # Check today + next 7 days
-        check_date = (now + datetime.timedelta(days=day_offset)).date()
-        check_day_str = DAY_MAP[check_date.weekday()]
-
-        for schedule_row in schedules: # Renamed to avoid conflict
-            active_days = schedule_row['days_active'].split(',') if schedule_row['days_active'] else []
-            if check_day_str in active_days:
-                start_time = datetime.time(schedule_row['start_hour'], 0)
-                potential_start_dt = datetime.datetime.combine(check_date, start_time)
-
-                # If this potential start is in the future compared to now
-                if potential_start_dt > now:
-                    # If it's the first one we found, or earlier than the current best
-                    if next_start_dt is None or potential_start_dt < next_start_dt:
-                        next_start_dt = potential_start_dt
-                        next_schedule_details = dict(schedule_row) # Store the details of this schedule
-
-    if next_start_dt:
-        # Format the result
-        return {
-            "next_start_iso": next_start_dt.isoformat(),
-            "next_start_day": DAY_MAP[next_start_dt.weekday()],
-            "next_start_time": next_start_dt.strftime("%H:%M"),
-            "schedule_id": next_schedule_details['id'],
-            "schedule_details": f"{str(next_schedule_details['start_hour']).zfill(2)}:00-{str(next_schedule_details['end_hour']).zfill(2)}:00 ({next_schedule_details['days_active']})"
-        }
-    else:
-        return None # No upcoming schedule found within the next week
\ No newline at end of file
+    slot, slot_start = _current_slot(now)
+    offset = compiled["start_offset"][slot]
+
+    if offset is None:
+        return None # No enabled schedule starts on any day
+
+    next_start_dt = slot_start + datetime.timedelta(hours=offset)
+    next_schedule_details = compiled["starts"][(slot + offset) % HOURS_PER_WEEK]
+    return {
+        "next_start_iso": next_start_dt.isoformat(),
+        "next_start_day": DAY_MAP[next_start_dt.weekday()],
+        "next_start_time": next_start_dt.strftime("%H:%M"),
+        "schedule_id": next_schedule_details['id'],
+        "schedule_details": f"{str(next_schedule_details['start_hour']).zfill(2)}:00-{str(next_schedule_details['end_hour']).zfill(2)}:00 ({next_schedule_details['days_active']})"
+    }
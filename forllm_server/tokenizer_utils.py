@@ -1,5 +1,10 @@
 import tiktoken
+import hashlib
 import logging
+import sys
+import threading
+from collections import OrderedDict
+from .config import TOKEN_COUNT_CACHE_MAX_BYTES, TOKEN_COUNT_BATCH_THREADS, TOKEN_COUNT_BATCH_MIN_CHARS
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -8,6 +13,14 @@ _tokenizer = None
 _tokenizer_initialized = False
 _initialization_error = None
 
+# Token counts keyed by a digest of the text, least recently used first
+_count_cache = OrderedDict()
+_count_cache_bytes = 0
+_count_cache_hits = 0
+_count_cache_misses = 0
+_count_cache_lock = threading.Lock()
+_CACHE_ENTRY_OVERHEAD_BYTES = 100 # Approximate cost of an OrderedDict slot besides the key and value objects
+
 def _initialize_tokenizer():
     global _tokenizer, _tokenizer_initialized, _initialization_error
     if _tokenizer_initialized:
@@ -22,9 +35,59 @@ def _initialize_tokenizer():
         _tokenizer_initialized = False # Explicitly set to false on error
         logger.error(f"Failed to initialize tiktoken tokenizer: {e}", exc_info=True)
 
+def is_tokenizer_available() -> bool:
+    """True once the tokenizer loaded, i.e. count_tokens returns real counts rather than 0."""
+    _initialize_tokenizer()
+    return _tokenizer_initialized
+
+def _cache_key(text: str) -> bytes:
+    return hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+def _cached_count(key: bytes):
+    global _count_cache_hits, _count_cache_misses
+    with _count_cache_lock:
+        count = _count_cache.get(key)
+        if count is None:
+            _count_cache_misses += 1
+            return None
+        _count_cache.move_to_end(key)
+        _count_cache_hits += 1
+        return count
+
+def _store_count(key: bytes, count: int):
+    global _count_cache_bytes
+    with _count_cache_lock:
+        if key in _count_cache:
+            return
+        _count_cache[key] = count
+        _count_cache_bytes += sys.getsizeof(key) + sys.getsizeof(count) + _CACHE_ENTRY_OVERHEAD_BYTES
+        while _count_cache_bytes > TOKEN_COUNT_CACHE_MAX_BYTES and _count_cache:
+            old_key, old_count = _count_cache.popitem(last=False)
+            _count_cache_bytes -= sys.getsizeof(old_key) + sys.getsizeof(old_count) + _CACHE_ENTRY_OVERHEAD_BYTES
+
+def _tokenizer_ready() -> bool:
+    _initialize_tokenizer() # Ensure tokenizer is attempted to be initialized
+
+    if not _tokenizer_initialized:
+        if _initialization_error:
+            logger.error(f"Cannot count tokens because tokenizer initialization failed: {_initialization_error}")
+        else:
+            logger.error("Cannot count tokens because tokenizer is not initialized and no specific error was recorded.")
+        return False
+    return True
+
+def _encode_count(text: str) -> int | None:
+    try:
+        tokens = _tokenizer.encode(text)
+        return len(tokens)
+    except Exception as e:
+        logger.error(f"Error encoding text with tiktoken: {e}", exc_info=True)
+        return None # Not cached, so a later call tries again
+
 def count_tokens(text: str) -> int:
     '''
     Counts the number of tokens in the given text using the cl100k_base tokenizer.
+    Counts are memoized by a hash of the text (see TOKEN_COUNT_CACHE_MAX_BYTES).
 
     Args:
         text: The input string.
@@ -33,24 +96,82 @@ def count_tokens(text: str) -> int:
         The number of tokens, or 0 if the tokenizer is not initialized or text is empty.
         Logs an error if tokenizer initialization previously failed.
     '''
-    _initialize_tokenizer() # Ensure tokenizer is attempted to be initialized
-
-    if not _tokenizer_initialized:
-        if _initialization_error:
-            logger.error(f"Cannot count tokens because tokenizer initialization failed: {_initialization_error}")
-        else:
-            logger.error("Cannot count tokens because tokenizer is not initialized and no specific error was recorded.")
+    if not _tokenizer_ready():
         return 0 # Or raise an exception, depending on desired error handling
 
     if not text:
         return 0
 
-    try:
-        tokens = _tokenizer.encode(text)
-        return len(tokens)
-    except Exception as e:
-        logger.error(f"Error encoding text with tiktoken: {e}", exc_info=True)
-        return 0 # Or raise, depending on how you want to handle encoding errors
+    key = _cache_key(text)
+    count = _cached_count(key)
+    if count is None:
+        count = _encode_count(text)
+        if count is None:
+            return 0 # Or raise, depending on how you want to handle encoding errors
+        _store_count(key, count)
+    return count
+
+def count_tokens_batch(texts: list) -> list:
+    '''
+    Counts tokens for several texts at once, in the same order. Cached counts are reused and the
+    remaining distinct texts are encoded together on TOKEN_COUNT_BATCH_THREADS threads when they add up to
+    at least TOKEN_COUNT_BATCH_MIN_CHARS, otherwise one by one.
+
+    Args:
+        texts: The input strings.
+
+    Returns:
+        A list of token counts, 0 for empty texts or if the tokenizer is not initialized.
+    '''
+    if not _tokenizer_ready():
+        return [0] * len(texts)
+
+    counts = [0] * len(texts)
+    pending = {} # key -> (text, indexes into texts)
+    for index, text in enumerate(texts):
+        if not text:
+            continue
+        key = _cache_key(text)
+        if key in pending:
+            pending[key][1].append(index)
+            continue
+        count = _cached_count(key)
+        if count is None:
+            pending[key] = (text, [index])
+        else:
+            counts[index] = count
+
+    if pending:
+        keys = list(pending)
+        new_counts = None
+        if len(keys) > 1 and sum(len(pending[key][0]) for key in keys) >= TOKEN_COUNT_BATCH_MIN_CHARS:
+            try:
+                encoded = _tokenizer.encode_batch([pending[key][0] for key in keys], num_threads=TOKEN_COUNT_BATCH_THREADS)
+                new_counts = [len(tokens) for tokens in encoded]
+            except Exception as e: # One bad text fails the whole batch; count them one by one instead
+                logger.warning(f"Batch token encoding failed, counting texts individually: {e}")
+        if new_counts is None:
+            new_counts = [_encode_count(pending[key][0]) for key in keys]
+        for key, count in zip(keys, new_counts):
+            if count is None:
+                continue
+            _store_count(key, count)
+            for index in pending[key][1]:
+                counts[index] = count
+    return counts
+
+def get_token_count_cache_stats() -> dict:
+    '''Hit/miss counters and size of the token count cache since startup.'''
+    with _count_cache_lock:
+        lookups = _count_cache_hits + _count_cache_misses
+        return {
+            'hits': _count_cache_hits,
+            'misses': _count_cache_misses,
+            'hit_rate': round(_count_cache_hits / lookups, 4) if lookups else None,
+            'entries': len(_count_cache),
+            'bytes': _count_cache_bytes,
+            'max_bytes': TOKEN_COUNT_CACHE_MAX_BYTES,
+        }
 
 # Attempt to initialize the tokenizer when the module is loaded
 # This makes it ready for use as soon as possible.
@@ -361,6 +361,12 @@ function renderPostNode(post, parentElement, depth) {
         llmButton.textContent = 'Request LLM Response';
         llmButton.addEventListener('click', () => requestLlm(post.post_id));
         actionsDiv.appendChild(llmButton);
+    } else if (post.parent_post_id !== null) {
+        // Asks for a fresh reply to the same post with the same persona, bypassing the response cache
+        const regenerateButton = document.createElement('button');
+        regenerateButton.textContent = 'Regenerate';
+        regenerateButton.addEventListener('click', () => requestLlm(post.parent_post_id, { personaId: post.llm_persona_id, useCache: false }));
+        actionsDiv.appendChild(regenerateButton);
     }
 
     const tagPersonaContainer = document.createElement('div');
@@ -434,6 +440,116 @@ function renderPostNode(post, parentElement, depth) {
 
 // Removed displayPostTagSuggestions from here as it's moved above renderPostNode
 
+// --- Live LLM Reply Streaming (Server-Sent Events) ---
+let topicStreamSource = null;
+let topicStreamTopicId = null;
+let streamingReplies = {}; // request_id -> { postId, text } for replies still being generated
+let suspendedTopicStreamId = null; // Topic whose stream was closed because the user left the topic view
+
+function renderStreamingReply(requestId) {
+    const reply = streamingReplies[requestId];
+    if (!reply) return;
+
+    let replyDiv = postList.querySelector(`.llm-streaming[data-request-id="${requestId}"]`);
+    if (!replyDiv) {
+        const parentPostDiv = postList.querySelector(`.post[data-post-id="${reply.postId}"]`);
+        if (!parentPostDiv) return; // Parent not rendered (e.g. deleted); the finished post shows up on refresh
+
+        let repliesContainer = parentPostDiv.querySelector(':scope > .post-replies');
+        if (!repliesContainer) {
+            repliesContainer = document.createElement('div');
+            repliesContainer.className = 'post-replies';
+            parentPostDiv.appendChild(repliesContainer);
+        }
+
+        replyDiv = document.createElement('div');
+        replyDiv.className = 'post llm-response llm-streaming';
+        replyDiv.dataset.requestId = requestId;
+        replyDiv.innerHTML = `
+            <div class="post-meta"><div class="post-meta-info"><span class="llm-meta">LLM is responding&hellip;</span></div></div>
+            <div class="post-content llm-streaming-content"></div>
+        `;
+        repliesContainer.appendChild(replyDiv);
+    }
+    replyDiv.querySelector('.llm-streaming-content').textContent = reply.text;
+}
+
+async function refreshPostsAfterStream(topicId) {
+    // Re-render in place (no showSection) so a reply finishing in the background doesn't pull the user back here.
+    if (isEditingPost || currentTopicId !== topicId) return;
+    try {
+        const posts = await apiRequest(`/api/topics/${topicId}/posts`, 'GET', null, false, true);
+        if (!isEditingPost && currentTopicId === topicId) {
+            renderPosts(posts);
+            Object.keys(streamingReplies).forEach(renderStreamingReply); // Other replies may still be streaming
+        }
+    } catch (error) {
+        // Logged by apiRequest; the finished post appears on the next load
+    }
+}
+
+function closeTopicStream() {
+    if (topicStreamSource) {
+        topicStreamSource.close();
+    }
+    topicStreamSource = null;
+    topicStreamTopicId = null;
+    streamingReplies = {};
+}
+
+// Called by showSection() on every view change: the stream is only held open while the topic is on screen.
+export function suspendTopicStream() {
+    if (topicStreamSource) {
+        suspendedTopicStreamId = topicStreamTopicId;
+    }
+    closeTopicStream();
+}
+
+export function resumeTopicStream() {
+    const topicId = suspendedTopicStreamId;
+    suspendedTopicStreamId = null;
+    if (topicId === null || topicId !== currentTopicId) return; // loadPosts opens the stream for a newly loaded topic
+    openTopicStream(topicId);
+    refreshPostsAfterStream(topicId); // Replies may have finished while the topic was hidden
+}
+
+// Don't hold a server connection open for a page that is being unloaded or put in the back/forward cache.
+window.addEventListener('pagehide', suspendTopicStream);
+window.addEventListener('pageshow', (event) => {
+    if (event.persisted) resumeTopicStream();
+});
+
+function openTopicStream(topicId) {
+    if (typeof EventSource === 'undefined') return; // Replies still appear when the topic is reloaded
+    if (topicStreamSource && topicStreamTopicId === topicId) {
+        Object.keys(streamingReplies).forEach(renderStreamingReply); // Posts were just re-rendered
+        return;
+    }
+    closeTopicStream();
+
+    topicStreamSource = new EventSource(`/api/topics/${topicId}/stream`);
+    topicStreamTopicId = topicId;
+
+    topicStreamSource.addEventListener('start', (event) => {
+        const data = JSON.parse(event.data);
+        streamingReplies[data.request_id] = { postId: data.post_id, text: '' }; // A restarted stream resends everything
+        renderStreamingReply(data.request_id);
+    });
+    topicStreamSource.addEventListener('token', (event) => {
+        const data = JSON.parse(event.data);
+        if (!streamingReplies[data.request_id]) return;
+        streamingReplies[data.request_id].text += data.text;
+        renderStreamingReply(data.request_id);
+    });
+    topicStreamSource.addEventListener('done', (event) => {
+        const data = JSON.parse(event.data);
+        delete streamingReplies[data.request_id];
+        const replyDiv = postList.querySelector(`.llm-streaming[data-request-id="${data.request_id}"]`);
+        if (replyDiv) replyDiv.remove();
+        refreshPostsAfterStream(topicId);
+    });
+}
+
 // --- Loading Functions ---
 export async function loadSubforums(shouldShowSection = true) {
     try {
@@ -450,6 +566,7 @@ export async function loadSubforums(shouldShowSection = true) {
 export async function loadTopics(subforumId, subforumName) {
     currentSubforumId = subforumId;
     currentTopicId = null;
+    closeTopicStream();
     try {
         const topics = await apiRequest(`/api/subforums/${subforumId}/topics`);
         currentSubforumName.textContent = subforumName;
@@ -468,6 +585,7 @@ export async function loadPosts(topicId, topicTitle) {
         renderPosts(posts);
         showSection('topic-view-section');
         hideReplyForm();
+        openTopicStream(topicId);
         // After successfully loading posts and updating user activity for the topic,
         // refresh the subforum list to update badges.
         // Pass false to prevent loadSubforums from hiding the topic view section
@@ -687,15 +805,24 @@ export async function submitReply() {
     }
 }
 
-export async function requestLlm(postId) {
-    if (!confirm(`Request an LLM response to post ${postId}?`)) {
+export async function requestLlm(postId, options = {}) {
+    const regenerate = options.useCache === false;
+    const question = regenerate
+        ? `Generate a new LLM response to post ${postId}? A cached reply will not be reused.`
+        : `Request an LLM response to post ${postId}?`;
+    if (!confirm(question)) {
         return;
     }
     try {
         let payload = {};
-        if (typeof llmPersonaSelect !== 'undefined' && llmPersonaSelect && llmPersonaSelect.value) {
+        if (options.personaId) {
+            payload.persona_id = options.personaId;
+        } else if (typeof llmPersonaSelect !== 'undefined' && llmPersonaSelect && llmPersonaSelect.value) {
             payload.persona_id = llmPersonaSelect.value;
         }
+        if (regenerate) {
+            payload.use_cache = false;
+        }
         await apiRequest(`/api/posts/${postId}/request_llm`, 'POST', payload);
         alert(`LLM response request queued for post ${postId}. It will be processed during scheduled hours.`);
     } catch (error) {
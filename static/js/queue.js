@@ -13,6 +13,23 @@ function escapeHTML(str) {
 }
 
 
+// One-line timing summary for a finished request: where its time went (queue, model load, prompt eval, decode)
+function formatRequestPerf(item) {
+    const parts = [];
+    if (item.queue_wait_seconds != null) parts.push(`queued ${item.queue_wait_seconds.toFixed(1)}s`);
+    if (item.prompt_build_seconds != null) parts.push(`prompt build ${item.prompt_build_seconds.toFixed(2)}s`);
+    if (item.load_duration) parts.push(`model load ${(item.load_duration / 1e9).toFixed(2)}s`);
+    if (item.prompt_eval_count != null && item.prompt_eval_duration) {
+        parts.push(`prompt eval ${item.prompt_eval_count} tok in ${(item.prompt_eval_duration / 1e9).toFixed(2)}s`);
+    }
+    if (item.time_to_first_token_seconds != null) parts.push(`first token ${item.time_to_first_token_seconds.toFixed(2)}s`);
+    if (item.eval_count != null && item.eval_duration) {
+        parts.push(`decode ${item.eval_count} tok at ${(item.eval_count / (item.eval_duration / 1e9)).toFixed(1)} tok/s`);
+    }
+    return parts.join(', ');
+}
+
+
 // --- New Token Breakdown Rendering Function for Modal ---
 function renderTokenBreakdownForModal(breakdownString, containerElement) {
     if (!containerElement) return;
@@ -139,7 +156,7 @@ export function renderQueueList(queueItems) {
                 <strong>Request ID: ${item.request_id}</strong><br>
                 Status: <span class="queue-status status-${status}">Pending Dependency</span><br>
                 Model: ${model}, Persona: ${personaDisplay}<br>
-                Queued: <span class="queue-meta">${queuedAt}</span>
+                Queued: <span class="queue-meta">${queuedAt}</span>, Priority: <span class="queue-meta">${item.priority ?? 'N/A'}</span>
             `;
         } else {
             snippet = item.post_snippet ? escapeHTML(item.post_snippet.substring(0, 150) + '...') : 'No snippet available';
@@ -161,9 +178,42 @@ export function renderQueueList(queueItems) {
                 <strong>Request ID: ${item.request_id}</strong><br>
                 Status: <span class="queue-status status-${status}">${status}</span><br>
                 Model: ${model}, Persona: ${personaDisplay}<br>
-                Queued: <span class="queue-meta">${queuedAt}</span><br>
+                Queued: <span class="queue-meta">${queuedAt}</span>, Priority: <span class="queue-meta">${item.priority ?? 'N/A'}</span><br>
                 Total Tokens: <span class="queue-meta">${totalTokensDisplay}</span>
             `;
+            // Requests that hit a transient Ollama failure are retried; show how it's going
+            if (item.attempt_count > 1 || item.last_error) {
+                const retryNote = status === 'pending' && item.next_attempt_at
+                    ? `, next try after <span class="queue-meta">${new Date(item.next_attempt_at + 'Z').toLocaleString()}</span>`
+                    : '';
+                summaryContent += `<br>Attempts: <span class="queue-meta">${item.attempt_count}</span>${retryNote}`;
+                if (item.last_error) {
+                    summaryContent += `<br>Last error: <span class="queue-meta">${escapeHTML(item.last_error)}</span>`;
+                }
+            }
+            const perf = formatRequestPerf(item);
+            if (perf) {
+                summaryContent += `<br>Timing: <span class="queue-meta">${perf}</span>`;
+            }
+            if (item.cache_status === 'hit') {
+                summaryContent += `<br><span class="queue-meta">Served from the response cache</span>`;
+            } else if (status === 'pending' && item.coalesced_into) {
+                summaryContent += `<br>Waiting on identical request <span class="queue-meta">${item.coalesced_into}</span>`;
+            }
+        }
+
+        // Estimated from recent per-model throughput and the processing schedule (see estimate_llm_queue_etas)
+        if (item.position !== undefined) {
+            const positionText = item.position === 0 ? 'running' : `#${item.position} in queue`;
+            let etaText;
+            if (item.estimated_start) {
+                etaText = `starts ~<span class="queue-meta">${new Date(item.estimated_start).toLocaleString()}</span>, done ~<span class="queue-meta">${new Date(item.estimated_finish).toLocaleString()}</span>`;
+            } else if (item.blocked_on_parent) {
+                etaText = `waiting on request <span class="queue-meta">${item.blocked_on_parent}</span>, which is no longer queued`;
+            } else {
+                etaText = 'no processing window scheduled';
+            }
+            summaryContent += `<br>ETA: ${positionText}, ${etaText}`;
         }
 
 
@@ -176,6 +226,45 @@ export function renderQueueList(queueItems) {
             </div>
         `;
 
+        // Queued requests can be moved ahead of bulk work
+        if (status === 'pending' || status === 'pending_dependency') {
+            const bumpButton = document.createElement('button');
+            bumpButton.className = 'button-secondary queue-bump-button';
+            bumpButton.textContent = 'Bump';
+            bumpButton.title = 'Process this request before lower-priority work';
+            bumpButton.addEventListener('click', async (event) => {
+                event.stopPropagation(); // Don't open the prompt modal
+                bumpButton.disabled = true;
+                try {
+                    await apiRequest(`/api/queue/${item.request_id}/bump`, 'POST');
+                    loadQueueData(currentQueuePage);
+                } catch (error) {
+                    bumpButton.disabled = false; // apiRequest already alerted the user
+                }
+            });
+            li.querySelector('.queue-item-summary').appendChild(bumpButton);
+        }
+
+        // Queued or running requests can be cancelled (a running generation is stopped)
+        if (status === 'pending' || status === 'pending_dependency' || status === 'processing') {
+            const cancelButton = document.createElement('button');
+            cancelButton.className = 'button-secondary queue-cancel-button';
+            cancelButton.textContent = 'Cancel';
+            cancelButton.title = 'Stop this request and any replies chained behind it';
+            cancelButton.addEventListener('click', async (event) => {
+                event.stopPropagation(); // Don't open the prompt modal
+                if (!confirm(`Cancel request ${item.request_id}? Replies chained behind it are cancelled too.`)) return;
+                cancelButton.disabled = true;
+                try {
+                    await apiRequest(`/api/queue/${item.request_id}`, 'DELETE');
+                    loadQueueData(currentQueuePage);
+                } catch (error) {
+                    cancelButton.disabled = false; // apiRequest already alerted the user
+                }
+            });
+            li.querySelector('.queue-item-summary').appendChild(cancelButton);
+        }
+
         // Add click listener to show full prompt and pass token breakdown string
         li.addEventListener('click', () => showFullPromptModal(item.request_id, item.prompt_token_breakdown));
 
@@ -211,8 +300,11 @@ async function showFullPromptModal(requestId, tokenBreakdownString) { // Added t
 
 
 // --- Queue Loading Function ---
+let currentQueuePage = 1; // Page to reload after actions on a queue item
+
 export async function loadQueueData(page = 1) {
     if (!queuePageContent) return;
+    currentQueuePage = page;
 
     if (page === 1) {
         queuePageContent.innerHTML = '<p>Loading queue...</p>';
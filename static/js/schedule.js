@@ -46,6 +46,8 @@ function createScheduleRowElement(schedule = {}) {
     const endHour = schedule.end_hour !== undefined ? schedule.end_hour : 6;
     const enabled = schedule.enabled !== undefined ? schedule.enabled : false; // Default new schedules to disabled
     const activeDays = schedule.days_active ? schedule.days_active.split(',') : []; // Default to no days if new
+    const finishInWindow = (schedule.admission_policy || 'fit') === 'fit';
+    const graceMinutes = schedule.overrun_grace_minutes ?? 0;
 
     const row = document.createElement('div');
     row.className = 'schedule-row';
@@ -89,6 +91,16 @@ function createScheduleRowElement(schedule = {}) {
          toggleLabel.title = e.target.checked ? 'Schedule Enabled' : 'Schedule Disabled';
     });
 
+    // Near the window end, only start requests predicted to finish in time (plus the grace minutes)
+    const admissionContainer = document.createElement('div');
+    admissionContainer.className = 'schedule-admission';
+    admissionContainer.innerHTML = `
+        <label title="Near the end of the window, only start requests predicted to finish before it closes">
+            <input type="checkbox" class="schedule-finish-in-window" ${finishInWindow ? 'checked' : ''}> Finish in window
+        </label>
+        <input type="number" class="schedule-overrun-grace" min="0" value="${graceMinutes}" title="Minutes a request may run past the window end">
+    `;
+
     const deleteButton = document.createElement('button');
     deleteButton.className = 'delete-schedule-btn';
     deleteButton.textContent = '🗑';
@@ -100,6 +112,7 @@ function createScheduleRowElement(schedule = {}) {
 
     row.appendChild(timeInputContainer);
     row.appendChild(daysSelector);
+    row.appendChild(admissionContainer);
     row.appendChild(toggleLabel);
     row.appendChild(deleteButton);
     return row;
@@ -253,16 +266,20 @@ export async function saveSchedules() {
         const startHourInput = row.querySelector('.schedule-start-hour');
         const endHourInput = row.querySelector('.schedule-end-hour');
         const enabledCheckbox = row.querySelector('.schedule-enabled');
+        const finishInWindowCheckbox = row.querySelector('.schedule-finish-in-window');
+        const graceInput = row.querySelector('.schedule-overrun-grace');
         const dayCheckboxes = row.querySelectorAll('.days-selector input[type="checkbox"]:checked');
 
         const startHour = parseInt(startHourInput.value, 10);
         const endHour = parseInt(endHourInput.value, 10);
         const enabled = enabledCheckbox.checked;
         const daysActive = Array.from(dayCheckboxes).map(cb => cb.value);
+        const graceMinutes = parseInt(graceInput.value, 10);
 
         startHourInput.style.borderColor = '';
         endHourInput.style.borderColor = '';
         row.querySelector('.days-selector').style.border = '';
+        graceInput.style.borderColor = '';
 
         if (isNaN(startHour) || startHour < 0 || startHour > 23 ||
             isNaN(endHour) || endHour < 0 || endHour > 23) {
@@ -271,6 +288,11 @@ export async function saveSchedules() {
             startHourInput.style.borderColor = 'red';
             endHourInput.style.borderColor = 'red';
         }
+        if (isNaN(graceMinutes) || graceMinutes < 0) {
+            scheduleError.textContent += `Invalid grace minutes in row ${index + 1}. `;
+            validationError = true;
+            graceInput.style.borderColor = 'red';
+        }
         if (daysActive.length === 0) {
              scheduleError.textContent += `Select at least one day in row ${index + 1}. `;
              validationError = true;
@@ -282,7 +304,9 @@ export async function saveSchedules() {
                 start_hour: startHour,
                 end_hour: endHour,
                 days_active: daysActive,
-                enabled: enabled
+                enabled: enabled,
+                admission_policy: finishInWindowCheckbox.checked ? 'fit' : 'any',
+                overrun_grace_minutes: graceMinutes
             };
             if (scheduleId) {
                 promises.push(apiRequest(`/api/schedules/${scheduleId}`, 'PUT', scheduleData));
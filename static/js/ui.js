@@ -19,6 +19,7 @@ let lastVisibleSectionId = 'activity-page-section'; // Default to activity page
 
 // Import loadActivityData from activity.js
 import { loadActivityData } from './activity.js';
+import { suspendTopicStream, resumeTopicStream } from './forum.js';
 
 export function showSection(sectionIdToShow, navElement = null) {
     if (!sectionIdToShow) {
@@ -27,6 +28,13 @@ export function showSection(sectionIdToShow, navElement = null) {
 
     setActiveNav(navElement);
 
+    // Live reply streaming only runs while a topic is shown
+    if (sectionIdToShow === 'topic-view-section') {
+        resumeTopicStream();
+    } else {
+        suspendTopicStream();
+    }
+
     // Always keep the sidebar visible
     subforumNav.style.display = 'flex'; // Use flex as defined in CSS
 